@@ -11,7 +11,11 @@
 """
 
 __version__ = '0.0.1'
-__all__ = ['Flood', 'UDF']
+__all__ = ['Flood', 'UDF', 'WhatIf', 'DamageFunctionLibrary', 'FieldMap', 'ArrayDepthGrid', 'SamplingPlan']
 
 from .flood import Flood
-from .udf import UDF
\ No newline at end of file
+from .udf import UDF
+from .what_if import WhatIf
+from .damage_functions import DamageFunctionLibrary
+from .udf_engine import FieldMap
+from .depth_grid import ArrayDepthGrid, SamplingPlan
@@ -0,0 +1,321 @@
+"""
+    Hazus - Flood depth-damage function library
+    ~~~~~
+
+    Compiles the FAST lookup table csvs (depth-damage functions, inventory economic
+    parameters, debris and restoration time) once into hash indexes keyed on their
+    lookup column and dense arrays of their numeric columns, so lookups and damage
+    interpolation are whole-array operations.
+
+    :copyright: © 2019 by FEMA's Natural Hazards and Risk Assesment Program.
+    :license: cc, see LICENSE for more details.
+"""
+
+import csv
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+# Lookup tables expected in LUT_Dir
+LUT_FILES = {
+    'bddf_riverine': 'Building_DDF_Riverine_LUT_Hazus4p0.csv',
+    'bddf_coastalA': 'Building_DDF_CoastalA_LUT_Hazus4p0.csv',
+    'bddf_coastalV': 'Building_DDF_CoastalV_LUT_Hazus4p0.csv',
+    'bddf_full': 'flBldgStructDmgFn.csv',
+    'cddf_riverine': 'Content_DDF_Riverine_LUT_Hazus4p0.csv',
+    'cddf_coastalA': 'Content_DDF_CoastalA_LUT_Hazus4p0.csv',
+    'cddf_coastalV': 'Content_DDF_CoastalV_LUT_Hazus4p0.csv',
+    'cddf_full': 'flBldgContDmgFn.csv',
+    'iddf_riverine': 'Inventory_DDF_LUT_Hazus4p0.csv',
+    'iddf_full': 'flBldgInvDmgFn.csv',
+    'iecon': 'flBldgEconParamSalesAndInv.csv',
+    'debris': 'flDebris_LUT.csv',
+    'rest': 'flRsFnGBS_LUT.csv'
+}
+
+# Lookup column of each table. The others are keyed on SpecificOccupId
+LUT_KEYS = {
+    'bddf_full': 'BldgDmgFnID',
+    'cddf_full': 'ContDmgFnId',
+    'iddf_full': 'InvDmgFnId',
+    'iecon': 'Occupancy',
+    'debris': 'DebrisID',
+    'rest': 'RestFnID'
+}
+
+# Compiled lookup tables, written to LUT_Dir as a numpy .npz archive loaded without pickle.
+# The version changes with the compiled form
+CACHE_FILE = '.hazpy_lut_cache.npz'
+CACHE_VERSION = 2
+
+# Depth columns of the DDF lookup tables: m4, m3, ... p0, ... p24 (feet)
+DEPTH_MIN = -4
+DEPTH_MAX = 24
+DEPTH_COLUMNS = [('m' if d < 0 else 'p') + str(abs(d)) for d in range(DEPTH_MIN, DEPTH_MAX + 1)]
+
+
+def _textColumn(values):
+    """A column of csv text as a numpy str array, or an object array if it has missing (None) cells"""
+    if any(value is None for value in values):
+        column = np.empty(len(values), dtype=object)
+        column[:] = values
+        return column
+    return np.array(values, dtype=str)
+
+
+class DamageFunctionTable():
+    """A lookup table csv indexed on its key column
+
+    Keyword Arguments:
+        path: str -- the lookup table csv
+        key: str -- the lookup column
+        keepLast: bool -- index the last row of repeated keys instead of the first
+
+    Notes: Positions returned by lookup are row numbers of the table, -1 for keys that are not
+        in it. Columns gathered at -1 positions take their missing value. The cells are kept as
+        text columns, read as csv.DictReader reads them, so a table is saved as a few arrays.
+    """
+    def __init__(self, path, key, keepLast=False):
+        with open(path) as f:
+            reader = csv.DictReader(f)
+            rows = [row for row in reader]
+            fieldnames = list(dict.fromkeys(reader.fieldnames or []))
+        text = dict((name, _textColumn([row.get(name) for row in rows])) for name in fieldnames)
+        self._setColumns(path, key, keepLast, fieldnames, text, len(rows))
+
+    @classmethod
+    def fromColumns(cls, path, key, keepLast, fieldnames, text, length, depths=None):
+        """Builds a table from the text columns of a compiled cache, indexed as the csv would be"""
+        table = cls.__new__(cls)
+        table._setColumns(path, key, keepLast, fieldnames, text, length)
+        table._depths = depths
+        return table
+
+    def _setColumns(self, path, key, keepLast, fieldnames, text, length):
+        self.path = path
+        self.key = key
+        self.keepLast = keepLast
+        self.fieldnames = fieldnames
+        self.text = text
+        self.length = length
+        self.index = {}
+        for i, value in enumerate(text[key].tolist() if length else []):
+            if keepLast or value not in self.index:
+                self.index[value] = i
+        self._columns = {}
+        self._depths = None
+
+    def __len__(self):
+        return self.length
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def get(self, key):
+        """Returns the row of key as a dict, or None if it is not in the table"""
+        position = self.index.get(key)
+        if position is None:
+            return None
+        return dict((name, self.text[name][position:position + 1].tolist()[0]) for name in self.fieldnames)
+
+    def lookup(self, keys):
+        """Returns the row positions of keys, -1 where the key is not in the table"""
+        codes, uniques = pd.factorize(np.asarray(keys, dtype=object))
+        positions = np.array([self.index.get(key, -1) for key in uniques] + [-1], dtype=np.int64)
+        return positions[codes]
+
+    def compiled(self, name, convert=float, missing=np.nan):
+        """Returns column name converted to an array, with the missing value appended for position -1"""
+        cacheKey = (name, convert, missing if missing == missing else 'nan')
+        if cacheKey not in self._columns:
+            values = [convert(value) for value in self.text[name].tolist()] + [missing]
+            self._columns[cacheKey] = np.array(values)
+        return self._columns[cacheKey]
+
+    def column(self, name, positions, convert=float, missing=np.nan):
+        """Gathers the converted values of column name at the positions"""
+        return self.compiled(name, convert, missing)[positions]
+
+    def values(self, name, positions):
+        """Gathers the text of column name at the positions, None where missing"""
+        cacheKey = (name, None, None)
+        if cacheKey not in self._columns:
+            values = np.empty(self.length + 1, dtype=object)
+            values[:-1] = self.text[name].tolist()
+            self._columns[cacheKey] = values
+        return self._columns[cacheKey][positions]
+
+    @property
+    def depths(self):
+        """The depth columns as a dense (rows x DEPTH_COLUMNS) float array of damage percents"""
+        if self._depths is None:
+            columns = [[float(value) for value in self.text[column].tolist()] for column in DEPTH_COLUMNS]
+            self._depths = np.array(columns, dtype=float).reshape(len(DEPTH_COLUMNS), -1).T.copy()
+        return self._depths
+
+    def interpolate(self, positions, depth):
+        """Damage ratio of the DDF rows at the depths, linearly interpolated between the foot columns
+
+        Keyword Arguments:
+            positions: numpy array -- row positions from lookup; all must be matched
+            depth: numpy array -- depths in feet, already clipped to DEPTH_MIN..DEPTH_MAX
+
+        Returns:
+            damage: numpy array -- damage as a fraction of the cost
+        """
+        lower = np.floor(depth)
+        frac = depth - lower
+        d_lower = self.depths[positions, (lower - DEPTH_MIN).astype(np.int64)]
+        d_upper = self.depths[positions, (np.ceil(depth) - DEPTH_MIN).astype(np.int64)]
+        return (d_lower + frac * (d_upper - d_lower)) / 100
+
+
+def _fileHash(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class DamageFunctionLibrary():
+    """The FAST lookup tables of a lookup table folder, compiled for vector lookups
+
+    Keyword Arguments:
+        LUT_Dir: str -- folder where the lookup table libraries reside
+        cache: bool -- load the tables from, and save them to, the compiled cache file in LUT_Dir
+
+    Notes: Tables are accessed by their LUT_FILES key, e.g. library['bddf_full']. Like the row
+        by row engine, the debris table resolves repeated DebrisIDs to their last row and the
+        other tables to their first.
+
+        library = DamageFunctionLibrary(LUT_Dir)
+        positions = library['bddf_riverine'].lookup(['RE12N', 'C1LN'])
+        damage = library['bddf_riverine'].interpolate(positions, np.array([2.5, 4.0]))
+
+        The cache (CACHE_FILE) is a numpy .npz archive of plain arrays and json, loaded with
+        allow_pickle=False. It records the size, modification time and SHA-256 of every csv it was
+        compiled from. It is used when they all match; a csv with another modification time but the
+        same size and hash still matches. Otherwise the tables are compiled from the csvs and the
+        cache is rewritten. A folder that cannot be written to is only read.
+
+        version identifies the contents of the csvs, e.g. to tell if results computed with another
+        library still hold.
+    """
+    def __init__(self, LUT_Dir, cache=True):
+        self.LUT_Dir = LUT_Dir
+        self.sources = None
+        self.tables = self._load() if cache else None
+        if self.tables is None:
+            self.sources = sources = self._sources()
+            self.tables = {}
+            for name, fileName in LUT_FILES.items():
+                key = LUT_KEYS.get(name, 'SpecificOccupId')
+                self.tables[name] = DamageFunctionTable(os.path.join(LUT_Dir, fileName), key, keepLast=name == 'debris')
+            if cache:
+                self._save(sources)
+
+    def __getitem__(self, name):
+        return self.tables[name]
+
+    def __contains__(self, name):
+        return name in self.tables
+
+    def keys(self):
+        return self.tables.keys()
+
+    @property
+    def version(self):
+        """A hash of the SHA-256 of every lookup table csv"""
+        digests = ''.join(fileName + ':' + self.sources[fileName][2] + '\n' for fileName in sorted(self.sources))
+        return hashlib.sha256(digests.encode('utf-8')).hexdigest()[:16]
+
+    def _sources(self, hashes=True):
+        """The size, modification time and hash of every lookup table csv"""
+        sources = {}
+        for fileName in LUT_FILES.values():
+            path = os.path.join(self.LUT_Dir, fileName)
+            stat = os.stat(path)
+            sources[fileName] = (stat.st_size, stat.st_mtime_ns, _fileHash(path) if hashes else None)
+        return sources
+
+    def _load(self):
+        """Returns the tables of the cache, or None if there is none or a csv has changed"""
+        try:
+            with np.load(os.path.join(self.LUT_Dir, CACHE_FILE), allow_pickle=False) as cached:
+                meta = json.loads(str(cached['meta']))
+                if meta['version'] != CACHE_VERSION or set(meta['sources']) != set(LUT_FILES.values()):
+                    return None
+                sources = dict((fileName, tuple(source)) for fileName, source in meta['sources'].items())
+                current = self._sources(hashes=False)
+                touched = False
+                for fileName, (size, mtime, digest) in sources.items():
+                    if current[fileName][:2] == (size, mtime):
+                        continue
+                    if current[fileName][0] != size or _fileHash(os.path.join(self.LUT_Dir, fileName)) != digest:
+                        return None
+                    touched = True
+                tables = dict((name, self._loadTable(cached, name, table)) for name, table in meta['tables'].items())
+            self.sources = sources
+        except Exception:
+            return None
+        if touched:
+            # Same contents under new modification times: record them, so they are not hashed again
+            self.tables = tables
+            self.sources = self._sources()
+            self._save(self.sources)
+        return tables
+
+    def _loadTable(self, cached, name, table):
+        """Rebuilds table name from its arrays in the cache and its entry in the cache metadata"""
+        text = {}
+        for i, fieldName in enumerate(table['fieldnames']):
+            column = cached[name + '.' + str(i)]
+            if i in table['missing']:
+                column = column.astype(object)
+                column[cached[name + '.' + str(i) + '.missing']] = None
+            text[fieldName] = column
+        depths = cached[name + '.depths'] if table['depths'] else None
+        return DamageFunctionTable.fromColumns(os.path.join(self.LUT_Dir, table['file']), table['key'], table['keepLast'],
+                                               table['fieldnames'], text, table['length'], depths)
+
+    def _save(self, sources):
+        """Writes the cache, replacing the previous one at once so concurrent readers see either
+
+        Notes: The text columns, with a mask of their missing cells, and the compiled depths are saved
+            as arrays and the rest as json, so loading the cache runs no code from it.
+        """
+        arrays = {}
+        tables = {}
+        for name, table in self.tables.items():
+            if all(column in table.text for column in DEPTH_COLUMNS):
+                try:
+                    table.depths
+                except (TypeError, ValueError):
+                    pass
+            missing = []
+            for i, fieldName in enumerate(table.fieldnames):
+                column = table.text[fieldName]
+                if column.dtype == object:
+                    missing.append(i)
+                    arrays[name + '.' + str(i) + '.missing'] = np.array([value is None for value in column.tolist()], dtype=bool)
+                    column = np.array(['' if value is None else value for value in column.tolist()], dtype=str)
+                arrays[name + '.' + str(i)] = column
+            if table._depths is not None:
+                arrays[name + '.depths'] = table._depths
+            tables[name] = {'file': os.path.basename(table.path), 'key': table.key, 'keepLast': table.keepLast,
+                            'fieldnames': table.fieldnames, 'length': table.length, 'missing': missing,
+                            'depths': table._depths is not None}
+        arrays['meta'] = np.array(json.dumps({'version': CACHE_VERSION, 'sources': sources, 'tables': tables}))
+        try:
+            handle, path = tempfile.mkstemp(prefix=CACHE_FILE, dir=self.LUT_Dir)
+        except OSError:
+            return
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(path, os.path.join(self.LUT_Dir, CACHE_FILE))
+        except OSError:
+            if os.path.exists(path):
+                os.remove(path)
@@ -0,0 +1,414 @@
+"""
+    Hazus - Flood depth grid sampling
+    ~~~~~
+
+    Samples flood depth grids at building locations without reading the whole
+    raster. Points are grouped by the native block of the raster and only the
+    blocks that contain points are read, through a block cache bounded by a
+    memory ceiling. Longitude/latitude points are transformed to the spatial
+    reference of the grid in one batched call, and the pixel indices of the
+    points can be kept in a SamplingPlan for the other grids of the same
+    geometry, and for later runs.
+
+    :copyright: © 2019 by FEMA's Natural Hazards and Risk Assesment Program.
+    :license: cc, see LICENSE for more details.
+"""
+
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+
+import numpy as np
+from osgeo import gdal, osr
+from osgeo.gdalconst import GA_ReadOnly
+
+# Default ceiling of the block cache of a depth grid, in bytes
+DEFAULT_MAX_MEMORY = 256 * 1024 * 1024
+
+# Ceiling of GDAL's own block cache, in bytes. DepthGrid keeps the blocks it reads, so GDAL only
+# needs to hold the raster blocks of the read in progress
+GDAL_CACHE_MAX = 64 * 1024 * 1024
+
+# Default folder of the saved sampling plans
+DEFAULT_PLAN_DIR = os.path.join(os.path.expanduser('~'), '.hazpy', 'plans')
+
+# Saved sampling plans not used for this many seconds are removed, then the least recently used
+# beyond this many bytes
+DEFAULT_PLAN_AGE = 30 * 24 * 3600
+DEFAULT_PLAN_BYTES = 512 * 1024 * 1024
+
+
+def mortonKeys(row, col):
+    """Z-order (Morton) keys of pixel indices, the bits of row and col interleaved
+
+    Notes: Pixels close on the grid mostly have close keys, so points sorted on their keys are
+        sampled block after block.
+    """
+    keys = np.zeros(len(row), dtype=np.uint64)
+    for values, shift in [(np.asarray(row), 1), (np.asarray(col), 0)]:
+        spread = values.astype(np.uint64) & np.uint64(0xFFFFFFFF)
+        for bits, mask in [(16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF), (4, 0x0F0F0F0F0F0F0F0F),
+                           (2, 0x3333333333333333), (1, 0x5555555555555555)]:
+            spread = (spread | (spread << np.uint64(bits))) & np.uint64(mask)
+        keys |= spread << np.uint64(shift)
+    return keys
+
+
+def setGDALCache(maxMemory):
+    """Caps GDAL's block cache at GDAL_CACHE_MAX, or maxMemory if smaller
+
+    Notes: The blocks of the depth grids are cached by DepthGrid within maxMemory. A GDAL cache
+        as large again would double the memory the grids take.
+    """
+    gdal.SetCacheMax(int(min(maxMemory, GDAL_CACHE_MAX)))
+
+
+class PointCache():
+    """Grid coordinates of inventory chunks, shared by the grids of a run
+
+    Notes: Projected coordinates are kept per chunk key and spatial reference, pixel indices
+        per chunk key, spatial reference and geotransform, so points are only transformed once
+        for all the grids in the same coordinate system. Chunk keys identify a chunk of points,
+        e.g. its position in the inventory. With a plan, grids take the indices of their points
+        from the SamplingPlan.
+    """
+    def __init__(self, plan=None):
+        self.points = {}
+        self.pixels = {}
+        self.plan = plan
+
+    def clear(self):
+        self.points.clear()
+        self.pixels.clear()
+
+
+class SamplingPlan():
+    """The pixel indices of points on the grid geometries they are sampled on, computed once
+
+    Keyword Arguments:
+        folder: str -- optional; plans are saved to this folder and loaded from it by later runs,
+            else only kept in memory
+        maxAge: float -- seconds after which a saved plan that was not used is removed
+        maxBytes: int -- ceiling of the plans in the folder, the least recently used removed first
+
+    Notes: A plan holds the (row, col) pixel indices of the points and the mask of the points on
+        the grid, for a spatial reference, geotransform and size. Every grid of that geometry, such
+        as the depth grids of the return periods of a study case, is sampled with the same plan, so
+        the points are only transformed and compared to the bounds of the grid once. Plans are
+        named by a hash of the geometry and of the coordinates of the points, so a plan is only
+        used for the very same points. The plans of the last points sampled are kept in memory.
+        The folder is pruned to maxAge and maxBytes when the plan is opened.
+
+        plan = SamplingPlan(folder)
+        raw, sampled = grid.sample(lat, lon, PointCache(plan), key)
+    """
+    def __init__(self, folder=None, maxAge=DEFAULT_PLAN_AGE, maxBytes=DEFAULT_PLAN_BYTES):
+        self.folder = folder
+        self.maxAge = maxAge
+        self.maxBytes = maxBytes
+        self.plans = {}
+        self.points = None
+        self.loads = 0
+        self.saves = 0
+        if folder is not None:
+            self._prune()
+
+    def indices(self, grid, lat, lon, cache=None, key=None):
+        """The plan of the points on the geometry of grid (see DepthGrid.indices), computed if there is none"""
+        lat, lon = np.ascontiguousarray(lat, dtype=float), np.ascontiguousarray(lon, dtype=float)
+        points = hashlib.sha1(lat.tobytes())
+        points.update(lon.tobytes())
+        if points.digest() != self.points:
+            # Plans of other points are not used again
+            self.points = points.digest()
+            self.plans.clear()
+        geometry = json.dumps([grid.wkt, list(grid.geoTransform), grid.rows, grid.cols])
+        points.update(geometry.encode('utf-8'))
+        name = points.hexdigest()[:24]
+        if name not in self.plans:
+            self.plans[name] = self._load(name) or grid.onGrid(*grid.pixels(lat, lon, cache, key))
+            self._save(name, self.plans[name])
+        return self.plans[name]
+
+    def _path(self, name):
+        return os.path.join(self.folder, name + '.npz')
+
+    def _prune(self):
+        """Removes the plans not used for maxAge, then the least recently used beyond maxBytes"""
+        try:
+            names = os.listdir(self.folder)
+        except OSError:
+            return
+        plans, partials = [], []
+        for name in names:
+            try:
+                stat = os.stat(os.path.join(self.folder, name))
+            except OSError:
+                continue
+            if name.endswith('.npz'):
+                plans.append((stat.st_mtime, stat.st_size, name))
+            elif name.endswith('.partial'):
+                partials.append((stat.st_mtime, stat.st_size, name))
+        now = time.time()
+        # Partial files may still be written by another process, and are only removed once stale
+        stale = [name for used, size, name in partials if now - used > self.maxAge]
+        total = 0
+        for used, size, name in sorted(plans, reverse=True):
+            total += size
+            if now - used > self.maxAge or total > self.maxBytes:
+                stale.append(name)
+        for name in stale:
+            try:
+                os.remove(os.path.join(self.folder, name))
+            except OSError:
+                # In use by another run
+                pass
+
+    def _load(self, name):
+        if self.folder is None or not os.path.exists(self._path(name)):
+            return None
+        try:
+            with np.load(self._path(name)) as plan:
+                row, col, inside = plan['row'], plan['col'], plan['inside']
+        except (OSError, ValueError, KeyError):
+            return None
+        try:
+            # Marks the plan as used, for _prune
+            os.utime(self._path(name))
+        except OSError:
+            pass
+        self.loads += 1
+        return row.astype(np.int64), col.astype(np.int64), inside
+
+    def _save(self, name, plan):
+        if self.folder is None or os.path.exists(self._path(name)):
+            return
+        os.makedirs(self.folder, exist_ok=True)
+        # Written to a temporary file and renamed, as other processes may load the plan at once
+        partial = self._path(name) + '.' + str(os.getpid()) + '.partial'
+        row, col, inside = plan
+        dtype = np.int32 if max(row.max(initial=0), col.max(initial=0)) < 2**31 else np.int64
+        with open(partial, 'wb') as f:
+            np.savez(f, row=row.astype(dtype), col=col.astype(dtype), inside=inside)
+        os.replace(partial, self._path(name))
+        self.saves += 1
+
+
+class DepthGrid():
+    """A depth grid opened once and sampled block by block
+
+    Keyword Arguments:
+        path: str -- the depth grid
+        maxMemory: int -- ceiling in bytes of the blocks kept in memory between reads
+
+    Notes: Blocks are the native blocks of the first band (tiles, or strips of rows). A block
+        larger than maxMemory is still read, one at a time. Close the grid when done.
+
+        grid = DepthGrid(path)
+        raw, sampled = grid.sample(lat, lon)
+        grid.close()
+
+        Points are transformed from WGS84 longitude/latitude to the spatial reference of the grid.
+        Grids without a spatial reference, and geographic grids, are sampled at the longitude/latitude.
+    """
+    def __init__(self, path, maxMemory=DEFAULT_MAX_MEMORY):
+        self.path = path
+        self.maxMemory = maxMemory
+        if hasattr(path, 'GetRasterBand'):
+            # An open gdal Dataset, left open on close
+            self.dataset = path
+            self.path = path.GetDescription()
+        else:
+            self.dataset = gdal.Open(path, GA_ReadOnly)
+        if self.dataset is None:
+            print('Could not open ' + path)
+            raise IOError('Could not open ' + path)
+        self.band = self.dataset.GetRasterBand(1)
+        blockCols, blockRows = self.band.GetBlockSize()
+        self._describe(self.dataset.GetProjection(), self.dataset.GetGeoTransform(), self.band.GetNoDataValue(),
+                       self.dataset.RasterYSize, self.dataset.RasterXSize, (blockRows, blockCols),
+                       self.band.ReadAsArray(0, 0, 1, 1).dtype)
+
+    def _describe(self, wkt, geoTransform, noData, rows, cols, blockSize, dtype):
+        self.wkt = wkt
+        self.srs = osr.SpatialReference(wkt=self.wkt)
+        self.isUTM = self.srs.GetAttrValue('UNIT') == 'metre'
+        self.transform = self.coordinateTransformation(self.srs) if self.wkt else None
+        self.noData = noData
+        self.geoTransform = geoTransform
+        self.cols = cols
+        self.rows = rows
+        self.blockSize = (max(1, min(blockSize[0], self.rows)), max(1, min(blockSize[1], self.cols)))
+        self.dtype = dtype
+        self.blocks = OrderedDict()
+        self.cachedBytes = 0
+        self.blockReads = 0
+
+    @staticmethod
+    def coordinateTransformation(srs):
+        """Returns the transformation of WGS84 longitude/latitude to srs, None if srs is geographic"""
+        if srs.IsGeographic():
+            # Geographic grids are sampled at the longitude/latitude as given
+            return None
+        wgs84 = osr.SpatialReference()
+        wgs84.ImportFromEPSG(4326)
+        if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+            # GDAL 3: x is longitude/easting regardless of the axis order of the definition
+            wgs84.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+            srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        return osr.CoordinateTransformation(wgs84, srs)
+
+    def close(self):
+        """Releases the dataset and the cached blocks"""
+        self.blocks.clear()
+        self.cachedBytes = 0
+        self.band = None
+        self.dataset = None
+
+    def project(self, lat, lon):
+        """Transforms longitude/latitude (WGS84) points to the coordinates of the grid
+
+        Returns:
+            X: numpy array -- x (easting or longitude) of the points, NaN where a coordinate is missing
+            Y: numpy array -- y (northing or latitude) of the points, NaN where a coordinate is missing
+        """
+        located = ~(np.isnan(lat) | np.isnan(lon))
+        X, Y = np.full(len(lat), np.nan), np.full(len(lat), np.nan)
+        if self.transform is None:
+            X[located], Y[located] = lon[located], lat[located]
+        elif located.any():
+            points = np.array(self.transform.TransformPoints(np.column_stack([lon[located], lat[located]]).tolist()))
+            X[located], Y[located] = points[:, 0], points[:, 1]
+        return X, Y
+
+    def pixels(self, lat, lon, cache=None, key=None):
+        """Returns the (row, col) pixel indices of the points, NaN where a coordinate is missing
+
+        Keyword Arguments:
+            lat: numpy array -- latitudes
+            lon: numpy array -- longitudes
+            cache: PointCache -- optional; reuses the indices of grids with the same spatial reference
+            key: hashable -- identifies the points in the cache
+        """
+        if cache is not None:
+            pixelKey = (key, self.wkt, tuple(self.geoTransform))
+            if pixelKey not in cache.pixels:
+                pointKey = (key, self.wkt)
+                if pointKey not in cache.points:
+                    cache.points[pointKey] = self.project(lat, lon)
+                cache.pixels[pixelKey] = self.toPixels(*cache.points[pointKey])
+            return cache.pixels[pixelKey]
+        return self.toPixels(*self.project(lat, lon))
+
+    def onGrid(self, row, col):
+        """Integer pixel indices, 0 off the grid, and the mask of the pixels on the grid"""
+        inside = (col >= 0) & (col < self.cols) & (row >= 0) & (row < self.rows)
+        return np.where(inside, row, 0).astype(np.int64), np.where(inside, col, 0).astype(np.int64), inside
+
+    def indices(self, lat, lon, cache=None, key=None):
+        """Returns the (row, col) pixel indices of the points and the mask of the points on the grid
+
+        Notes: Indices come from the SamplingPlan of the cache, if it has one.
+        """
+        if cache is not None and cache.plan is not None:
+            return cache.plan.indices(self, lat, lon, cache, key)
+        return self.onGrid(*self.pixels(lat, lon, cache, key))
+
+    def spatialKeys(self, lat, lon):
+        """The mortonKeys of the pixels of the points; points off the grid come last"""
+        row, col, inside = self.onGrid(*self.pixels(lat, lon))
+        return np.where(inside, mortonKeys(row, col), np.iinfo(np.uint64).max)
+
+    def toPixels(self, X, Y):
+        """Returns the (row, col) pixel indices of grid coordinates"""
+        xOrigin, pixelWidth, _, yOrigin, _, pixelHeight = self.geoTransform
+        # int() truncation towards zero, as the row engine
+        col = np.trunc((X - xOrigin) / pixelWidth)
+        row = np.trunc((yOrigin - Y) / -pixelHeight)
+        return row, col
+
+    def block(self, blockRow, blockCol):
+        """Returns a block of the first band, reading it unless it is cached"""
+        key = (blockRow, blockCol)
+        if key in self.blocks:
+            self.blocks.move_to_end(key)
+            return self.blocks[key]
+        rowsPerBlock, colsPerBlock = self.blockSize
+        yoff, xoff = blockRow * rowsPerBlock, blockCol * colsPerBlock
+        data = self.band.ReadAsArray(xoff, yoff, min(colsPerBlock, self.cols - xoff), min(rowsPerBlock, self.rows - yoff))
+        self.blockReads += 1
+        while self.blocks and self.cachedBytes + data.nbytes > self.maxMemory:
+            self.cachedBytes -= self.blocks.popitem(last=False)[1].nbytes
+        self.blocks[key] = data
+        self.cachedBytes += data.nbytes
+        return data
+
+    def read(self, row, col):
+        """Reads the pixels at integer row and col indices that are all on the grid"""
+        values = np.empty(len(row), dtype=self.dtype)
+        if len(row) == 0:
+            return values
+        rowsPerBlock, colsPerBlock = self.blockSize
+        blockRow, blockCol = row // rowsPerBlock, col // colsPerBlock
+        key = blockRow * ((self.cols + colsPerBlock - 1) // colsPerBlock) + blockCol
+        order = np.argsort(key, kind='stable')
+        starts = np.flatnonzero(np.r_[True, key[order][1:] != key[order][:-1]])
+        for start, end in zip(starts, np.r_[starts[1:], len(order)]):
+            points = order[start:end]
+            br, bc = int(blockRow[points[0]]), int(blockCol[points[0]])
+            data = self.block(br, bc)
+            values[points] = data[row[points] - br * rowsPerBlock, col[points] - bc * colsPerBlock]
+        return values
+
+    def sample(self, lat, lon, cache=None, key=None):
+        """Samples the depth grid at every point
+
+        Keyword Arguments:
+            lat: numpy array -- latitudes
+            lon: numpy array -- longitudes
+            cache: PointCache -- optional; reuses the pixel indices of grids with the same spatial reference,
+                or of the SamplingPlan of the cache
+            key: hashable -- identifies the points in the cache
+
+        Returns:
+            raw: numpy array -- pixel values in the raster data type, 0 where not sampled
+            sampled: numpy array -- False where the point is off the grid or on a noData or NaN pixel
+
+        Notes: NaN pixels of float grids are dry, as noData pixels are. The row engine of flood_damage takes
+            them for flood depths and stops at the first building on one.
+        """
+        row, col, inside = self.indices(lat, lon, cache, key)
+        raw = np.zeros(len(lat), dtype=self.dtype)
+        raw[inside] = self.read(row[inside], col[inside])
+        sampled = inside & ~np.isnan(raw.astype(float))
+        if self.noData is not None:
+            sampled &= raw.astype(float) != self.noData
+        raw[~sampled] = 0
+        return raw, sampled
+
+
+class ArrayDepthGrid(DepthGrid):
+    """A depth grid held in memory, sampled like a DepthGrid
+
+    Keyword Arguments:
+        array: numpy array -- the (rows x cols) depths
+        geoTransform: tuple -- the gdal geotransform of the array
+        wkt: str -- the spatial reference of the array, '' for longitude/latitude
+        noData: number -- optional; the value of cells without a depth
+        path: str -- optional; the name recorded in the GridName attribute
+
+    Notes: The array is used as it is, as the single block of the grid.
+    """
+    def __init__(self, array, geoTransform, wkt='', noData=None, path=''):
+        self.array = np.asarray(array)
+        self.path = path
+        self.maxMemory = self.array.nbytes
+        self.dataset = None
+        self.band = None
+        rows, cols = self.array.shape
+        self._describe(wkt, tuple(geoTransform), noData, rows, cols, (rows, cols), self.array.dtype)
+
+    def block(self, blockRow, blockCol):
+        return self.array
@@ -0,0 +1,319 @@
+"""
+    Hazus - Flood building footprints
+    ~~~~~
+
+    Samples flood depth grids over building footprints instead of at a single
+    point, for the maximum, mean or a percentile of the depth under every
+    footprint. The footprints of a chunk of buildings are rasterized together
+    onto the pixel grid by an even-odd scanline fill of all their edges at once,
+    then the pixels are read block by block through the block cache of the
+    DepthGrid and reduced per footprint with array operations. No footprint is
+    masked on its own, so the cost grows with the number of pixels covered.
+
+    :copyright: © 2019 by FEMA's Natural Hazards and Risk Assesment Program.
+    :license: cc, see LICENSE for more details.
+"""
+
+import numpy as np
+import pandas as pd
+from osgeo import ogr, osr
+
+# Statistics of the depth of the pixels of a footprint: 'max', 'mean', 'median' or a percentile
+# such as 'p90'
+ZONAL_STATISTICS = ['max', 'mean', 'median']
+
+
+def _ranges(starts, counts):
+    """Concatenates range(start, start + count) of every start and count"""
+    counts = np.asarray(counts, dtype=np.int64)
+    offsets = np.cumsum(counts) - counts
+    return np.repeat(np.asarray(starts, dtype=np.int64) - offsets, counts) + np.arange(counts.sum(), dtype=np.int64)
+
+
+def wgs84Transform(srs):
+    """The transformation of a spatial reference to WGS84 longitude/latitude, or None without a spatial reference"""
+    if srs is None:
+        return None
+    wgs84 = osr.SpatialReference()
+    wgs84.ImportFromEPSG(4326)
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        wgs84.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return osr.CoordinateTransformation(srs, wgs84)
+
+
+def _rings(geometry):
+    """The (x, y) vertex lists of the rings of a polygon or multipolygon"""
+    if geometry.GetGeometryCount() == 0:
+        points = geometry.GetPoints() or []
+        return [[point[:2] for point in points]] if points else []
+    rings = []
+    for i in range(geometry.GetGeometryCount()):
+        rings += _rings(geometry.GetGeometryRef(i))
+    return rings
+
+
+class Footprints():
+    """Building footprint polygons, keyed by building ID
+
+    Keyword Arguments:
+        ids: list -- the building ID (UserDefinedFltyId) of every footprint
+        x: numpy array -- longitude of the vertices of the rings (WGS84)
+        y: numpy array -- latitude of the vertices of the rings
+        ringStarts: numpy array -- position of the first vertex of every ring, then the number of vertices
+        footprintRings: numpy array -- position of the first ring of every footprint, then the number of rings
+
+    Notes: Holes and the parts of multipolygons are rings of the footprint; a pixel is in the footprint
+        if its center is inside an odd number of its rings. Rings may repeat their first vertex at the
+        end or not. IDs are compared as stripped text; the first footprint of an ID is used.
+
+        footprints = Footprints.read('footprints.gpkg', 'BldgID')
+        positions = footprints.lookup(ids)
+        raw, sampled = zonalDepths(grid, footprints, positions, lat, lon, 'max')
+    """
+    def __init__(self, ids, x, y, ringStarts, footprintRings):
+        self.ids = [str(value).strip() for value in ids]
+        self.x = np.asarray(x, dtype=float)
+        self.y = np.asarray(y, dtype=float)
+        self.ringStarts = np.asarray(ringStarts, dtype=np.int64)
+        self.footprintRings = np.asarray(footprintRings, dtype=np.int64)
+        index = pd.Index(self.ids)
+        first = ~index.duplicated()
+        self.index = index[first]
+        self.positions = np.flatnonzero(first)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @staticmethod
+    def fromGeometries(ids, geometries):
+        """Footprints of ogr Geometries in WGS84 longitude/latitude; None geometries are left out"""
+        keep, x, y, ringStarts, footprintRings = [], [], [], [0], [0]
+        for id, geometry in zip(ids, geometries):
+            if geometry is None:
+                continue
+            rings = _rings(geometry)
+            for ring in rings:
+                x += [point[0] for point in ring]
+                y += [point[1] for point in ring]
+                ringStarts.append(len(x))
+            footprintRings.append(len(ringStarts) - 1)
+            keep.append(id)
+        return Footprints(keep, x, y, ringStarts, footprintRings)
+
+    @staticmethod
+    def fromWKT(ids, wkts):
+        """Footprints of polygons given as WKT in WGS84 longitude/latitude; '' or None is no footprint"""
+        return Footprints.fromGeometries(ids, [ogr.CreateGeometryFromWkt(wkt) if wkt else None for wkt in wkts])
+
+    @staticmethod
+    def read(path, idField, layerName=None):
+        """Reads the footprints of a polygon layer (Shapefile, GeoPackage, ...) readable by ogr
+
+        Keyword Arguments:
+            path: str -- the vector dataset
+            idField: str -- the field holding the building ID
+            layerName: str -- optional; the layer, else the first layer
+
+        Notes: Footprints are transformed to WGS84 longitude/latitude from the spatial reference of the layer.
+        """
+        source = ogr.Open(path)
+        if source is None:
+            raise IOError('Could not open ' + path)
+        layer = source.GetLayer() if layerName is None else source.GetLayerByName(layerName)
+        transform = wgs84Transform(layer.GetSpatialRef())
+        ids, geometries = [], []
+        for feature in layer:
+            geometry = feature.GetGeometryRef()
+            if geometry is not None:
+                geometry = geometry.Clone()
+                if transform is not None:
+                    geometry.Transform(transform)
+            ids.append(feature.GetField(idField))
+            geometries.append(geometry)
+        return Footprints.fromGeometries(ids, geometries)
+
+    def lookup(self, ids):
+        """Returns the position of the footprint of every building ID, -1 for the buildings without one"""
+        keys = [value.strip() if isinstance(value, str) else '' if value is None else str(value) for value in ids]
+        found = self.index.get_indexer(keys)
+        return np.where(found >= 0, self.positions[np.maximum(found, 0)], -1)
+
+    def edges(self, positions):
+        """The edges of the rings of the footprints at positions
+
+        Returns:
+            owner: numpy array -- the index in positions of the footprint of every edge
+            x0, y0, x1, y1: numpy array -- longitude/latitude of the ends of every edge
+        """
+        owners = np.flatnonzero(positions >= 0)
+        footprints = positions[owners]
+        ringCounts = self.footprintRings[footprints + 1] - self.footprintRings[footprints]
+        rings = _ranges(self.footprintRings[footprints], ringCounts)
+        vertexCounts = self.ringStarts[rings + 1] - self.ringStarts[rings]
+        vertices = _ranges(self.ringStarts[rings], vertexCounts)
+        # Every vertex is joined to the next one of its ring, the last one to the first
+        following = vertices + 1
+        following[np.cumsum(vertexCounts)[vertexCounts > 0] - 1] = self.ringStarts[rings][vertexCounts > 0]
+        owner = np.repeat(np.repeat(owners, ringCounts), vertexCounts)
+        return owner, self.x[vertices], self.y[vertices], self.x[following], self.y[following]
+
+
+def rasterize(owner, col0, row0, col1, row1, rows, cols):
+    """The pixels whose centers are inside the rings of every owner (even-odd rule)
+
+    Keyword Arguments:
+        owner: numpy array -- the polygon of every edge
+        col0, row0, col1, row1: numpy array -- the ends of every edge in fractional pixel coordinates
+        rows: int -- rows of the grid; pixels off the grid are left out
+        cols: int -- columns of the grid
+
+    Returns:
+        owner: numpy array -- the polygon of every pixel, in increasing order
+        row: numpy array -- the row of every pixel
+        col: numpy array -- the column of every pixel
+    """
+    # Polygons with a vertex that could not be located are left out
+    bad = np.unique(owner[~np.isfinite(col0 + row0 + col1 + row1)])
+    keep = ~np.isin(owner, bad)
+    owner, col0, row0, col1, row1 = owner[keep], col0[keep], row0[keep], col1[keep], row1[keep]
+    # Scanlines (pixel row centers) crossed by every edge, counting an end on a scanline once
+    first = np.clip(np.ceil(np.minimum(row0, row1) - 0.5), 0, rows).astype(np.int64)
+    last = np.clip(np.ceil(np.maximum(row0, row1) - 0.5), 0, rows).astype(np.int64)
+    counts = np.maximum(last - first, 0)
+    edge = np.repeat(np.arange(len(owner)), counts)
+    row = _ranges(first, counts)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = col0[edge] + (row + 0.5 - row0[edge]) * (col1[edge] - col0[edge]) / (row1[edge] - row0[edge])
+    crossing = owner[edge]
+    # Crossings are grouped by polygon and scanline; most groups are the two sides of a polygon, so
+    # only the crossings of larger groups (concave polygons, holes, multipolygons) are sorted on x
+    scanline = crossing * rows + row
+    order = np.argsort(scanline, kind='stable')
+    scanline, crossing, row, x = scanline[order], crossing[order], row[order], x[order]
+    starts = np.flatnonzero(np.r_[True, scanline[1:] != scanline[:-1]])
+    sizes = np.diff(np.r_[starts, len(scanline)])
+    larger = np.repeat(sizes > 2, sizes)
+    if larger.any():
+        x[larger] = x[larger][np.lexsort((x[larger], scanline[larger]))]
+    # Consecutive crossings of a polygon on a scanline bound the pixels inside it
+    start = np.clip(np.ceil(np.minimum(x[0::2], x[1::2]) - 0.5), 0, cols).astype(np.int64)
+    end = np.clip(np.ceil(np.maximum(x[0::2], x[1::2]) - 0.5), 0, cols).astype(np.int64)
+    counts = np.maximum(end - start, 0)
+    return np.repeat(crossing[0::2], counts), np.repeat(row[0::2], counts), _ranges(start, counts)
+
+
+def _percentile(statistic):
+    """The percentile of a zonal statistic, None for 'max' and 'mean'"""
+    if statistic == 'median':
+        return 50.0
+    if statistic in ZONAL_STATISTICS:
+        return None
+    try:
+        percentile = float(statistic[1:]) if statistic[:1] == 'p' else None
+    except ValueError:
+        percentile = None
+    if percentile is None or not 0 <= percentile <= 100:
+        raise ValueError("Zonal statistic must be 'max', 'mean', 'median' or a percentile such as 'p90': " + str(statistic))
+    return percentile
+
+
+def _sortGroups(values, starts, counts, width=32):
+    """Sorts the values of every group of consecutive values, given by its start and count"""
+    values = values.copy()
+    # Groups of up to width values are sorted together, as the rows of a matrix padded with inf
+    small = (counts > 1) & (counts <= width)
+    if small.any():
+        positions = _ranges(starts[small], counts[small])
+        rows = np.repeat(np.arange(small.sum()), counts[small])
+        cols = _ranges(np.zeros(small.sum()), counts[small])
+        matrix = np.full((small.sum(), counts[small].max()), np.inf)
+        matrix[rows, cols] = values[positions]
+        matrix.sort(axis=1)
+        values[positions] = matrix[rows, cols]
+    large = counts > width
+    if large.any():
+        positions = _ranges(starts[large], counts[large])
+        groups = np.repeat(np.arange(large.sum()), counts[large])
+        values[positions] = values[positions][np.lexsort((values[positions], groups))]
+    return values
+
+
+def reduce(owner, values, n, statistic='max'):
+    """Reduces the pixel values of every owner to a statistic
+
+    Keyword Arguments:
+        owner: numpy array -- owner of every pixel, in increasing order
+        values: numpy array -- value of every pixel
+        n: int -- number of owners
+        statistic: str -- 'max', 'mean', 'median' or a percentile such as 'p90'
+
+    Returns:
+        result: numpy array -- the statistic of every owner, NaN for the owners without pixels
+    """
+    percentile = _percentile(statistic)
+    counts = np.bincount(owner, minlength=n)
+    result = np.full(n, np.nan)
+    present = np.flatnonzero(counts)
+    if len(present) == 0:
+        return result
+    starts = np.cumsum(counts) - counts
+    if statistic == 'max':
+        result[present] = np.maximum.reduceat(values, starts[present])
+    elif statistic == 'mean':
+        result[present] = np.bincount(owner, weights=values, minlength=n)[present] / counts[present]
+    else:
+        # Linear interpolation between the closest ranks, as numpy.percentile
+        values = _sortGroups(values, starts[present], counts[present])
+        position = percentile / 100 * (counts[present] - 1)
+        low = np.floor(position).astype(np.int64)
+        high = np.minimum(low + 1, counts[present] - 1)
+        lower, upper = values[starts[present] + low], values[starts[present] + high]
+        result[present] = lower + (position - low) * (upper - lower)
+    return result
+
+
+def zonalDepths(grid, footprints, positions, lat, lon, statistic='max', cache=None, key=None):
+    """Samples a depth grid over the footprints of the buildings of a chunk
+
+    Keyword Arguments:
+        grid: DepthGrid -- the depth grid
+        footprints: Footprints -- the building footprints
+        positions: numpy array -- the footprint of every building, from Footprints.lookup; -1 for none
+        lat: numpy array -- latitude of every building
+        lon: numpy array -- longitude of every building
+        statistic: str -- 'max', 'mean', 'median' or a percentile such as 'p90' of the pixels of a footprint
+        cache: PointCache -- optional; reuses the pixel indices of the buildings, as DepthGrid.sample
+        key: hashable -- identifies the points in the cache
+
+    Returns:
+        raw: numpy array -- as DepthGrid.sample: the statistic of the footprint, in the raster data type
+            for 'max' and as floats for the others
+        sampled: numpy array -- as DepthGrid.sample: False where no pixel of the footprint has a depth
+
+    Notes: noData pixels of a footprint count as a depth of 0 in the statistic. Buildings without a
+        footprint, and footprints too small to cover a pixel center, are sampled at their point.
+    """
+    _percentile(statistic)
+    raw, sampled = grid.sample(lat, lon, cache, key)
+    owner, x0, y0, x1, y1 = footprints.edges(positions)
+    if len(owner) == 0:
+        return (raw, sampled) if statistic == 'max' else (raw.astype(float), sampled)
+    X, Y = grid.project(np.concatenate([y0, y1]), np.concatenate([x0, x1]))
+    xOrigin, pixelWidth, _, yOrigin, _, pixelHeight = grid.geoTransform
+    col, row = (X - xOrigin) / pixelWidth, (yOrigin - Y) / -pixelHeight
+    owner, row, col = rasterize(owner, col[:len(owner)], row[:len(owner)], col[len(owner):], row[len(owner):], grid.rows, grid.cols)
+    values = grid.read(row, col).astype(float)
+    valid = ~np.isnan(values)
+    if grid.noData is not None:
+        valid &= values != grid.noData
+    values[~valid] = 0
+    n = len(lat)
+    zonal = reduce(owner, values, n, statistic)
+    covered = ~np.isnan(zonal)
+    if statistic != 'max':
+        raw = raw.astype(float)
+    raw[covered] = zonal[covered]
+    sampled[covered] = np.bincount(owner, weights=valid, minlength=n)[covered] > 0
+    raw[~sampled] = 0
+    return raw, sampled
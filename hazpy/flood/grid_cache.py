@@ -0,0 +1,165 @@
+"""
+    Hazus - Flood depth grid cache
+    ~~~~~
+
+    Prepares depth grids for repeated reads. A grid in any format gdal reads,
+    such as an Esri grid (w001001.adf), is converted once to an internally
+    tiled, DEFLATE compressed cloud-optimized GeoTIFF with overviews, and later
+    runs read the copy. Copies are kept in a cache folder (~/.hazpy/grids by
+    default), keyed by the path of the source grid and the modification time and
+    size of its files, so a copy is made again when the source grid changes.
+    Deleting the folder clears the cache.
+
+    :copyright: © 2019 by FEMA's Natural Hazards and Risk Assesment Program.
+    :license: cc, see LICENSE for more details.
+"""
+
+import hashlib
+import os
+
+from osgeo import gdal
+from osgeo.gdalconst import GA_ReadOnly, GA_Update
+
+# Default folder of the prepared grids
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.hazpy', 'grids')
+
+# Tile size of the prepared grids, and the size under which no more overviews are built
+BLOCK_SIZE = 512
+
+
+def sourceFiles(dataset):
+    """The files of a grid: for an Esri grid, every file of its folder"""
+    files = dataset.GetFileList() or [dataset.GetDescription()]
+    return sorted(os.path.abspath(path) for path in files if os.path.isfile(path))
+
+
+def cacheKey(path, files):
+    """Key of the copy of a grid: a hash of its absolute path, and of the modification time and size of its files"""
+    key = hashlib.sha1(os.path.abspath(path).encode('utf-8'))
+    for name in files:
+        stat = os.stat(name)
+        key.update(('\n' + name + '\t' + str(stat.st_mtime_ns) + '\t' + str(stat.st_size)).encode('utf-8'))
+    return key.hexdigest()[:16]
+
+
+def cacheName(path):
+    """Name of the copies of a grid: the folder of an Esri grid, else the file name, then a hash of the path"""
+    folder, name = os.path.split(os.path.abspath(path))
+    if name.lower().endswith('.adf'):
+        name = os.path.basename(folder)
+    return os.path.splitext(name)[0] + '_' + hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()[:8]
+
+
+def isPrepared(dataset):
+    """True for a GeoTIFF that is already tiled (or a single block), compressed and has overviews if it needs any"""
+    band = dataset.GetRasterBand(1)
+    blockCols, blockRows = band.GetBlockSize()
+    rows, cols = dataset.RasterYSize, dataset.RasterXSize
+    return (dataset.GetDriver().ShortName == 'GTiff' and (blockCols < cols or blockRows >= rows)
+            and dataset.GetMetadataItem('COMPRESSION', 'IMAGE_STRUCTURE') is not None
+            and (band.GetOverviewCount() > 0 or not overviewLevels(rows, cols)))
+
+
+def overviewLevels(rows, cols):
+    """Decimation factors of the overviews, halving the grid until it fits in a tile"""
+    levels = []
+    factor = 2
+    while max(rows, cols) / factor >= BLOCK_SIZE // 2:
+        levels.append(factor)
+        factor *= 2
+    return levels
+
+
+def convert(dataset, target):
+    """Writes a grid as a tiled, compressed GeoTIFF with nearest neighbour overviews
+
+    Notes: Uses the COG driver (gdal 3.1 and later), else a tiled GeoTIFF with internal overviews.
+        The pixels, data type, nodata value, geotransform and spatial reference are those of the grid.
+    """
+    options = ['COMPRESS=DEFLATE', 'PREDICTOR=YES', 'BIGTIFF=IF_SAFER', 'NUM_THREADS=ALL_CPUS']
+    if gdal.GetDriverByName('COG') is not None:
+        gdal.Translate(target, dataset, format='COG',
+                       creationOptions=options + ['BLOCKSIZE=' + str(BLOCK_SIZE), 'RESAMPLING=NEAREST'])
+        return
+    gdal.Translate(target, dataset, format='GTiff',
+                   creationOptions=['TILED=YES', 'BLOCKXSIZE=' + str(BLOCK_SIZE), 'BLOCKYSIZE=' + str(BLOCK_SIZE),
+                                    'COMPRESS=DEFLATE', 'BIGTIFF=IF_SAFER', 'NUM_THREADS=ALL_CPUS'])
+    copy = gdal.Open(target, GA_Update)
+    levels = overviewLevels(copy.RasterYSize, copy.RasterXSize)
+    if levels:
+        copy.BuildOverviews('NEAREST', levels)
+    copy = None
+
+
+def prepareGrid(path, cacheDir=None):
+    """The path of the prepared copy of a depth grid, converting the grid the first time
+
+    Keyword Arguments:
+        path: str -- the depth grid, e.g. the w001001.adf of an Esri grid
+        cacheDir: str -- folder of the prepared grids (default: DEFAULT_CACHE_DIR)
+
+    Returns:
+        prepared: str -- the cached GeoTIFF; or path for a grid that already is a tiled, compressed
+            GeoTIFF with overviews
+
+    Notes: The copy is written to a temporary file and renamed, so processes preparing the same grid
+        at once do not read a partial copy. Copies of older versions of the grid are removed.
+    """
+    path = str(path)
+    dataset = gdal.Open(path, GA_ReadOnly)
+    if dataset is None:
+        raise IOError('Could not open ' + path)
+    try:
+        if isPrepared(dataset):
+            return path
+        cacheDir = cacheDir or DEFAULT_CACHE_DIR
+        name = cacheName(path)
+        prepared = os.path.join(cacheDir, name + '_' + cacheKey(path, sourceFiles(dataset)) + '.tif')
+        if os.path.exists(prepared):
+            return prepared
+        os.makedirs(cacheDir, exist_ok=True)
+        partial = prepared + '.' + str(os.getpid()) + '.partial'
+        try:
+            convert(dataset, partial)
+            os.replace(partial, prepared)
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+    finally:
+        dataset = None
+    for other in os.listdir(cacheDir):
+        if other.startswith(name + '_') and other.endswith('.tif') and os.path.join(cacheDir, other) != prepared:
+            try:
+                os.remove(os.path.join(cacheDir, other))
+            except OSError:
+                # Still open in another process
+                pass
+    return prepared
+
+
+def prepareGrids(paths, cacheDir=None):
+    """The prepared copy of every depth grid (see prepareGrid)
+
+    Returns:
+        prepared: dict -- path of every grid to the file it is read from
+    """
+    return dict((path, prepareGrid(path, cacheDir)) for path in paths)
+
+
+def gridPath(path, gridCache=None):
+    """The file a depth grid is read from
+
+    Keyword Arguments:
+        path: str -- the depth grid
+        gridCache: str or bool -- folder of the prepared grids; None or True for DEFAULT_CACHE_DIR, or False
+            to read the grid itself
+
+    Returns:
+        path: str -- the prepared copy of the grid (see prepareGrid), or the grid when gridCache is False
+
+    Notes: The prepared grids are only ever read again by later runs. Deleting the cache folder frees their
+        space; grids that are read again are then converted again.
+    """
+    if gridCache is False:
+        return str(path)
+    return prepareGrid(path, None if gridCache is True else gridCache)
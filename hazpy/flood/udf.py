@@ -23,6 +23,10 @@ import os,csv,sys,time,math,datetime,math,subprocess,numpy as np, utm
 from osgeo import gdal, osr, gdal_array,gdalconst
 from osgeo.gdalconst import *
 
+from . import depth_grid, grid_cache, udf_engine, udf_ensemble, udf_frame, udf_incremental, udf_output, udf_parallel, udf_summary, udf_vector
+from .damage_functions import DamageFunctionLibrary
+from .footprints import Footprints
+
 class UDF():
     def __init__(self):
         pass
@@ -44,13 +48,200 @@ class UDF():
         return objUDF.flood_damage(*argv)
     
     @staticmethod
-    def flood_damage(UDFOrig, LUT_Dir, ResultsDir, DepthGrids, QC_Warning, fmap):
-        # UDFOrig = USer-supplied UDF input file. Full pathname required
+    def flood_damage(UDFOrig, LUT_Dir, ResultsDir, DepthGrids, QC_Warning, fmap, engine='row', chunkSize=udf_engine.DEFAULT_CHUNK_SIZE,
+                     maxMemory=udf_engine.DEFAULT_MAX_MEMORY, wide=False, workers=1, sort=True, format='csv',
+                     pipeline=True, summary=False, returnPeriods=None, aalDetail=False, footprints=None, footprintId=None,
+                     zonalStatistic='max', gridCache=None, checkpoint=False, resume=False, incremental=False,
+                     samplingPlans=None, spatialOrder=False):
+        # UDFOrig = USer-supplied UDF input file. Full pathname required. A csv, or a point or footprint layer read directly
+        #           (columnar engine): a GeoPackage, Shapefile or other layer ogr reads, or a GeoParquet file. Only the fields
+        #           of fmap and census fields are read, and are the inventory fields of the results; a latitude/longitude of
+        #           fmap that is not a field of the layer is taken from the point, or a point on the footprint, in WGS84
         # LUT_Dir = folder name where the Lookup table libraries reside
         # ResultsDir = Where the output file geodatabase will be created. Folder (dir) must exist, else fail
         # DepthGrids = one or more flood depth grids
-        # QC_Warning = Boolean, report on informative inconsistency observations if selected, otherwise suppress them  
-        gdal.SetCacheMax(2**30*5)
+        # QC_Warning = Boolean, report on informative inconsistency observations if selected, otherwise suppress them
+        # engine = 'row' (default) is the original record-by-record implementation. 'columnar' processes the inventory as
+        #          whole-array operations, chunkSize records at a time; the options marked (columnar engine) below require it.
+        #          The columnar engine takes NaN pixels of float grids for noData (no exposure, Depth_Grid 0); the row
+        #          engine stops with an error at the first building on one.
+        # maxMemory = ceiling in bytes of the depth grid blocks held in memory (columnar engine). Only the
+        #             blocks of a grid that contain buildings are read. GDAL's own block cache is capped apart, at
+        #             depth_grid.GDAL_CACHE_MAX or maxMemory if smaller.
+        # wide = write one table, <UDF>_wide.csv, with the columns of every grid suffixed with the grid name
+        #        instead of a results csv (and sorted copy) per grid (columnar engine). User-supplied SOID and DDF ID
+        #        fields keep their inventory values; the DDF IDs used are the BDDF_ID, CDDF_ID and IDDF_ID of every grid
+        # workers = number of processes the inventory chunks and depth grids are shared out to (columnar engine).
+        #           The chunks are read by the workers from memory-mapped files and the results joined in row order.
+        #           On Windows the workers are spawned, importing the calling script: call flood_damage under
+        #           if __name__ == '__main__': in a script. Use no more workers than free cores.
+        # sort = also write <results>_sorted.csv, the results sorted on Depth_in_Struc (columnar engine). The copy is
+        #        built while the results are written, by an external merge sort of bounded memory.
+        # format = 'csv', or 'parquet' or 'arrow' (Arrow IPC) for typed results written one row group per chunk,
+        #          <results>.parquet or <results>.arrow, without a sorted copy (columnar engine). Requires pyarrow.
+        # pipeline = read the inventory, read the depth grids, calculate and write the results in threads of their own,
+        #            connected by bounded queues, so disk and network I/O overlaps the calculation (columnar engine, workers = 1)
+        # summary = also write <UDF>_summary.csv (or .parquet/.arrow), the losses, debris and exposure totals of every grid
+        #           and of its occupancy classes and census tracts/blocks (CensusTract, CensusBlock fields), totalled
+        #           during the run (columnar engine). Off by default, as the totals add to the time of every chunk.
+        #           Blocks that are not 15 digit GEOIDs are totalled by tract and block, as <CensusTract>/<CensusBlock>.
+        # returnPeriods = the return period in years of every depth grid. Writes <UDF>_aal.csv (or .parquet/.arrow), the
+        #                 average annualized loss of every building, instead of the results of every grid; the inventory
+        #                 is read once and the losses at every return period are only kept in memory (columnar engine)
+        # aalDetail = also write the building, content and inventory losses of every return period in the AAL table,
+        #             suffixed rp<return period>
+        # footprints = building footprint polygons (Shapefile, GeoPackage or any layer ogr reads, or a Footprints). The depth
+        #              of a building is then a statistic of the depth grid pixels within its footprint rather than the
+        #              pixel at its latitude/longitude; buildings without a footprint are still sampled at their point (columnar engine)
+        # footprintId = the field of the footprints holding the UserDefinedFltyId of the building, by default the field of
+        #               the same name as the UserDefinedFltyId field of the inventory
+        # zonalStatistic = 'max', 'mean', 'median' or a percentile such as 'p90' of the depth within a footprint
+        # gridCache = a folder, or True for grid_cache.DEFAULT_CACHE_DIR. The depth grids (e.g. Esri w001001.adf grids) are
+        #             converted once to tiled, compressed GeoTIFFs with overviews kept in the folder, and read from the copies
+        #             by this and later runs; a copy is made again when its grid changes (columnar engine)
+        # checkpoint = commit the progress of the run to <UDF>_checkpoint in ResultsDir every few chunks, so an interrupted
+        #              run can be resumed; the folder is removed when the run completes (columnar engine). Parquet and
+        #              Arrow results are then staged in batch files rather than streamed one row group per chunk.
+        # resume = carry on from the last commit of an interrupted run of the same inventory, grids and settings instead of
+        #          starting over; the run is checkpointed. The outputs are the ones of an uninterrupted run.
+        # incremental = keep the results of every record in <UDF>_incremental in ResultsDir and, on later runs, only compute the
+        #               records that are new or changed since the last run, and all of them for a grid that changed. The results
+        #               files are the ones of a full run. Writes csv results per grid, in one process and without checkpoints
+        #               (columnar engine; not with wide, returnPeriods, footprints or other formats)
+        # samplingPlans = a folder, or True for depth_grid.DEFAULT_PLAN_DIR. The pixel indices of the buildings on the geometry
+        #                 (spatial reference, geotransform and size) of a depth grid are saved to the folder as a SamplingPlan and
+        #                 reused by the other grids of that geometry and by later runs of the same inventory (columnar engine).
+        #                 Plans not used for depth_grid.DEFAULT_PLAN_AGE, and the least recently used beyond
+        #                 depth_grid.DEFAULT_PLAN_BYTES, are removed from the folder.
+        # spatialOrder = process the buildings of every few chunks in the order of the Morton key of their pixel on the first depth
+        #                grid, so the grids are read one region after the other rather than in the arbitrary order of the inventory.
+        #                True reorders udf_engine.DEFAULT_SPATIAL_WINDOW chunks at a time, a number that many. The results are
+        #                written in inventory order (columnar engine, workers = 1)
+        fmap = udf_engine.fieldMap(fmap)
+        if engine == 'row':
+            if udf_vector.isVector(UDFOrig):
+                raise ValueError('The row engine reads csv inventories only')
+            options = [('wide', wide, False), ('workers', workers, 1), ('format', format, 'csv'), ('summary', summary, False),
+                       ('returnPeriods', returnPeriods, None), ('footprints', footprints, None), ('gridCache', gridCache, None),
+                       ('checkpoint', checkpoint, False), ('resume', resume, False), ('incremental', incremental, False),
+                       ('samplingPlans', samplingPlans, None), ('spatialOrder', spatialOrder, False)]
+            columnar = [name for name, value, default in options if not (value is default or value == default)]
+            if columnar:
+                raise ValueError(', '.join(columnar) + " require engine='columnar'")
+            return UDF.flood_damage_rows(UDFOrig, LUT_Dir, ResultsDir, DepthGrids, QC_Warning, fmap)
+        depth_grid.setGDALCache(maxMemory)
+        logger = UDF.getLogger()
+        logger.info('\n')
+        logger.info('Calculation FL Building & Content Losses...')
+        counter = 0
+        try:
+            QC_Warning = QC_Warning.lower() == 'true'
+            fields = udf_engine.UDFFields(fmap)
+            library = DamageFunctionLibrary(LUT_Dir)
+            if isinstance(footprints, str):
+                footprints = Footprints.read(footprints, footprintId or fields.UserDefinedFltyId)
+            gridFiles = grid_cache.prepareGrids(DepthGrids, None if gridCache is True else gridCache) if gridCache else None
+            extension = udf_output.OUTPUT_FORMATS[format]
+            UDFRoot = os.path.basename(UDFOrig)
+            ResultsFiles = [os.path.join(ResultsDir, UDFRoot.split('.')[0] + "_" + udf_engine.gridSuffix(dgp)) for dgp in DepthGrids]
+            WideFile = os.path.join(ResultsDir, UDFRoot.split('.')[0] + "_wide") if wide else None
+            AALFile = os.path.join(ResultsDir, UDFRoot.split('.')[0] + "_aal") if returnPeriods is not None else None
+            if AALFile is not None:
+                # Only the AAL table is written
+                WideFile = None
+                wide = False
+            outputs = None if wide or AALFile is not None else [f + extension for f in ResultsFiles]
+            sortedOutputs = [f + '_sorted.csv' for f in ResultsFiles] if sort and outputs and format == 'csv' else None
+            SummaryFile = os.path.join(ResultsDir, UDFRoot.split('.')[0] + "_summary") + extension if summary else None
+            PlanDir = (depth_grid.DEFAULT_PLAN_DIR if samplingPlans is True else samplingPlans) if samplingPlans else None
+            CheckpointDir = os.path.join(ResultsDir, UDFRoot.split('.')[0] + "_checkpoint") if checkpoint or resume else None
+            if incremental:
+                if wide or AALFile is not None or footprints is not None or format != 'csv':
+                    raise ValueError('Incremental runs write csv results per grid, without footprints')
+                # Only the records that changed since the last run are computed
+                allStats = udf_incremental.runGridsIncremental(UDFOrig, DepthGrids, outputs, fields, library,
+                                                               os.path.join(ResultsDir, UDFRoot.split('.')[0] + "_incremental"),
+                                                               QC_Warning, chunkSize, maxMemory, sortedOutputs, summary=summary,
+                                                               gridFiles=gridFiles, planDir=PlanDir)
+            elif workers > 1:
+                # Chunks of the inventory are processed by a pool of processes
+                allStats = udf_parallel.runGridsParallel(UDFOrig, DepthGrids, outputs, fmap, LUT_Dir, QC_Warning, chunkSize, maxMemory,
+                                                         WideFile + extension if wide else None, sortedOutputs, workers, format, summary,
+                                                         AALFile + extension if AALFile else None, returnPeriods, aalDetail,
+                                                         footprints, zonalStatistic, gridFiles, CheckpointDir, resume,
+                                                         planDir=PlanDir)
+            else:
+                # All grids are sampled in a single pass over the inventory
+                allStats = udf_engine.runGrids(UDFOrig, DepthGrids, outputs, fields, library,
+                                               QC_Warning, chunkSize, maxMemory, WideFile + extension if wide else None, sortedOutputs,
+                                               format=format, pipeline=pipeline, summary=summary,
+                                               aalPath=AALFile + extension if AALFile else None, returnPeriods=returnPeriods,
+                                               aalDetail=aalDetail, footprints=footprints, zonalStatistic=zonalStatistic,
+                                               gridFiles=gridFiles, checkpointDir=CheckpointDir, resume=resume, planDir=PlanDir,
+                                               spatialWindow=udf_engine.DEFAULT_SPATIAL_WINDOW if spatialOrder is True else int(spatialOrder))
+            if summary:
+                udf_summary.writeSummary(SummaryFile, [os.path.basename(dgp) for dgp in DepthGrids],
+                                         [stats['summary'] for stats in allStats], format)
+            log = []
+            for dgp, ResultsFile, stats in zip(DepthGrids, ResultsFiles, allStats):
+                if wide:
+                    ResultsFile = WideFile
+                elif AALFile is not None:
+                    ResultsFile = AALFile
+                outputDir = ResultsFile + extension
+                for entry in stats['unmatched']:
+                    logger.info(entry)
+                counter += stats['records']
+                logger.info('Loss calculations complete for the selected grid...')
+                if sortedOutputs:
+                    logger.info('Sorting reults by Depth in structure...')
+                logger.info('Results saved into ' + ResultsFile + extension)
+                if summary:
+                    logger.info('Summary saved into ' + SummaryFile)
+                log.append([counter, 0, stats['flooded'], stats['invalidSOID'], os.path.basename(dgp), ResultsFile + extension])
+            return(True, UDF.summary(log, outputDir))
+        except Exception as e:
+            logger.info(e)
+            print(e)
+            return(False, counter)
+
+    @staticmethod
+    def flood_damage_frame(inventory, LUT_Dir, DepthGrids, fmap, QC_Warning=False, chunkSize=udf_engine.DEFAULT_CHUNK_SIZE,
+                           maxMemory=udf_engine.DEFAULT_MAX_MEMORY, wide=False):
+        # inventory = the UDF inventory as a pandas DataFrame or a pyarrow Table
+        # LUT_Dir = folder name where the Lookup table libraries reside, or a DamageFunctionLibrary already compiled
+        # DepthGrids = depth grids as paths, open gdal Datasets or ArrayDepthGrids (numpy arrays with their
+        #              geotransform), or a dict of grid name to depth grid
+        # fmap = FieldMap, or the field map list or a dict of attribute to field
+        # QC_Warning = Boolean, report on informative inconsistency observations if selected, otherwise suppress them
+        # wide = return one frame with the columns of every grid suffixed with the grid name
+        # Returns a dict of grid name to results DataFrame (the wide DataFrame with wide). Nothing is written to disk.
+        return udf_frame.damageFrame(inventory, DepthGrids, fmap, LUT_Dir, QC_Warning, chunkSize, maxMemory, wide)
+
+    @staticmethod
+    def flood_damage_ensemble(inventory, LUT_Dir, DepthGrid, fmap, realizations=1000, seed=0, depthStd=udf_ensemble.DEPTH_STD,
+                              ffhStd=udf_ensemble.FFH_STD, ddfStd=udf_ensemble.DDF_STD, percentiles=udf_ensemble.DEFAULT_PERCENTILES,
+                              QC_Warning=False, chunkSize=udf_engine.DEFAULT_CHUNK_SIZE, maxMemory=udf_engine.DEFAULT_MAX_MEMORY):
+        # inventory = the UDF inventory csv or vector file (full pathname), or a pandas DataFrame or pyarrow Table
+        # LUT_Dir = folder name where the Lookup table libraries reside, or a DamageFunctionLibrary already compiled
+        # DepthGrid = the flood depth grid, as a path, an open gdal Dataset or an ArrayDepthGrid
+        # fmap = FieldMap, or the field map list or a dict of attribute to field
+        # realizations = number of realizations of every building. The depth (of flooded buildings), the first floor
+        #                height and the damage ratios are drawn from normal distributions around their values, with
+        #                standard deviations depthStd and ffhStd (feet) and ddfStd (a factor of the damage ratios).
+        #                One factor scales the building, content and inventory damage ratios of a realization of a
+        #                building; the ordinates of the damage functions are not drawn one by one.
+        # seed = seed of the random draws; the same seed gives the same results, whatever the chunkSize
+        # percentiles = the percentiles of the losses reported with their mean
+        # chunkSize = number of (building, realization) pairs computed at once, which bounds memory
+        # Returns (buildings, aggregate) DataFrames: the mean and percentiles of the building, content, inventory and
+        # total losses of every building, and of their sums for the inventory and its occupancy classes and census
+        # tracts/blocks. Nothing is written to disk.
+        return udf_ensemble.ensembleLosses(inventory, DepthGrid, fmap, LUT_Dir, realizations, seed, depthStd, ffhStd, ddfStd,
+                                           percentiles, QC_Warning, chunkSize, maxMemory)
+
+    @staticmethod
+    def getLogger():
         logger = logging.getLogger('FAST')
         logger.setLevel(logging.INFO)
         cdir = os.getcwd()
@@ -65,6 +256,28 @@ class UDF():
         formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
         handler.setFormatter(formatter)
         logger.addHandler(handler)
+        return logger
+
+    @staticmethod
+    def summary(log, outputDir):
+        # The result message: one paragraph per depth grid
+        message = ''
+        for grid in log:#CBH
+            message += 'For depth-grid: ' + str(grid[4]) + '\n' + str(grid[0])+' records processed of ' + str(grid[0]) + ' records total.\n' + \
+            'Total records with flooding: ' + str(grid[2]) + '\n' + \
+            'Total number of records with unmatched Specific Occupancy IDs found: ' + \
+            str(grid[3]) +'\n File saved to: ' + os.path.realpath(os.path.join(os.path.dirname(outputDir),str(grid[5]))) + '\n\n' #UKS - modified for complete file name #CBH - change added 8/28/19
+        return message
+
+    @staticmethod
+    def flood_damage_rows(UDFOrig, LUT_Dir, ResultsDir, DepthGrids, QC_Warning, fmap):
+        # UDFOrig = USer-supplied UDF input file. Full pathname required
+        # LUT_Dir = folder name where the Lookup table libraries reside
+        # ResultsDir = Where the output file geodatabase will be created. Folder (dir) must exist, else fail
+        # DepthGrids = one or more flood depth grids
+        # QC_Warning = Boolean, report on informative inconsistency observations if selected, otherwise suppress them  
+        gdal.SetCacheMax(2**30*5)
+        logger = UDF.getLogger()
 
         log = []#CBH
         logger.info('\n')
@@ -974,14 +1187,7 @@ class UDF():
                     log.append([counter,counter2,recCountNonZeroDepth,invalidSOID,os.path.basename(dgp),ResultsFile + '.csv'])            
 
                     #recCountNonZeroDepth counter logged, concatenated to the message and reset
-                message = ''   
-                for grid in log:#CBH
-                    message += 'For depth-grid: ' + str(grid[4]) + '\n' + str(grid[0])+' records processed of ' + str(grid[0]) + ' records total.\n' + \
-                    'Total records with flooding: ' + str(grid[2]) + '\n' + \
-                    'Total number of records with unmatched Specific Occupancy IDs found: ' + \
-                    str(grid[3]) +'\n File saved to: ' + os.path.realpath(os.path.join(os.path.dirname(outputDir),str(grid[5]))) + '\n\n' #UKS - modified for complete file name #CBH - change added 8/28/19
-                            
-                    recCountNonZeroDepth = 0    
+                message = UDF.summary(log, outputDir)
 
                 #return(True, [counter,counter2,recCountNonZeroDepth,invalidSOID]) #UKS Commented
                 return(True, message)#CBH added
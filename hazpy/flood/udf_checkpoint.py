@@ -0,0 +1,240 @@
+"""
+    Hazus - Flood UDF checkpoints
+    ~~~~~
+
+    Commits the progress of a long UDF run so a run that stops partway, such as
+    on a network share error, can be resumed instead of started over. Results
+    are committed every few chunks: the csv outputs are flushed to disk and
+    their sizes recorded, the sorted copies spill their records to run files,
+    typed (Parquet/Arrow) results are kept as one batch file per chunk until the
+    run completes, and the counts and summary totals are saved. A small json
+    manifest in the checkpoint folder records the committed row range of every
+    grid. A resumed run truncates its outputs to the last commit and carries on
+    from the next chunk, so its outputs are the ones of an uninterrupted run.
+
+    :copyright: © 2019 by FEMA's Natural Hazards and Risk Assesment Program.
+    :license: cc, see LICENSE for more details.
+"""
+
+import json
+import logging
+import os
+import pickle
+import shutil
+
+from . import udf_output
+
+# Manifest of a checkpoint folder
+MANIFEST = 'checkpoint.json'
+
+# Records written between commits, at least; commits are made at chunk boundaries
+DEFAULT_CHECKPOINT_RECORDS = udf_output.DEFAULT_RUN_RECORDS
+
+
+def fileIdentity(path):
+    """The absolute path, size and modification time of a file, or only the path if it does not exist"""
+    path = os.path.abspath(str(path))
+    if not os.path.exists(path):
+        return [path]
+    stat = os.stat(path)
+    return [path, stat.st_size, stat.st_mtime_ns]
+
+
+def runIdentity(engine, inventory, depthGrids, outputs, **settings):
+    """What a run is made of, as the identity of its Checkpoint
+
+    Keyword Arguments:
+        engine: str -- the runner, as the checkpoints of the runners hold different files
+        inventory: str -- the UDF inventory csv
+        depthGrids: list -- the depth grids
+        outputs: list -- the paths of the outputs; None entries are left out
+        settings: -- json values of the settings the outputs depend on, e.g. the field map and chunk size
+    """
+    return dict(settings, engine=engine, inventory=fileIdentity(inventory),
+                grids=[fileIdentity(dgp) for dgp in depthGrids],
+                outputs=[os.path.abspath(path) for path in outputs if path is not None])
+
+
+def _sync(f):
+    """Flushes a csv output to disk and returns its size in bytes"""
+    f.flush()
+    os.fsync(f.fileno())
+    return os.fstat(f.fileno()).st_size
+
+
+class BatchFiles():
+    """Typed results of a checkpointed run, kept as one Arrow IPC file per chunk until the run completes
+
+    Keyword Arguments:
+        folder: str -- the checkpoint folder
+        name: str -- prefix of the batch files
+        path: str -- the results file, written on close
+        format: str -- 'parquet' or 'arrow'
+        header: list -- the results header
+        batches: int -- batches already committed, when resumed
+
+    Notes: Written like udf_output.ArrowResults. On close the batches are written to the results
+        file by an ArrowResults, one row group each, as an uninterrupted run writes them.
+    """
+    def __init__(self, folder, name, path, format, header, batches=0):
+        self.folder = folder
+        self.name = name
+        self.path = path
+        self.format = format
+        self.header = header
+        self.batches = batches
+        self.closed = False
+
+    def _batchPath(self, index):
+        return os.path.join(self.folder, self.name + '.' + str(index) + '.arrows')
+
+    def write(self, batch):
+        udf_output.saveBatch(self._batchPath(self.batches), batch)
+        self.batches += 1
+
+    def discard(self):
+        """Stops without writing the results file; the batch files stay for a resumed run"""
+        self.closed = True
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        results = udf_output.ArrowResults(self.path, self.format, self.header)
+        try:
+            for index in range(self.batches):
+                results.write(udf_output.loadBatch(self._batchPath(index)))
+        finally:
+            results.close()
+
+
+class Checkpoint():
+    """The committed progress of a run, kept in a folder
+
+    Keyword Arguments:
+        folder: str -- the checkpoint folder, created if need be; an existing folder must be empty or a
+            checkpoint folder, as it is cleared to start over
+        identity: dict -- what the run is made of (inventory, grids, outputs and settings), as json values;
+            a checkpoint of another run is not resumed
+        resume: bool -- pick up the last commit of the checkpoint in folder; else, or if there is none
+            or it is of another run, start over
+
+    Notes: The manifest records the commit count, the chunks and records committed, the committed
+        size of every csv output and the row range of every grid. Everything else the run needs to
+        carry on (counts, summary totals, sorted runs) is pickled in a state file of the commit.
+
+        checkpoint = Checkpoint(folder, identity, resume)
+        f = checkpoint.open(path)
+        ... write chunks, then every few chunks:
+        checkpoint.commit(chunks, records, {path: f}, state)
+        checkpoint.close()
+    """
+    def __init__(self, folder, identity, resume=False):
+        self.folder = folder
+        self.identity = json.loads(json.dumps(identity))
+        self.manifest = self._load() if resume else None
+        self.resumed = self.manifest is not None and self.manifest['commit'] > 0
+        if self.manifest is None:
+            if resume:
+                logging.getLogger('FAST').info('No checkpoint of this run in ' + folder + ', starting over')
+            if os.path.isdir(folder) and os.listdir(folder):
+                if not os.path.exists(os.path.join(folder, MANIFEST)):
+                    raise ValueError('Not a checkpoint folder: ' + folder)
+                shutil.rmtree(folder)
+            os.makedirs(folder, exist_ok=True)
+            self.manifest = {'identity': self.identity, 'commit': 0, 'chunks': 0, 'records': 0, 'files': {}, 'grids': []}
+            self._writeManifest(self.manifest)
+
+    def _load(self):
+        try:
+            with open(os.path.join(self.folder, MANIFEST)) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return manifest if manifest.get('identity') == self.identity else None
+
+    @property
+    def chunks(self):
+        """Inventory chunks committed"""
+        return self.manifest['chunks']
+
+    @property
+    def records(self):
+        """Inventory records committed"""
+        return self.manifest['records']
+
+    def _statePath(self, commit):
+        return os.path.join(self.folder, 'state' + str(commit) + '.pkl')
+
+    def state(self):
+        """The state saved with the last commit, or None"""
+        if not self.manifest['commit']:
+            return None
+        with open(self._statePath(self.manifest['commit']), 'rb') as f:
+            return pickle.load(f)
+
+    def open(self, path):
+        """Opens a csv output for writing: a resumed one truncated to its committed size, for appending"""
+        size = self.manifest['files'].get(os.path.abspath(path))
+        if size is None:
+            return open(path, 'w')
+        os.truncate(path, size)
+        return open(path, 'a')
+
+    def folderFor(self, name):
+        """A folder of the checkpoint, e.g. for the run files of a sorted copy"""
+        folder = os.path.join(self.folder, name)
+        os.makedirs(folder, exist_ok=True)
+        return folder
+
+    def commit(self, chunks, records, files, state, gridRows=()):
+        """Records the progress of the run once its outputs are on disk
+
+        Keyword Arguments:
+            chunks: int -- inventory chunks written
+            records: int -- inventory records written
+            files: dict -- path of every open csv output to its file
+            state: object -- pickled, returned by state() when resumed
+            gridRows: list -- (grid name, records) of the rows of every grid committed, shown in the manifest
+        """
+        sizes = dict((os.path.abspath(path), _sync(f)) for path, f in files.items())
+        commit = self.manifest['commit'] + 1
+        with open(self._statePath(commit), 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        manifest = dict(self.manifest, commit=commit, chunks=chunks, records=records, files=sizes,
+                        grids=[{'grid': name, 'rows': [0, rows]} for name, rows in gridRows])
+        self._writeManifest(manifest)
+        if self.manifest['commit']:
+            os.remove(self._statePath(self.manifest['commit']))
+        self.manifest = manifest
+
+    def _writeManifest(self, manifest):
+        """Replaces the manifest at once, so an interrupted commit leaves the previous one"""
+        partial = os.path.join(self.folder, MANIFEST + '.partial')
+        with open(partial, 'w') as f:
+            json.dump(manifest, f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(partial, os.path.join(self.folder, MANIFEST))
+
+    def close(self):
+        """Removes the checkpoint of a completed run"""
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+
+def sortedState(sortedFiles):
+    """Spills the records of the sorted copies to run files and returns their runs, for a commit"""
+    state = []
+    for sortedFile in sortedFiles:
+        sortedFile.spill()
+        state.append((list(sortedFile.runs), sortedFile.runFiles))
+    return state
+
+
+def restoreSorted(sortedFiles, state):
+    """Gives the sorted copies of a resumed run the runs of the commit"""
+    for sortedFile, (runs, runFiles) in zip(sortedFiles, state):
+        sortedFile.runs = list(runs)
+        sortedFile.runFiles = runFiles
@@ -0,0 +1,1563 @@
+"""
+    Hazus - Flood UDF columnar engine
+    ~~~~~
+
+    Vectorized implementation of the FAST flood UDF loss calculation used by
+    UDF.flood_damage. The inventory is read in chunks of rows and the Specific
+    Occupancy ID, depth in structure, building/content/inventory damage, debris
+    and restoration days are computed as whole-array operations. Results are
+    written with the same columns and values as the row-by-row engine.
+
+    :copyright: © 2019 by FEMA's Natural Hazards and Risk Assesment Program.
+    :license: cc, see LICENSE for more details.
+"""
+
+import codecs
+import csv
+import io
+import itertools
+import logging
+import os
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+
+from . import udf_checkpoint, udf_output, udf_pipeline, udf_summary, udf_vector
+from .damage_functions import DEPTH_MAX, DEPTH_MIN
+from .depth_grid import DEFAULT_MAX_MEMORY, DepthGrid, PointCache, SamplingPlan
+from .footprints import zonalDepths
+
+# Default content cost multipliers of the Hazus-MH Flood Technical Manual. Other classes use 0
+CONTENT_MULTIPLIERS = dict(
+    [(oc, 0.5) for oc in ['RES1', 'RES2', 'RES3A', 'RES3B', 'RES3C', 'RES3D', 'RES3E', 'RES3F', 'RES4', 'RES5', 'RES6', 'COM10']] +
+    [(oc, 1.0) for oc in ['COM1', 'COM2', 'COM3', 'COM4', 'COM5', 'COM8', 'COM9', 'IND6', 'AGR1', 'REL1', 'GOV1', 'EDU1']] +
+    [(oc, 1.5) for oc in ['COM6', 'COM7', 'IND1', 'IND2', 'IND3', 'IND4', 'IND5', 'GOV2', 'EDU2']]
+)
+
+# Default inventory DDF only defined for a subset of occupancy classes
+INVENTORY_OCCUPANCIES = ['COM1', 'COM2', 'IND1', 'IND2', 'IND3', 'IND4', 'IND5', 'IND6', 'AGR1']
+
+# Output attributes, in the order they are appended to the inventory fields
+NEW_FIELDS = ['Depth_Grid', 'Depth_in_Struc', 'flExp', 'SOID', 'BDDF_ID', 'BldgDmgPct', 'BldgLossUSD',
+              'ContentCostUSD', 'CDDF_ID', 'ContDmgPct', 'ContentLossUSD', 'InventoryCostUSD', 'IDDF_ID',
+              'InvDmgPct', 'InventoryLossUSD', 'DebrisID', 'Debris_Fin', 'Debris_Struc', 'Debris_Found',
+              'Debris_Tot', 'Restor_Days_Min', 'Restor_Days_Max', 'GridName']
+
+# Row status codes
+STATUS_SKIPPED = 0      # a required field is empty; the record is passed through untouched
+STATUS_UNMATCHED = 1    # no default building DDF for the Specific Occupancy ID
+STATUS_PROCESSED = 2
+
+# Output attributes assigned to records that are not fully processed
+SKIPPED_FIELDS = ['Depth_in_Struc']
+UNMATCHED_FIELDS = ['Depth_Grid', 'Depth_in_Struc', 'flExp', 'SOID', 'ContentCostUSD', 'InventoryCostUSD', 'BDDF_ID']
+
+# Output attributes that do not depend on the depth grid. The wide table has them once, the
+# others once per grid with the grid name as suffix
+SHARED_FIELDS = ['SOID', 'ContentCostUSD', 'InventoryCostUSD']
+GRID_FIELDS = [name for name in NEW_FIELDS if name not in SHARED_FIELDS and name != 'GridName']
+
+DEFAULT_CHUNK_SIZE = 100000
+
+# Inventory chunks reordered together by spatialChunks
+DEFAULT_SPATIAL_WINDOW = 8
+
+# Columns of the average annualized loss table: the AAL of every building, and optionally its
+# losses at every return period
+AAL_FIELDS = ['BldgAALUSD', 'ContentAALUSD', 'InventoryAALUSD', 'TotalAALUSD']
+RETURN_PERIOD_FIELDS = ['BldgLossUSD', 'ContentLossUSD', 'InventoryLossUSD']
+
+# Attributes that determine the building archetype: with the depth, they determine the damage
+# ratios, debris rates and restoration days (the Specific Occupancy ID derives from them)
+ARCHETYPE_FIELDS = ['OC', 'foundationType', 'numStories', 'bddf', 'cddf', 'iddf']
+
+
+class FieldMap(NamedTuple):
+    """The FAST field map: the inventory field of every attribute
+
+    Notes: UserDefinedFltyId, OccupancyClass, Cost, Area, NumStories, FoundationType, FirstFloorHt,
+        latitude and longitude are required. The others are optional, '' when not used; flC is the
+        coastal zone code ('CAE', 'V' or 'VE') rather than a field. A FieldMap is a tuple in the
+        order of the list field maps, so it can be passed wherever a list is.
+
+        fmap = FieldMap(UserDefinedFltyId='BldgID', OccupancyClass='Occ', Cost='Cost', Area='Area',
+                        NumStories='NumStories', FoundationType='FoundationType', FirstFloorHt='FFH',
+                        latitude='Lat', longitude='Lon')
+    """
+    UserDefinedFltyId: str = ''
+    OccupancyClass: str = ''
+    Cost: str = ''
+    Area: str = ''
+    NumStories: str = ''
+    FoundationType: str = ''
+    FirstFloorHt: str = ''
+    ContentCost: str = ''
+    BldgDamageFnID: str = ''
+    ContDamageFnId: str = ''
+    InvDamageFnId: str = ''
+    InvCost: str = ''
+    SOI: str = ''
+    latitude: str = ''
+    longitude: str = ''
+    flC: str = ''
+
+
+def fieldMap(fmap):
+    """Returns a FieldMap of a field map given as a FieldMap, a list or a dict of attribute to field"""
+    if isinstance(fmap, FieldMap):
+        return fmap
+    if isinstance(fmap, dict):
+        return FieldMap(**fmap)
+    return FieldMap(*fmap)
+
+
+class UDFFields():
+    """Names of the inventory and output attributes of a FAST field map
+
+    Keyword Arguments:
+        fmap: FieldMap -- the FAST field map, or a list (UserDefinedFltyId, OccupancyClass, Cost, Area,
+            NumStories, FoundationType, FirstFloorHt, ContentCost, BldgDamageFnID, ContDmgFnId,
+            InvDamageFnId, InvCost, SOI, latitude, longitude, flC) or a dict. Optional fields are ''.
+    """
+    def __init__(self, fmap):
+        self.fmap = fmap = fieldMap(fmap)
+        (self.UserDefinedFltyId, self.OccupancyClass, self.Cost, self.Area, self.NumStories,
+         self.FoundationType, self.FirstFloorHt, self.ContentCost, self.BldgDamageFnID,
+         self.ContDamageFnId, self.InvDamageFnId, self.InvCost, self.SOI, self.latitude,
+         self.longitude, self.flC) = fmap
+        self.required = [self.UserDefinedFltyId, self.OccupancyClass, self.Cost, self.Area, self.NumStories,
+                         self.FoundationType, self.FirstFloorHt, self.latitude, self.longitude]
+        # The inventory fields of the field map; flC is a code rather than a field
+        self.columns = [name for name in fmap[:-1] if name]
+        # User-supplied SOID and DDF ID fields are overwritten with the values used
+        self.output = dict((name, name) for name in NEW_FIELDS)
+        self.output['SOID'] = self.SOI or 'SOID'
+        self.output['BDDF_ID'] = self.BldgDamageFnID or 'BDDF_ID'
+        self.output['CDDF_ID'] = self.ContDamageFnId or 'CDDF_ID'
+        self.output['IDDF_ID'] = self.InvDamageFnId or 'IDDF_ID'
+
+    def header(self, fieldnames):
+        """Returns the results header for an inventory with the given fieldnames"""
+        return list(fieldnames) + [self.output[name] for name in NEW_FIELDS]
+
+    def wideHeader(self, fieldnames, suffixes):
+        """Returns the header of the wide table of several grids, suffixes naming the grids"""
+        shared = [self.output[name] for name in SHARED_FIELDS if self.output[name] not in fieldnames]
+        return list(fieldnames) + shared + [name + '_' + suffix for suffix in suffixes for name in GRID_FIELDS]
+
+    def aalHeader(self, fieldnames, suffixes, detail=False):
+        """Returns the header of the AAL table, with detail the losses of the return periods named by suffixes"""
+        detailFields = [name + '_' + suffix for suffix in suffixes for name in RETURN_PERIOD_FIELDS] if detail else []
+        return self.wideHeader(fieldnames, []) + AAL_FIELDS + detailFields
+
+
+class UDFResult():
+    """Results of one inventory chunk against one depth grid
+
+    Keyword Arguments:
+        status: numpy array -- STATUS_* code of every record
+        columns: dict -- output attribute (NEW_FIELDS name) to numpy array
+        integral: dict -- output attribute to boolean mask of the cells written as integers
+
+    Notes: Float columns use NaN for empty cells. Columns in the raster data type (Depth_Grid)
+        are written the way numpy formats its scalars.
+    """
+    def __init__(self, status, columns, integral):
+        self.status = status
+        self.columns = columns
+        self.integral = integral
+
+    def __len__(self):
+        return len(self.status)
+
+
+def readInventory(path, chunkSize=DEFAULT_CHUNK_SIZE, fields=None):
+    """Reads a UDF inventory csv in chunks of records
+
+    Keyword Arguments:
+        path: str -- the UDF inventory csv, or a GeoPackage, Shapefile, GeoParquet or other vector
+            inventory (see udf_vector.isVector)
+        chunkSize: int -- number of records per chunk
+        fields: UDFFields -- of the run; only the fields of its field map are read from a vector
+            inventory, and latitude/longitude are taken from the geometry if the layer has no such fields
+
+    Returns:
+        fieldnames: list -- the inventory header
+        chunks: generator -- (records x fields) object arrays of the cell text. Cells missing from
+            short records are None, like csv.DictReader.
+
+    Notes: A csv is read with pyarrow when it is installed, and with the csv module from the first
+        record of another width than the header on (or throughout). Blank lines are skipped, so every
+        chunk but the last has chunkSize records.
+    """
+    if udf_vector.isVector(path):
+        if fields is None:
+            return udf_vector.readVector(path, chunkSize)
+        return udf_vector.readVector(path, chunkSize, fields.columns, fields.latitude, fields.longitude)
+    f = open(path, newline='')
+    reader = csv.reader(f)
+    fieldnames = next(reader)
+
+    def chunks():
+        with f:
+            width = len(fieldnames)
+            records = 0
+            try:
+                if fieldnames and fieldnames[0].startswith('\ufeff"'):
+                    # A quote after a byte order mark is text to the csv module, not to pyarrow
+                    raise ValueError('Not read by pyarrow')
+                for cells in _arrowChunks(path, f.encoding, width, chunkSize):
+                    records += len(cells)
+                    yield cells
+                return
+            except ValueError:
+                # A record of another width: the csv module reads on from the first record not yielded
+                f.seek(0)
+                reader = csv.reader(f)
+                next(reader)
+            # Blank lines are no records
+            rest = itertools.islice(filter(None, reader), records, None)
+            while True:
+                rows = [row for row in itertools.islice(rest, chunkSize)]
+                if len(rows) == 0:
+                    return
+                rows = [row if len(row) == width else row + [None] * (width - len(row)) for row in rows]
+                for row in rows:
+                    records += 1
+                    if len(row) > width:
+                        raise ValueError('Inventory record ' + str(records) + ' has ' + str(len(row)) + ' fields, the header ' + str(width))
+                cells = np.empty((len(rows), width), dtype=object)
+                cells[:] = rows
+                yield cells
+    return fieldnames, chunks()
+
+
+def _arrowChunks(path, encoding, width, chunkSize):
+    """Reads the records of an inventory csv with pyarrow, in chunks of chunkSize records as readInventory
+
+    Notes: Cells are parsed as the csv module does, and blank lines skipped. A record of another width than
+        the header raises a ValueError (pyarrow.ArrowInvalid) once the chunks before it are yielded; so does
+        an inventory of a single field, and any inventory when pyarrow is not installed.
+    """
+    arrow = _pyarrow()
+    if arrow is None or width < 2:
+        raise ValueError('Not read by pyarrow')
+    pa = arrow[0]
+    import pyarrow.csv as pacsv
+    names = ['f' + str(i) for i in range(width)]
+    # The header is read as a record too, and dropped
+    reader = pacsv.open_csv(path, read_options=pacsv.ReadOptions(column_names=names, encoding=codecs.lookup(encoding).name),
+                            parse_options=pacsv.ParseOptions(newlines_in_values=True),
+                            convert_options=pacsv.ConvertOptions(column_types=dict.fromkeys(names, pa.string()),
+                                                                 strings_can_be_null=False, quoted_strings_can_be_null=False))
+
+    def parts():
+        header = True
+        for batch in reader:
+            cells = np.empty((batch.num_rows, width), dtype=object)
+            for i in range(width):
+                cells[:, i] = batch.column(i).to_numpy(zero_copy_only=False)
+            if header and len(cells):
+                cells = cells[1:]
+                header = False
+            yield cells
+    return udf_vector.rechunk(parts(), chunkSize)
+
+
+def _getValue(cell):
+    """The row engine's getValue: stripped text, 0 if blank, a float if it converts"""
+    val = cell.strip() if cell.strip() != '' else 0
+    try:
+        val = float(val)
+    except:
+        pass
+    return val
+
+
+def _uidText(cell):
+    """The UserDefinedFltyId of a record as the log shows it, str(getValue(cell))"""
+    return str(_getValue(cell))
+
+
+def _objects(values):
+    """A one dimensional object array of the values"""
+    out = np.empty(len(values), dtype=object)
+    out[:] = values
+    return out
+
+
+def _convert(cells, convert, name, uids):
+    """Applies convert(getValue(cell)) to every cell, once per unique cell text
+
+    Notes: A missing cell (a record shorter than the header) raises a ValueError naming the record,
+        by the UserDefinedFltyId in uids, and the field name.
+    """
+    codes, uniques = pd.factorize(np.asarray(cells, dtype=object))
+    if (codes < 0).any():
+        raise ValueError('Record ' + str(uids[np.flatnonzero(codes < 0)[0]]).strip() + ': no ' + name + ' value')
+    return _objects([convert(_getValue(cell)) for cell in uniques])[codes]
+
+
+def _numbers(cells, truncate, name, uids):
+    """Converts cells to floats as float(getValue(cell)) does, truncated toward zero if requested"""
+    try:
+        # float() strips whitespace itself; blank, missing and text cells take the slow path
+        values = np.array(list(map(float, np.asarray(cells, dtype=object).tolist())), dtype=float)
+    except (TypeError, ValueError):
+        values = None
+    if values is None or (truncate and not np.isfinite(values).all()):
+        convert = (lambda v: float(int(v))) if truncate else float
+        return _convert(cells, convert, name, uids).astype(float)
+    if truncate:
+        values = np.trunc(values) + 0.0
+    return values
+
+
+def _specificOccupancyId(OC, foundationType, numStories):
+    """Builds the Specific Occupancy ID from OccupancyClass, FoundationType and NumStories"""
+    # Prefix: Note that REL1 is the exception in the OccupancyClass list.
+    sopre = OC[:1] + OC[-(len(OC) - 3):] if OC != 'REL1' else 'RE1'
+    # Suffix: Basement or no Basement
+    sosuf = 'B' if foundationType == 4 else 'N'
+    # Middle Character: Number of Stories
+    if OC[:4] == 'RES3':
+        somid = '5' if numStories > 4 else '3' if numStories > 2 else '1'
+    elif OC[:4] == 'RES1':
+        # If NumStories is not an integer, assume Split Level residence. Cap it at 3.
+        numStories = 3 if numStories > 3.0 else numStories
+        somid = str(round(numStories)) if numStories - round(numStories) == 0 else 'S'
+    elif OC[:4] == 'RES2':
+        somid = '1'
+    else:
+        somid = 'H' if numStories > 6 else 'M' if numStories > 3 else 'L'
+    return sopre + somid + sosuf
+
+
+def _ddfKey(value):
+    """User-supplied DDF ID as (lookup key, id), or (None, None) if it is not a number"""
+    try:
+        return str(int(value)), int(value)
+    except (TypeError, ValueError, OverflowError):
+        return None, None
+
+
+def prepareInventory(cells, fieldnames, fields, library):
+    """Computes the grid-independent attributes of an inventory chunk
+
+    Keyword Arguments:
+        cells: numpy array -- (records x fields) cell text from readInventory
+        fieldnames: list -- the inventory header
+        fields: UDFFields -- the field map
+        library: DamageFunctionLibrary -- the compiled lookup tables
+
+    Returns:
+        attributes: dict -- attribute name to numpy array, one value per record. Values are
+            NaN/None for records missing a required field (valid == False).
+    """
+    index = dict((name, i) for i, name in enumerate(fieldnames))
+    column = lambda name: cells[:, index[name]]
+    n = len(cells)
+    valid = np.ones(n, dtype=bool)
+    for name in fields.required:
+        values = column(name)
+        valid &= (values != None) & (values != '')
+    rows = np.flatnonzero(valid)
+    uid = column(fields.UserDefinedFltyId)[rows]
+    attr = lambda name, convert: _convert(column(name)[rows], convert, name, uid)
+    num = lambda name, truncate=False: _numbers(column(name)[rows], truncate, name, uid)
+
+    OC = attr(fields.OccupancyClass, lambda v: v)
+    foundationType = num(fields.FoundationType)
+    numStories = num(fields.NumStories)
+    area = num(fields.Area)
+    cost = num(fields.Cost, True)
+    ffh = num(fields.FirstFloorHt)
+    lat = num(fields.latitude)
+    lon = num(fields.longitude)
+
+    # Specific Occupancy ID, once per unique OccupancyClass/FoundationType/NumStories
+    codes, first = _archetypes([OC, foundationType, numStories])
+    soid = _objects([_specificOccupancyId(OC[i], float(foundationType[i]), float(numStories[i])) for i in first])[codes]
+
+    # Content Cost: user-supplied value, else the default multiplier of the Cost
+    codes, uniques = pd.factorize(OC)
+    cmult = np.array([CONTENT_MULTIPLIERS.get(oc, 0) for oc in uniques] + [0], dtype=float)[codes]
+    isRES = np.array([oc[:3] == 'RES' for oc in uniques] + [False], dtype=bool)[codes]
+    defaultContent = cost * cmult
+    if fields.ContentCost != '':
+        xt = num(fields.ContentCost, True)
+        ccost = np.where(xt == -1, defaultContent, xt)
+        ccostInt = (xt != -1) | (cmult == 0)
+    else:
+        ccost = defaultContent
+        ccostInt = cmult == 0
+
+    # Inventory Cost: default sales based cost for occupancies with a default inventory DDF,
+    # else the user-supplied value (0 if blank)
+    owdi = np.isin(OC, INVENTORY_OCCUPANCIES)
+    iecon = library['iecon']
+    positions = iecon.lookup(OC)
+    defaultInventory = iecon.column('AnnualSalesPerSqFt', positions) * iecon.column('BusinessInvPctofSales', positions) * area / 100
+    defaultInventoryInt = positions < 0
+    defaultInventory[defaultInventoryInt] = 0
+    if fields.InvCost != '':
+        xt = attr(fields.InvCost, lambda v: v)
+        blank = np.array([isinstance(v, int) for v in xt], dtype=bool)
+        xt = xt.astype(float)
+        useDefault = owdi & (xt == -1)
+        icost = np.where(useDefault, defaultInventory, np.where(xt > -1, xt, 0))
+        icostInt = np.where(useDefault, defaultInventoryInt, blank | ~(xt > -1))
+    else:
+        icost = np.where(owdi, defaultInventory, 0)
+        icostInt = np.where(owdi, defaultInventoryInt, True)
+
+    attributes = {
+        'valid': valid,
+        'uid': _expand(uid, rows, n, None), 'OC': _expand(OC, rows, n), 'SOID': _expand(soid, rows, n),
+        'foundationType': _expand(foundationType, rows, n), 'numStories': _expand(numStories, rows, n),
+        'area': _expand(area, rows, n), 'cost': _expand(cost, rows, n), 'ffh': _expand(ffh, rows, n),
+        'lat': _expand(lat, rows, n), 'lon': _expand(lon, rows, n),
+        'ccost': _expand(ccost, rows, n), 'ccostInt': _expand(ccostInt, rows, n, False),
+        'icost': _expand(icost, rows, n), 'icostInt': _expand(icostInt, rows, n, False),
+        'owdi': _expand(owdi, rows, n, False),
+        'isRES': _expand(isRES, rows, n, False)
+    }
+    # User-supplied DDF IDs are only interpreted for flooded records
+    for key, name in [('bddf', fields.BldgDamageFnID), ('cddf', fields.ContDamageFnId), ('iddf', fields.InvDamageFnId)]:
+        if name != '':
+            values = attr(name, lambda v: v)
+            codes, uniques = pd.factorize(values)
+            pairs = [_ddfKey(v) for v in uniques]
+            attributes[key] = _expand(_objects([pair[0] for pair in pairs])[codes], rows, n, None)
+            attributes[key + 'Id'] = _expand(_objects([pair[1] for pair in pairs])[codes], rows, n, None)
+            attributes[key + 'Value'] = _expand(values, rows, n, None)
+    # Census geography of the summary table, when the inventory has it
+    for level, name in udf_summary.censusFields(fieldnames).items():
+        attributes[level] = _objects(['' if value is None else value.strip() for value in column(name).tolist()])
+    if 'CensusBlock' in attributes:
+        attributes['CensusBlock'] = udf_summary.blockGroups(attributes['CensusBlock'], attributes.get('CensusTract'))
+    # Buildings of the same archetype have the same damage at the same depth
+    attributes['archetype'] = _expand(_archetypes([attributes[key][rows] for key in ARCHETYPE_FIELDS if key in attributes])[0], rows, n, -1)
+    return attributes
+
+
+def _expand(values, rows, n, fill=np.nan):
+    """Scatters the values of the valid records into a full length column"""
+    if values.dtype == object or fill is None:
+        out = np.full(n, None, dtype=object)
+    else:
+        out = np.full(n, fill, dtype=np.result_type(values.dtype, type(fill)))
+    out[rows] = values
+    return out
+
+
+def _selectDDF(attributes, wet, fields, library, kind, coastal):
+    """Resolves the DDF of every flooded record for one of 'bddf', 'cddf', 'iddf'
+
+    Returns:
+        damage: numpy array -- damage ratio, 0 where there is no DDF
+        ddfId: numpy array -- the DDF ID recorded in the results
+        matched: numpy array -- False where the default lookup has no match
+    """
+    n = len(attributes['valid'])
+    damage = np.zeros(n)
+    ddfId = np.zeros(n, dtype=object)
+    matched = np.ones(n, dtype=bool)
+    userSupplied = kind in attributes
+    user = np.zeros(n, dtype=bool)
+    # Dry records keep the no-damage defaults; only the flooded ones are looked up
+    wetIdx = np.flatnonzero(wet)
+    if len(wetIdx) == 0:
+        return damage, ddfId, matched, user
+    if userSupplied:
+        keys = attributes[kind][wetIdx]
+        bad = keys == None
+        if bad.any():
+            first = wetIdx[bad][0]
+            name = {'bddf': fields.BldgDamageFnID, 'cddf': fields.ContDamageFnId, 'iddf': fields.InvDamageFnId}[kind]
+            raise ValueError('Record ' + str(attributes['uid'][first]).strip() + ': ' + name + ' value '
+                             + repr(attributes[kind + 'Value'][first]) + ' is not a DDF ID')
+        full = library[kind + '_full']
+        positions = full.lookup(keys)
+        found = positions >= 0
+        idx = wetIdx[found]
+        user[idx] = True
+        damage[idx] = full.interpolate(positions[found], attributes['depth'][idx])
+        ddfId[idx] = attributes[kind + 'Id'][idx]
+
+    # Default DDF, by Specific Occupancy ID. Coastal tables are only used for RES-type structures.
+    default = wet & ~user
+    if kind == 'iddf':
+        default &= attributes['owdi']
+    isRES = attributes['isRES']
+    name = kind + '_riverine'
+    for table, rows in [(name, default & ~(isRES & (coastal is not None))),
+                        (kind + '_' + str(coastal), default & isRES & (coastal is not None))]:
+        idx = np.flatnonzero(rows)
+        if len(idx) == 0:
+            continue
+        lut = library[table]
+        positions = lut.lookup(attributes['SOID'][idx])
+        found = positions >= 0
+        matched[idx[~found]] = False
+        idx, positions = idx[found], positions[found]
+        damage[idx] = lut.interpolate(positions, attributes['depth'][idx])
+        ddfId[idx] = attributes[kind + 'Id'][idx] if userSupplied else lut.values('DDF_ID', positions)
+    return damage, ddfId, matched, user
+
+
+def _archetypes(columns):
+    """Numbers the unique combinations of the values of columns, in order of first appearance
+
+    Returns:
+        codes: numpy array -- the archetype of every record
+        first: numpy array -- the first record of every archetype
+    """
+    codes = np.zeros(len(columns[0]), dtype=np.int64)
+    for values in columns:
+        valueCodes, uniques = pd.factorize(values)
+        codes = pd.factorize(codes * (len(uniques) + 1) + valueCodes + 1)[0]
+    first = np.zeros(codes.max() + 1 if len(codes) else 0, dtype=np.int64)
+    first[codes[::-1]] = np.arange(len(codes) - 1, -1, -1)
+    return codes, first
+
+
+def _broadcast(values, rows, codes, n, fill):
+    """Scatters archetype values to the records of rows, fill for the other records"""
+    out = np.full(n, fill, dtype=values.dtype)
+    out[rows] = values[codes]
+    return out
+
+
+def _archetypeDamage(archetypes, fields, library, coastal):
+    """Computes the damage ratios, debris rates and restoration days of flooded building archetypes
+
+    Keyword Arguments:
+        archetypes: dict -- the attributes of one record of every archetype, with its clipped depth
+        fields: UDFFields -- the field map
+        library: DamageFunctionLibrary -- the compiled lookup tables
+        coastal: str -- the coastal lookup tables, or None
+
+    Returns:
+        archetype: dict -- name to numpy array, one value per archetype
+    """
+    n = len(archetypes['valid'])
+    archetype = {}
+    wet = np.ones(n, dtype=bool)
+    archetype['bdamage'], archetype['bddfId'], archetype['bmatched'], archetype['buser'] = _selectDDF(archetypes, wet, fields, library, 'bddf', coastal)
+    wet = archetype['bmatched'].copy()
+    archetype['cdamage'], archetype['cddfId'], archetype['cmatched'], archetype['cuser'] = _selectDDF(archetypes, wet, fields, library, 'cddf', coastal)
+    archetype['idamage'], archetype['iddfId'], archetype['imatched'], archetype['iuser'] = _selectDDF(archetypes, wet, fields, library, 'iddf', None)
+
+    # Debris and restoration time, for archetypes with flood depth in the structure
+    clipped = archetypes['depth']
+    archetype['DebrisID'] = np.full(n, None, dtype=object)
+    for name in ['Finishes', 'Structure', 'Foundation']:
+        archetype[name] = np.full(n, np.nan)
+    archetype['Min_Restor_Days'] = np.zeros(n, dtype=np.int64)
+    archetype['Max_Restor_Days'] = np.zeros(n, dtype=np.int64)
+    idx = np.flatnonzero(wet & (clipped > 0))
+    if len(idx) > 0:
+        oc, d, ft = archetypes['OC'][idx], clipped[idx], archetypes['foundationType'][idx]
+        basement = ((oc == 'RES1') | (oc == 'COM6')) & (ft == 4)
+        bsm = np.where(basement & (oc == 'RES1'), 'B', 'NB')
+        fnd = np.where((ft == 4) | (ft == 7), 'SG', 'FT')
+        dsuf = np.where(basement,
+                        np.select([d < -4, d < 0, d < 4, d < 6, d < 8], ['-8', '-4', '0', '4', '6'], '8'),
+                        np.select([d < 1, d < 4, d < 8, d < 12], ['0', '1', '4', '8'], '12'))
+        dsuf = np.where((oc == 'RES2') & (d < 0), '', dsuf)
+        debrisKey = oc + bsm.astype(object) + fnd.astype(object) + dsuf.astype(object)
+        archetype['DebrisID'][idx] = debrisKey
+        lut = library['debris']
+        positions = lut.lookup(debrisKey)
+        for name in ['Finishes', 'Structure', 'Foundation']:
+            archetype[name][idx] = lut.column(name, positions)
+
+        rsuf = np.select([d < 0, d < 1, d < 4, d < 8, d < 12], ['0', '1', '4', '8', '12'], '24')
+        lut = library['rest']
+        positions = lut.lookup(oc + rsuf.astype(object))
+        for name in ['Min_Restor_Days', 'Max_Restor_Days']:
+            archetype[name][idx] = lut.column(name, positions, int, 0)
+    return archetype
+
+
+def computeDamage(attributes, raw, sampled, gridName, fields, library, QC_Warning=False):
+    """Computes the flood losses of an inventory chunk for one depth grid
+
+    Keyword Arguments:
+        attributes: dict -- from prepareInventory
+        raw: numpy array -- sampled depth in the raster data type
+        sampled: numpy array -- False where the depth is not from the grid
+        gridName: str -- recorded in the GridName attribute
+        fields: UDFFields -- the field map
+        library: DamageFunctionLibrary -- the compiled lookup tables
+        QC_Warning: bool -- report inconsistencies between user-supplied DDFs and occupancy classes
+
+    Returns:
+        result: UDFResult
+    """
+    n = len(attributes['valid'])
+    valid = attributes['valid']
+    rastervalue = raw.astype(float)
+    depth = rastervalue - attributes['ffh']
+    wet = valid & (rastervalue > 0)
+    # LUTs do not extend beyond -4 to 24 feet
+    clipped = np.clip(depth, DEPTH_MIN, DEPTH_MAX)
+    attributes = dict(attributes, depth=clipped)
+
+    # Coastal lookup tables are selected by the Coastal Zone code ('CAE', 'V', 'VE')
+    coastal = None
+    if fields.flC != '':
+        coastal = 'coastalA' if fields.flC == 'CAE' else 'coastalV' if fields.flC in ['VE', 'V'] else None
+
+    # Damage ratios, debris rates and restoration days are computed once per archetype of the
+    # flooded records and broadcast to them; costs and areas are applied per building
+    wetIdx = np.flatnonzero(wet)
+    codes, first = _archetypes([attributes['archetype'][wetIdx], clipped[wetIdx]])
+    keys = ['valid', 'uid', 'OC', 'foundationType', 'SOID', 'owdi', 'isRES', 'depth']
+    keys += [kind + suffix for kind in ['bddf', 'cddf', 'iddf'] if kind in attributes for suffix in ['', 'Id', 'Value']]
+    archetypes = dict((key, attributes[key][wetIdx[first]]) for key in keys)
+    archetype = _archetypeDamage(archetypes, fields, library, coastal)
+    broadcast = lambda name, fill: _broadcast(archetype[name], wetIdx, codes, n, fill)
+
+    damage, bddfId, bmatched, buser = broadcast('bdamage', 0.0), broadcast('bddfId', 0), broadcast('bmatched', True), broadcast('buser', False)
+    unmatched = wet & ~bmatched
+    processed = valid & ~unmatched
+    wet &= processed
+    cdamage, cddfId, cmatched, cuser = broadcast('cdamage', 0.0), broadcast('cddfId', 0), broadcast('cmatched', True), broadcast('cuser', False)
+    idamage, iddfId, imatched, iuser = broadcast('idamage', 0.0), broadcast('iddfId', 0), broadcast('imatched', True), broadcast('iuser', False)
+    # Content/inventory records without a default DDF get no damage
+    cddfId[wet & ~cmatched] = 'Unmatched'
+    iddfId[wet & ~imatched] = 'Unmatched'
+    cdamageInt = ~wet | ~cmatched
+    idamageInt = ~wet | ~imatched | ~(iuser | attributes['owdi'])
+
+    SOID = attributes['SOID']
+    if QC_Warning:
+        _reportQC(attributes, wet, buser, cuser, iuser, library, fields)
+    for i in np.flatnonzero(unmatched):
+        print("something wrong, no match for Specific Occupancy ID :" + SOID[i] + "   UDF: " + fields.UserDefinedFltyId)
+
+    cost = attributes['cost']
+    ccost = attributes['ccost']
+    icost = attributes['icost']
+    area = attributes['area']
+
+    # Debris and restoration time, for records with flood depth in the structure
+    debrisId = broadcast('DebrisID', None)
+    dfin = area * broadcast('Finishes', np.nan) / 1000
+    dstruc = area * broadcast('Structure', np.nan) / 1000
+    dfound = area * broadcast('Foundation', np.nan) / 1000
+    debris = {'Debris_Fin': dfin, 'Debris_Struc': dstruc, 'Debris_Found': dfound, 'Debris_Tot': dfin + dstruc + dfound}
+    restMin = broadcast('Min_Restor_Days', 0)
+    restMax = broadcast('Max_Restor_Days', 0)
+
+    status = np.where(valid, np.where(unmatched, STATUS_UNMATCHED, STATUS_PROCESSED), STATUS_SKIPPED).astype(np.int8)
+    depthInStruc = np.where(valid, depth, -99999)
+    bddfId[unmatched] = 'Unmatched'
+    bdamageInt = ~wet
+    columns = {
+        'Depth_Grid': raw,
+        'Depth_in_Struc': depthInStruc,
+        'flExp': np.where(valid & (rastervalue > 0), 1, 0),
+        'SOID': SOID,
+        'BDDF_ID': bddfId,
+        'BldgDmgPct': damage * 100,
+        'BldgLossUSD': damage * cost,
+        'ContentCostUSD': ccost,
+        'CDDF_ID': cddfId,
+        'ContDmgPct': cdamage * 100,
+        'ContentLossUSD': cdamage * ccost,
+        'InventoryCostUSD': icost,
+        'IDDF_ID': iddfId,
+        'InvDmgPct': idamage * 100,
+        'InventoryLossUSD': idamage * icost,
+        'DebrisID': debrisId,
+        'Debris_Fin': debris['Debris_Fin'],
+        'Debris_Struc': debris['Debris_Struc'],
+        'Debris_Found': debris['Debris_Found'],
+        'Debris_Tot': debris['Debris_Tot'],
+        'Restor_Days_Min': restMin,
+        'Restor_Days_Max': restMax,
+        'GridName': np.full(n, gridName, dtype=object)
+    }
+    ccostInt = attributes['ccostInt']
+    icostInt = attributes['icostInt']
+    integral = {
+        'Depth_Grid': ~sampled,
+        'Depth_in_Struc': ~valid,
+        'BldgDmgPct': bdamageInt,
+        'BldgLossUSD': bdamageInt,
+        'ContentCostUSD': ccostInt,
+        'ContDmgPct': cdamageInt,
+        'ContentLossUSD': ~wet | (cdamageInt & ccostInt),
+        'InventoryCostUSD': icostInt,
+        'InvDmgPct': idamageInt,
+        'InventoryLossUSD': ~wet | (idamageInt & icostInt)
+    }
+    return UDFResult(status, columns, integral)
+
+
+def _reportQC(attributes, wet, buser, cuser, iuser, library, fields):
+    """Prints the informative inconsistency observations of the row engine"""
+    OC = attributes['OC']
+    uid = attributes['uid']
+    for kind, user, label in [('bddf', buser, 'Building'), ('cddf', cuser, 'Content '), ('iddf', iuser, 'Inventory')]:
+        if kind not in attributes:
+            continue
+        values = attributes[kind + 'Value']
+        full = library[kind + '_full']
+        positions = full.lookup(np.where(user, attributes[kind], None))
+        occupancy = full.values('Occupancy', positions)
+        for i in np.flatnonzero(user & (occupancy != OC)):
+            print("FYI: User-supplied " + label + " DDFID " + str(values[i]) + " Occupancy Class is inconsistent with UDF Occupancy Class " + OC[i] + " versus " + occupancy[i] + "  " + _uidText(uid[i]))
+        ids = attributes[kind + 'Id']
+        for i in np.flatnonzero(wet & ~user & (ids != None)):
+            if ids[i] > 0:
+                print("User specified a non-official " + label.strip() + " DDFID: " + str(values[i]) + "    UID: " + _uidText(uid[i]) + "   Reverting to default " + label.strip() + " DDF for Occupancy Class " + OC[i])
+
+
+def _text(values, integral=None):
+    """Formats a result column as the text the csv module writes for its values"""
+    if values.dtype == object:
+        try:
+            '\0'.join(values.tolist())
+            return values
+        except TypeError:
+            pass
+        # object columns hold text, None and integer ids
+        codes, uniques = pd.factorize(values)
+        return _objects([str(value) for value in uniques] + [''])[codes]
+    if values.dtype.kind == 'f':
+        if integral is None or not integral.any():
+            return _floatText(values)
+        # Cells written as integers (the no-damage zeros of dry records, mostly) are formatted
+        # once per unique value, apart from the float cells
+        integral = integral & ~np.isnan(values)
+        text = np.empty(len(values), dtype=object)
+        rest = ~integral
+        if rest.any():
+            text[rest] = _floatText(values[rest])
+        codes, uniques = pd.factorize(values[integral])
+        text[integral] = _objects([str(int(value)) for value in uniques.tolist()])[codes]
+        return text
+    codes, uniques = pd.factorize(values)
+    format = str if values.dtype.kind in 'iu' else lambda value: str(values.dtype.type(value))
+    return _objects([format(value) for value in uniques.tolist()])[codes]
+
+
+def _pyarrow():
+    """pyarrow and pyarrow.compute if they are installed, else None; then the text is handled cell by cell"""
+    try:
+        import pyarrow as pa
+        import pyarrow.compute as pc
+    except ImportError:
+        return None
+    return pa, pc
+
+
+def _reprs(values):
+    """repr() of every value of a float64 array, as a list
+
+    Notes: pyarrow writes the same shortest round-trip digits as repr, but integral values without
+        '.0' and some values in an exponent notation of its own. Values it writes in exponent notation,
+        and those repr writes so (below 1e-4 or from 1e16 on), are left to repr.
+    """
+    arrow = _pyarrow()
+    if arrow is None or len(values) < 1000:
+        return [repr(value) for value in values.tolist()]
+    pa, pc = arrow
+    magnitude = np.abs(values)
+    bulk = np.isfinite(values) & (((magnitude >= 1e-4) & (magnitude < 1e16)) | (values == 0))
+    if not bulk.all():
+        text = np.empty(len(values), dtype=object)
+        text[bulk] = _reprs(values[bulk])
+        text[~bulk] = [repr(value) for value in values[~bulk].tolist()]
+        return text.tolist()
+    text = pc.cast(pa.array(values), pa.string())
+    exponent = pc.match_substring(text, 'e').to_numpy(zero_copy_only=False)
+    text = pc.if_else(pa.array((values == np.trunc(values)) & ~exponent), pc.binary_join_element_wise(text, '.0', ''), text)
+    text = text.to_numpy(zero_copy_only=False)
+    for i in np.flatnonzero(exponent):
+        text[i] = repr(float(values[i]))
+    return text.tolist()
+
+
+def _floatText(values):
+    """Formats a float column, '' for NaN"""
+    codes, uniques = pd.factorize(values)
+    # float64 cells are written as Python floats, other raster types as numpy scalars
+    if values.dtype == np.float64:
+        formatted = _reprs(uniques)
+    else:
+        formatted = [str(value) for value in uniques]
+    text = _objects(formatted + [''])[codes]
+    # factorize does not tell -0.0 from 0.0
+    text[(values == 0) & np.signbit(values)] = '-0.0'
+    return text
+
+
+def _quote(text):
+    """Quotes the cells the csv module would quote, leaving the others as they are"""
+    joined = '\0'.join(text.tolist())
+    if ',' not in joined and '"' not in joined and '\n' not in joined and '\r' not in joined:
+        return text
+    codes, uniques = pd.factorize(text)
+    special = [i for i, cell in enumerate(uniques) if ',' in cell or '"' in cell or '\n' in cell or '\r' in cell]
+    if not special:
+        return text
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=',', lineterminator='\n')
+    uniques = _objects(list(uniques))
+    for i in special:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerow([uniques[i]])
+        uniques[i] = buffer.getvalue()[:-1]
+    return uniques[codes]
+
+
+def _resultMask(result, key):
+    """The records the results of attribute key are written for"""
+    status = result.status
+    mask = status == STATUS_PROCESSED
+    if key in SKIPPED_FIELDS:
+        mask |= status == STATUS_SKIPPED
+    if key in UNMATCHED_FIELDS:
+        mask |= status == STATUS_UNMATCHED
+    return mask
+
+
+def _resultText(result, key, old=None):
+    """Formats the results of attribute key, keeping old (or '') for the records they do not include"""
+    status = result.status
+    mask = _resultMask(result, key)
+    new = _text(result.columns[key], result.integral.get(key))
+    if new.dtype == object and result.columns[key].dtype == object:
+        new = _quote(new)
+    if mask.all():
+        return new
+    return np.where(mask, new, np.full(len(status), '', dtype=object) if old is None else old)
+
+
+def joinRows(columns, header):
+    """Joins csv text columns into the text of each record"""
+    return list(map(','.join, zip(*[columns[name].tolist() for name in header])))
+
+
+def _formatRows(columns, header):
+    if len(header) and len(columns[header[0]]):
+        return joinRows(columns, header)
+    return []
+
+
+def writeRows(file_out, rows):
+    """Writes the text of records, with '\\n' line endings, in a single write"""
+    if rows:
+        file_out.write('\n'.join(rows) + '\n')
+
+
+def _sortedRows(rows, columns, header):
+    """The records as written with '\\r\\n' line endings, where cells with a carriage return are quoted"""
+    if not any('\r' in row for row in rows):
+        return rows
+    columns = dict(columns)
+    for name in header:
+        cells = columns[name].tolist()
+        if any('\r' in cell and cell[:1] != '"' for cell in cells):
+            columns[name] = np.array([cell if '\r' not in cell or cell[:1] == '"' else '"' + cell + '"' for cell in cells], dtype=object)
+    return joinRows(columns, header)
+
+
+def inventoryText(cells, fieldnames):
+    """Formats the inventory cells of a chunk as csv text, once for all the grids
+
+    Returns:
+        inventory: dict -- inventory field to numpy array of csv text
+    """
+    return dict((name, _quote(_text(cells[:, i]))) for i, name in enumerate(fieldnames))
+
+
+def formatResults(inventory, fieldnames, fields, result, sort=False):
+    """Formats the records of an inventory chunk with their results as csv text
+
+    Keyword Arguments:
+        inventory: dict -- the inventory chunk from inventoryText
+        fieldnames: list -- the inventory header
+        fields: UDFFields -- the field map
+        result: UDFResult -- the results of the chunk
+        sort: bool -- also format the records for the sorted copy
+
+    Returns:
+        rows: list -- text of the records, without line endings
+        sortedRows: tuple -- with sort, the records for SortedResults.append and their Depth_in_Struc; else None
+    """
+    columns = dict(inventory)
+    for key in NEW_FIELDS:
+        name = fields.output[key]
+        columns[name] = _resultText(result, key, columns.get(name))
+    header = fields.header(fieldnames)
+    rows = _formatRows(columns, header)
+    if not sort:
+        return rows, None
+    keys = np.array(list(map(float, columns[fields.output['Depth_in_Struc']].tolist())), dtype=float)
+    return rows, (_sortedRows(rows, columns, header), keys)
+
+
+def writeResults(file_out, inventory, fieldnames, fields, result, sortedResults=None):
+    """Writes the records of an inventory chunk with their results
+
+    Keyword Arguments:
+        file_out: file -- the results file, written as csv with '\\n' line endings
+        inventory: dict -- the inventory chunk from inventoryText
+        fieldnames: list -- the inventory header
+        fields: UDFFields -- the field map
+        result: UDFResult -- the results of the chunk
+        sortedResults: SortedResults -- optional; also adds the records to the sorted copy
+    """
+    rows, sortedRows = formatResults(inventory, fieldnames, fields, result, sortedResults is not None)
+    writeRows(file_out, rows)
+    if sortedResults is not None:
+        sortedResults.append(*sortedRows)
+
+
+def wideSharedText(inventory, fields, result):
+    """The inventory and grid-independent columns of the wide table, as csv text"""
+    columns = dict(inventory)
+    for key in SHARED_FIELDS:
+        name = fields.output[key]
+        columns[name] = _resultText(result, key, columns.get(name))
+    return columns
+
+
+def wideGridText(result, suffix):
+    """The columns of one grid in the wide table, as csv text"""
+    return dict((key + '_' + suffix, _resultText(result, key)) for key in GRID_FIELDS)
+
+
+def formatWideResults(inventory, fieldnames, fields, results, suffixes):
+    """Formats the records of an inventory chunk with the results of several grids side by side
+
+    Keyword Arguments:
+        inventory: dict -- the inventory chunk from inventoryText
+        fieldnames: list -- the inventory header
+        fields: UDFFields -- the field map
+        results: list -- UDFResult of the chunk for every grid
+        suffixes: list -- column name suffix of every grid
+
+    Returns:
+        rows: list -- text of the records of the wide results csv, without line endings
+    """
+    columns = wideSharedText(inventory, fields, results[0])
+    for result, suffix in zip(results, suffixes):
+        columns.update(wideGridText(result, suffix))
+    return _formatRows(columns, fields.wideHeader(fieldnames, suffixes))
+
+
+def writeWideResults(file_out, inventory, fieldnames, fields, results, suffixes):
+    """Writes the records of an inventory chunk with the results of several grids side by side, as formatWideResults"""
+    writeRows(file_out, formatWideResults(inventory, fieldnames, fields, results, suffixes))
+
+
+def inventoryArrays(cells, fieldnames):
+    """The inventory cells of a chunk as pyarrow string arrays, null for cells missing from short records
+
+    Returns:
+        inventory: dict -- inventory field to pyarrow array
+    """
+    import pyarrow as pa
+    return dict((name, pa.array(cells[:, i], type=pa.string())) for i, name in enumerate(fieldnames))
+
+
+def _resultArray(result, key, old=None):
+    """The results of attribute key as a typed pyarrow array, null where the csv cell is empty
+
+    Notes: Results that replace an inventory field of the same name (old) keep its text for the
+        records they do not include, so they are text like the field.
+    """
+    import pyarrow as pa
+    values = result.columns[key]
+    mask = _resultMask(result, key)
+    if old is not None:
+        text = np.where(mask, _text(values, result.integral.get(key)), old.to_numpy(zero_copy_only=False))
+        return pa.array(text, type=pa.string())
+    if values.dtype == object:
+        # object columns hold text, None and integer ids
+        codes, uniques = pd.factorize(values)
+        text = _objects([str(value) for value in uniques] + [None])[codes]
+        return pa.array(text, type=pa.string(), mask=~mask)
+    if values.dtype.kind == 'f':
+        return pa.array(values, mask=~mask | np.isnan(values))
+    return pa.array(values, mask=~mask)
+
+
+def resultArrays(inventory, fields, result):
+    """The records of an inventory chunk with their results, as pyarrow arrays
+
+    Keyword Arguments:
+        inventory: dict -- the inventory chunk from inventoryArrays
+        fields: UDFFields -- the field map
+        result: UDFResult -- the results of the chunk
+
+    Returns:
+        arrays: dict -- column name to pyarrow array, the inventory fields then the output attributes.
+            Output attributes named like an inventory field replace it, where the csv has the name twice.
+    """
+    arrays = dict(inventory)
+    for key in NEW_FIELDS:
+        name = fields.output[key]
+        arrays[name] = _resultArray(result, key, inventory.get(name))
+    return arrays
+
+
+def wideArrays(inventory, fields, results, suffixes):
+    """The records of an inventory chunk with the results of several grids side by side, as pyarrow arrays"""
+    arrays = dict(inventory)
+    for key in SHARED_FIELDS:
+        name = fields.output[key]
+        arrays[name] = _resultArray(results[0], key, inventory.get(name))
+    arrays.update(wideGridArrays(results, suffixes))
+    return arrays
+
+
+def wideGridArrays(results, suffixes):
+    """The columns of grids in the wide table, as pyarrow arrays"""
+    return dict((key + '_' + suffix, _resultArray(result, key)) for result, suffix in zip(results, suffixes) for key in GRID_FIELDS)
+
+
+def aalWeights(returnPeriods):
+    """Weights of the losses at the return periods in the average annualized loss (AAL)
+
+    Keyword Arguments:
+        returnPeriods: list -- the return period in years of every depth grid
+
+    Returns:
+        weights: numpy array -- the AAL is the sum of the losses times their weights
+
+    Notes: The loss is integrated over the annual exceedance probability (1 / return period)
+        with the trapezoidal rule, between the most frequent and the rarest return period. The
+        loss of events outside that range is not extrapolated.
+    """
+    returnPeriods = np.asarray(returnPeriods, dtype=float)
+    if len(returnPeriods) < 2 or not (returnPeriods > 0).all() or len(np.unique(returnPeriods)) < len(returnPeriods):
+        raise ValueError('AAL needs the depth grids of two or more distinct, positive return periods')
+    probabilities = 1 / returnPeriods
+    order = np.argsort(-probabilities, kind='stable')
+    steps = probabilities[order[:-1]] - probabilities[order[1:]]
+    weights = np.zeros(len(returnPeriods))
+    np.add.at(weights, order[:-1], steps / 2)
+    np.add.at(weights, order[1:], steps / 2)
+    return weights
+
+
+def annualizedLosses(results, weights):
+    """Computes the AAL of the records of a chunk from their results at every return period
+
+    Keyword Arguments:
+        results: list -- UDFResult of the chunk for the grid of every return period
+        weights: numpy array -- from aalWeights
+
+    Returns:
+        aal: dict -- AAL_FIELDS name to numpy array; NaN for the records without losses at every
+            return period (missing required fields, or no DDF for a flooded record)
+    """
+    complete = np.logical_and.reduce([result.status == STATUS_PROCESSED for result in results])
+    aal = {}
+    for name, key in zip(AAL_FIELDS, RETURN_PERIOD_FIELDS):
+        losses = np.column_stack([np.where(_resultMask(result, key), result.columns[key], 0.0) for result in results])
+        aal[name] = np.where(complete, losses @ weights, np.nan)
+    aal['TotalAALUSD'] = aal['BldgAALUSD'] + aal['ContentAALUSD'] + aal['InventoryAALUSD']
+    return aal
+
+
+def aalText(inventory, fields, results, weights, suffixes, detail=False):
+    """The columns of the AAL table of an inventory chunk, as csv text (see UDFFields.aalHeader)"""
+    columns = wideSharedText(inventory, fields, results[0])
+    for name, values in annualizedLosses(results, weights).items():
+        columns[name] = _text(values)
+    if detail:
+        for result, suffix in zip(results, suffixes):
+            columns.update((key + '_' + suffix, _resultText(result, key)) for key in RETURN_PERIOD_FIELDS)
+    return columns
+
+
+def aalArrays(inventory, fields, results, weights, suffixes, detail=False):
+    """The columns of the AAL table of an inventory chunk, as pyarrow arrays, null where the csv cell is empty"""
+    import pyarrow as pa
+    arrays = wideArrays(inventory, fields, results[:1], [])
+    for name, values in annualizedLosses(results, weights).items():
+        arrays[name] = pa.array(values, mask=np.isnan(values))
+    if detail:
+        for result, suffix in zip(results, suffixes):
+            arrays.update((key + '_' + suffix, _resultArray(result, key)) for key in RETURN_PERIOD_FIELDS)
+    return arrays
+
+
+def returnPeriodSuffix(returnPeriod):
+    """Column name suffix of the losses at a return period, such as 'rp100'"""
+    return 'rp' + format(float(returnPeriod), 'g')
+
+
+def gridSuffix(dgp):
+    """The name of a depth grid used in result file and column names"""
+    return os.path.split(dgp)[1].split('.')[0]
+
+
+def summaryValues(attributes, result):
+    """The values and groups of the records of a chunk for the summary table
+
+    Returns:
+        rows: numpy array -- mask of the records with results, the ones totalled
+        values: dict -- summary field to numpy array, one value per record
+        groups: dict -- level to the group of every record
+    """
+    status = result.status
+    rows = status != STATUS_SKIPPED
+    values = {'Records': rows.astype(np.int64),
+              'Exposed': ((status == STATUS_PROCESSED) & (result.columns['flExp'] == 1)).astype(np.int64)}
+    for key in ['BldgLossUSD', 'ContentLossUSD', 'InventoryLossUSD', 'Debris_Tot']:
+        values[key] = np.where(_resultMask(result, key) & ~np.isnan(result.columns[key]), result.columns[key], 0.0)
+    groups = {'OccupancyClass': attributes['OC']}
+    for level in ['CensusTract', 'CensusBlock']:
+        if level in attributes:
+            groups[level] = attributes[level]
+    return rows, values, groups
+
+
+def summaryTotals(attributes, result):
+    """Totals the results of a chunk for the summary table, by occupancy class and census geography
+
+    Returns:
+        totals: udf_summary.GroupTotals -- of the records with results
+    """
+    rows, values, groups = summaryValues(attributes, result)
+    totals = udf_summary.GroupTotals()
+    totals.add(dict((name, value[rows]) for name, value in values.items()),
+               dict((level, keys[rows]) for level, keys in groups.items()))
+    return totals
+
+
+def chunkStats(attributes, result, summary):
+    """The counts, unmatched SOID log entries and, with summary, the summary totals of the results of a chunk"""
+    unmatched = np.flatnonzero(result.status == STATUS_UNMATCHED)
+    return {'records': len(result),
+            'flooded': int(((result.status == STATUS_PROCESSED) & (result.columns['flExp'] == 1)).sum()),
+            'invalidSOID': len(unmatched),
+            'unmatched': ['Unmatched SOID: ' + result.columns['SOID'][j] + ' with userDefinedFltyId: ' + _uidText(attributes['uid'][j]) for j in unmatched],
+            'summary': summaryTotals(attributes, result) if summary else None}
+
+
+def recordStats(attributes, result):
+    """The counts, unmatched SOID log entries and summary values of every record of a chunk
+
+    Returns:
+        stats: dict -- flooded (mask), unmatched (the log entry, or None), totalled (mask of the records
+            in the summary) and the summary values and groups (see summaryValues), one value per record
+    """
+    totalled, values, groups = summaryValues(attributes, result)
+    unmatched = np.full(len(result), None, dtype=object)
+    unmatched[result.status == STATUS_UNMATCHED] = chunkStats(attributes, result, False)['unmatched']
+    stats = {'flooded': (result.status == STATUS_PROCESSED) & (result.columns['flExp'] == 1),
+             'unmatched': unmatched, 'totalled': totalled}
+    stats.update(values)
+    stats.update(groups)
+    return stats
+
+
+def totalStats(stats, summary):
+    """The chunkStats of a chunk from the recordStats of its records"""
+    totalled = stats['totalled']
+    totals = None
+    if summary:
+        totals = udf_summary.GroupTotals()
+        totals.add(dict((name, stats[name][totalled]) for name in udf_summary.SUMMARY_FIELDS),
+                   dict((level, stats[level][totalled]) for level in udf_summary.LEVELS if level in stats))
+    unmatched = [entry for entry in stats['unmatched'].tolist() if entry is not None]
+    return {'records': len(totalled), 'flooded': int(stats['flooded'].sum()), 'invalidSOID': len(unmatched),
+            'unmatched': unmatched, 'summary': totals}
+
+
+def addStats(stats, chunk):
+    """Adds the chunkStats of a chunk to the stats of a grid"""
+    for key in ['records', 'flooded', 'invalidSOID', 'unmatched']:
+        stats[key] += chunk[key]
+    if stats['summary'] is not None:
+        stats['summary'].update(chunk['summary'])
+
+
+class SpatialWindow():
+    """Consecutive inventory chunks processed in the spatial order of their records
+
+    Keyword Arguments:
+        sizes: list -- records of every inventory chunk of the window
+        order: numpy array -- the position in the window of every record, in the order they are processed
+    """
+    def __init__(self, sizes, order):
+        self.sizes = sizes
+        self.order = order
+
+    def restore(self, parts):
+        """Puts the outputs of the chunks processed back in inventory order, split by inventory chunk
+
+        Keyword Arguments:
+            parts: list -- an output of every chunk processed, in processing order: the text of its
+                records, a numpy array, a pyarrow RecordBatch, None, or a tuple or dict of those
+
+        Returns:
+            parts: list -- the output of every inventory chunk of the window
+        """
+        first = parts[0]
+        if first is None:
+            return [None] * len(self.sizes)
+        if isinstance(first, tuple):
+            return list(zip(*[self.restore([part[i] for part in parts]) for i in range(len(first))]))
+        if isinstance(first, dict):
+            columns = dict((key, self.restore([part[key] for part in parts])) for key in first)
+            return [dict((key, columns[key][i]) for key in first) for i in range(len(self.sizes))]
+        inverse = np.empty(len(self.order), dtype=np.int64)
+        inverse[self.order] = np.arange(len(self.order))
+        bounds = np.cumsum([0] + self.sizes).tolist()
+        if isinstance(first, list):
+            values = np.concatenate([_objects(part) for part in parts])[inverse]
+            return [values[start:end].tolist() for start, end in zip(bounds[:-1], bounds[1:])]
+        if isinstance(first, np.ndarray):
+            values = np.concatenate(parts)[inverse]
+            return [values[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+        import pyarrow as pa
+        columns = [pa.concat_arrays([part.column(i) for part in parts]) for i in range(first.num_columns)]
+        return [pa.RecordBatch.from_arrays([_take(column, inverse[start:end]) for column in columns], schema=first.schema)
+                for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def _take(array, indices):
+    """array.take(indices), keeping the values under the nulls of fixed width arrays as they are"""
+    import pyarrow as pa
+    if array.null_count == 0 or not pa.types.is_primitive(array.type):
+        return array.take(indices)
+    values = pa.Array.from_buffers(array.type, len(array), [None, array.buffers()[1]], 0, array.offset).take(indices)
+    valid = array.is_valid().take(indices)
+    return pa.Array.from_buffers(array.type, len(indices), [valid.buffers()[1], values.buffers()[1]], -1, 0)
+
+
+def spatialKeys(cells, fieldnames, fields, grid):
+    """The sort keys of the records of cells on a depth grid: the DepthGrid.spatialKeys of their latitude/longitude"""
+    lat = pd.to_numeric(cells[:, fieldnames.index(fields.latitude)], errors='coerce')
+    lon = pd.to_numeric(cells[:, fieldnames.index(fields.longitude)], errors='coerce')
+    return grid.spatialKeys(np.asarray(lat, dtype=float), np.asarray(lon, dtype=float))
+
+
+def spatialChunks(chunks, keys, window=DEFAULT_SPATIAL_WINDOW):
+    """Reorders the records of every few inventory chunks on their spatial keys
+
+    Keyword Arguments:
+        chunks: iterator -- the inventory chunks from readInventory
+        keys: function -- the sort key of every record of cells, such as spatialKeys
+        window: int -- inventory chunks reordered together
+
+    Returns:
+        chunks: generator -- (cells, SpatialWindow) of chunks of the records of every window in the order of
+            their keys, as many and as large as the inventory chunks of the window
+    """
+    while True:
+        group = list(itertools.islice(chunks, window))
+        if not group:
+            return
+        cells = np.concatenate(group)
+        spatial = SpatialWindow([len(part) for part in group], np.argsort(keys(cells), kind='stable'))
+        start = 0
+        for size in spatial.sizes:
+            yield cells[spatial.order[start:start + size]], spatial
+            start += size
+
+
+class _GridStages():
+    """The work of runGrids on every inventory chunk, in the stages of a udf_pipeline
+
+    Notes: sample computes the grid-independent attributes of a chunk and reads the grids at its
+        points, compute calculates and formats the results of every grid and write writes them and
+        adds up their counts, so the counts are those of the chunks written. Each method is only ever
+        called from one thread.
+
+        Chunks come with their SpatialWindow, or None. The chunks of a window are written once they
+        are all computed, restored to inventory order; their counts are kept per record until then.
+    """
+    def __init__(self, fieldnames, fields, library, grids, gridNames, suffixes, QC_Warning, format,
+                 files, sortedFiles, wide, summary, aal=None, aalWeights=None, aalSuffixes=None, aalDetail=False,
+                 footprints=None, zonalStatistic='max', plan=None):
+        self.fieldnames = fieldnames
+        self.fields = fields
+        self.library = library
+        self.grids = grids
+        self.gridNames = gridNames
+        self.suffixes = suffixes
+        self.QC_Warning = QC_Warning
+        self.format = format
+        self.files = files
+        self.sortedFiles = sortedFiles
+        self.wide = wide
+        self.aal = aal
+        self.aalWeights = aalWeights
+        self.aalSuffixes = aalSuffixes
+        self.aalDetail = aalDetail
+        self.footprints = footprints
+        self.zonalStatistic = zonalStatistic
+        self.plan = plan
+        self.summary = summary
+        self.chunks = 0
+        self.records = 0
+        self.written = 0
+        self.writtenChunks = 0
+        self.pending = []
+        self.stats = [{'records': 0, 'flooded': 0, 'invalidSOID': 0, 'unmatched': [],
+                       'summary': udf_summary.GroupTotals() if summary else None} for grid in grids]
+
+    def sample(self, chunk):
+        cells, window = chunk
+        attributes = prepareInventory(cells, self.fieldnames, self.fields, self.library)
+        cache = PointCache(self.plan)
+        if self.footprints is None:
+            samples = [grid.sample(attributes['lat'], attributes['lon'], cache, self.chunks) for grid in self.grids]
+        else:
+            positions = self.footprints.lookup(cells[:, self.fieldnames.index(self.fields.UserDefinedFltyId)])
+            samples = [zonalDepths(grid, self.footprints, positions, attributes['lat'], attributes['lon'], self.zonalStatistic,
+                                   cache, self.chunks) for grid in self.grids]
+        self.chunks += 1
+        return cells, attributes, samples, window
+
+    def compute(self, item):
+        cells, attributes, samples, window = item
+        inventory = inventoryText(cells, self.fieldnames) if self.format == 'csv' else inventoryArrays(cells, self.fieldnames)
+        results = []
+        outputs = []
+        for i, (raw, sampled) in enumerate(samples):
+            result = computeDamage(attributes, raw, sampled, self.gridNames[i], self.fields, self.library, self.QC_Warning)
+            if self.files and self.format != 'csv':
+                outputs.append(udf_output.recordBatch(resultArrays(inventory, self.fields, result)))
+            elif self.files:
+                outputs.append(formatResults(inventory, self.fieldnames, self.fields, result, bool(self.sortedFiles)))
+            results.append(result)
+        wideOutput = None
+        if self.wide is not None and self.format != 'csv':
+            wideOutput = udf_output.recordBatch(wideArrays(inventory, self.fields, results, self.suffixes))
+        elif self.wide is not None:
+            wideOutput = formatWideResults(inventory, self.fieldnames, self.fields, results, self.suffixes)
+        aalOutput = None
+        if self.aal is not None and self.format != 'csv':
+            aalOutput = udf_output.recordBatch(aalArrays(inventory, self.fields, results, self.aalWeights, self.aalSuffixes, self.aalDetail))
+        elif self.aal is not None:
+            columns = aalText(inventory, self.fields, results, self.aalWeights, self.aalSuffixes, self.aalDetail)
+            aalOutput = _formatRows(columns, self.fields.aalHeader(self.fieldnames, self.aalSuffixes, self.aalDetail))
+        self.records += len(cells)
+        print("   processing record " + str(self.records))
+        if window is not None:
+            return outputs, wideOutput, aalOutput, [recordStats(attributes, result) for result in results], window
+        return outputs, wideOutput, aalOutput, [chunkStats(attributes, result, self.summary) for result in results], None
+
+    def write(self, item):
+        window = item[-1]
+        if window is None:
+            return self._write(*item[:-1])
+        self.pending.append(item)
+        if len(self.pending) < len(window.sizes):
+            return
+        pending, self.pending = self.pending, []
+        outputs = list(zip(*[window.restore([output[i] for output, _, _, _, _ in pending]) for i in range(len(pending[0][0]))]))
+        wideOutputs = window.restore([wideOutput for _, wideOutput, _, _, _ in pending])
+        aalOutputs = window.restore([aalOutput for _, _, aalOutput, _, _ in pending])
+        stats = list(zip(*[window.restore([chunk[3][i] for chunk in pending]) for i in range(len(self.grids))]))
+        for i in range(len(window.sizes)):
+            self._write(list(outputs[i]) if outputs else [], wideOutputs[i], aalOutputs[i],
+                        [totalStats(gridStats, self.summary) for gridStats in stats[i]])
+
+    def _write(self, outputs, wideOutput, aalOutput, stats):
+        for i, output in enumerate(outputs):
+            if self.format != 'csv':
+                self.files[i].write(output)
+                continue
+            rows, sortedRows = output
+            writeRows(self.files[i], rows)
+            if sortedRows is not None:
+                self.sortedFiles[i].append(*sortedRows)
+        if wideOutput is not None and self.format != 'csv':
+            self.wide.write(wideOutput)
+        elif wideOutput is not None:
+            writeRows(self.wide, wideOutput)
+        if aalOutput is not None and self.format != 'csv':
+            self.aal.write(aalOutput)
+        elif aalOutput is not None:
+            writeRows(self.aal, aalOutput)
+        for gridStats, chunk in zip(self.stats, stats):
+            addStats(gridStats, chunk)
+        self.written += stats[0]['records']
+        self.writtenChunks += 1
+
+
+def runGrids(UDFOrig, depthGrids, outputPaths, fields, library, QC_Warning=False, chunkSize=DEFAULT_CHUNK_SIZE,
+             maxMemory=DEFAULT_MAX_MEMORY, widePath=None, sortedPaths=None, runRecords=udf_output.DEFAULT_RUN_RECORDS,
+             format='csv', pipeline=True, summary=False, aalPath=None, returnPeriods=None, aalDetail=False,
+             footprints=None, zonalStatistic='max', gridFiles=None, checkpointDir=None, resume=False,
+             checkpointRecords=udf_checkpoint.DEFAULT_CHECKPOINT_RECORDS, planDir=None, spatialWindow=0):
+    """Runs the inventory against several depth grids in one pass and writes the results files
+
+    Keyword Arguments:
+        UDFOrig: str -- the UDF inventory csv
+        depthGrids: list -- the depth grids
+        outputPaths: list -- the results csv of every grid, or None to skip the per grid csvs
+        fields: UDFFields -- the field map
+        library: DamageFunctionLibrary -- the compiled lookup tables
+        QC_Warning: bool -- report informative inconsistency observations
+        chunkSize: int -- number of records processed at once
+        maxMemory: int -- ceiling in bytes of the depth grid blocks kept in memory, shared by the grids
+        widePath: str -- optional; a single results csv with the columns of every grid side by side
+        sortedPaths: list -- optional; the copy of every results csv sorted on Depth_in_Struc
+        runRecords: int -- records of a sorted copy kept in memory before they are sorted to a run file
+        format: str -- 'csv', or 'parquet' or 'arrow' for typed results written by udf_output.ArrowResults
+        pipeline: bool -- read the inventory, read the grids, compute and write in threads of their own,
+            connected by bounded queues (udf_pipeline); else one chunk after the other in this thread
+        summary: bool -- total the results for the summary table (udf_summary) while they are computed
+        aalPath: str -- optional; the average annualized loss table of the buildings, computed from the
+            losses at the return periods of the grids (see aalWeights)
+        returnPeriods: list -- with aalPath, the return period in years of every grid
+        aalDetail: bool -- with aalPath, also write the losses of every return period in the AAL table
+        footprints: Footprints -- optional; sample the grids over the footprints of the buildings (see
+            footprints.zonalDepths), matched on UserDefinedFltyId
+        zonalStatistic: str -- with footprints, 'max', 'mean', 'median' or a percentile such as 'p90' of the
+            depth of the pixels of a footprint
+        gridFiles: dict -- optional; the file a depth grid is read from, such as its grid_cache copy, by
+            depth grid. The grid names and suffixes still come from depthGrids.
+        checkpointDir: str -- optional; commit the progress of the run to this folder (see udf_checkpoint),
+            removed when the run completes
+        resume: bool -- with checkpointDir, carry on from the last commit of an interrupted run of the
+            same inventory, grids, outputs and settings
+        checkpointRecords: int -- with checkpointDir, records written between commits, at least
+        planDir: str -- optional; the folder of the SamplingPlans of the chunks, reused by later runs of
+            the same inventory and by the grids of the same geometry
+        spatialWindow: int -- optional; process the records of every spatialWindow chunks in the order of the
+            Morton key of their pixel on the first grid (spatialChunks), so the grid blocks are read one region
+            after the other, then write them in inventory order. 0 processes the records in inventory order.
+
+    Returns:
+        stats: list -- records, flooded (records with flooding) and invalidSOID counts of every grid,
+            the unmatched SOID log entries and, with summary, the udf_summary.GroupTotals of the grid
+
+    Notes: Each inventory chunk is read and its grid-independent attributes (SOID, costs, DDF IDs)
+        computed once, then every grid is sampled and its damage computed from that shared state.
+        Points are projected once for the grids in the same spatial reference. Sorted copies are
+        built from the same records while they are written, with udf_output.SortedResults.
+
+        Results files are only written by the calling thread, a whole chunk per write, and an
+        error of any stage (such as a failed write to a network drive) stops the run.
+    """
+    grids = []
+    files = []
+    sortedFiles = []
+    stages = None
+    checkpoint = None
+    if checkpointDir is not None:
+        identity = udf_checkpoint.runIdentity('runGrids', UDFOrig, depthGrids,
+                                              (outputPaths or []) + (sortedPaths or []) + [widePath, aalPath],
+                                              fields=list(fields.fmap), format=format, chunkSize=chunkSize, summary=summary,
+                                              returnPeriods=returnPeriods, aalDetail=aalDetail,
+                                              footprints=footprints is not None, zonalStatistic=zonalStatistic)
+        checkpoint = udf_checkpoint.Checkpoint(checkpointDir, identity, resume)
+    state = checkpoint.state() if checkpoint is not None else None
+    csvFiles = {}
+
+    def openResults(path, header):
+        # A csv output, or the writer of a typed one
+        if format != 'csv' and checkpoint is not None:
+            name = 'output' + str(len(files))
+            return udf_checkpoint.BatchFiles(checkpoint.folder, name, path, format, header,
+                                             state['batches'][name] if state else 0)
+        if format != 'csv':
+            return udf_output.ArrowResults(path, format, header)
+        f = checkpoint.open(path) if checkpoint is not None else open(path, 'w')
+        if state is None:
+            csv.writer(f, delimiter=',', lineterminator='\n').writerow(header)
+        csvFiles[path] = f
+        return f
+
+    try:
+        for dgp in depthGrids:
+            grids.append(DepthGrid((gridFiles or {}).get(dgp, dgp), maxMemory // max(1, len(depthGrids))))
+            # Reported for every grid, as by the row engine
+            print('Is it UTM? ', grids[-1].isUTM)
+        gridNames = [os.path.split(dgp)[1] for dgp in depthGrids]
+        suffixes = [gridSuffix(dgp) for dgp in depthGrids]
+        fieldnames, chunks = readInventory(UDFOrig, chunkSize, fields)
+        for outputPath in outputPaths or []:
+            files.append(openResults(outputPath, fields.header(fieldnames)))
+        for i, sortedPath in enumerate(sortedPaths or []):
+            folder = checkpoint.folderFor('sorted' + str(i)) if checkpoint is not None else None
+            sortedFiles.append(udf_output.SortedResults(sortedPath, fields.header(fieldnames), runRecords, folder))
+        if state is not None:
+            udf_checkpoint.restoreSorted(sortedFiles, state['sorted'])
+        wide = None
+        if widePath is not None:
+            wide = openResults(widePath, fields.wideHeader(fieldnames, suffixes))
+            files.append(wide)
+        aal = None
+        weights = None
+        aalSuffixes = [returnPeriodSuffix(returnPeriod) for returnPeriod in returnPeriods or []]
+        if aalPath is not None:
+            if len(aalSuffixes) != len(depthGrids):
+                raise ValueError('AAL needs the return period of every depth grid')
+            weights = aalWeights(returnPeriods)
+            aal = openResults(aalPath, fields.aalHeader(fieldnames, aalSuffixes, aalDetail))
+            files.append(aal)
+        run = _GridStages(fieldnames, fields, library, grids, gridNames, suffixes, QC_Warning, format,
+                          files[:len(outputPaths or [])], sortedFiles, wide, summary,
+                          aal, weights, aalSuffixes, aalDetail, footprints, zonalStatistic,
+                          SamplingPlan(planDir) if planDir is not None else None)
+
+        def commit():
+            batches = dict((f.name, f.batches) for f in files if isinstance(f, udf_checkpoint.BatchFiles))
+            checkpoint.commit(run.writtenChunks, run.written, csvFiles,
+                              {'stats': run.stats, 'batches': batches, 'sorted': udf_checkpoint.sortedState(sortedFiles)},
+                              [(name, run.written) for name in gridNames])
+
+        if checkpoint is not None and state is not None:
+            # The committed chunks are skipped
+            run.stats = state['stats']
+            run.written = run.records = checkpoint.records
+            run.writtenChunks = run.chunks = checkpoint.chunks
+            chunks = itertools.islice(chunks, checkpoint.chunks, None)
+            logging.getLogger('FAST').info('resuming after record ' + str(checkpoint.records))
+        elif checkpoint is not None:
+            commit()
+        committed = run.written
+        if spatialWindow:
+            chunks = spatialChunks(chunks, lambda cells: spatialKeys(cells, fieldnames, fields, grids[0]), spatialWindow)
+        else:
+            chunks = ((cells, None) for cells in chunks)
+        if pipeline:
+            stages = udf_pipeline.pipeline(chunks, [run.sample, run.compute])
+        else:
+            stages = map(run.compute, map(run.sample, chunks))
+        for item in stages:
+            run.write(item)
+            if checkpoint is not None and run.written - committed >= checkpointRecords:
+                commit()
+                committed = run.written
+        if checkpoint is not None and run.written > committed:
+            commit()
+        for f in files:
+            f.close()
+        while sortedFiles:
+            sortedFiles.pop(0).close()
+        if checkpoint is not None:
+            checkpoint.close()
+    finally:
+        if pipeline and stages is not None:
+            stages.close()
+        for f in files:
+            if isinstance(f, udf_checkpoint.BatchFiles):
+                f.discard()
+            else:
+                f.close()
+        for sortedFile in sortedFiles:
+            sortedFile.discard()
+        for grid in grids:
+            grid.close()
+    return run.stats
@@ -0,0 +1,202 @@
+"""
+    Hazus - Flood UDF uncertainty ensembles
+    ~~~~~
+
+    Loss distributions of a UDF inventory rather than point estimates. Every
+    building is computed for a number of realizations of the flood depth, its
+    first floor height and its damage ratios, drawn at random around their
+    inventory and grid values. The realizations of a chunk of buildings are
+    computed in one batched pass of the columnar engine, and chunks hold a
+    bounded number of (building, realization) pairs so memory does not grow
+    with the number of realizations.
+
+    The damage functions are not perturbed ordinate by ordinate: a realization
+    of a building scales the building, content and inventory damage ratios
+    interpolated from the unperturbed functions by one factor. This treats the
+    errors of all the ordinates of the three functions as fully correlated, and
+    leaves the shape of the functions as tabulated.
+
+    :copyright: © 2019 by FEMA's Natural Hazards and Risk Assesment Program.
+    :license: cc, see LICENSE for more details.
+"""
+
+import logging
+
+import numpy as np
+import pandas as pd
+
+from . import udf_engine, udf_frame, udf_summary, udf_sweep
+from .damage_functions import DamageFunctionLibrary
+from .depth_grid import DEFAULT_MAX_MEMORY
+
+LOSS_FIELDS = udf_sweep.LOSS_FIELDS
+
+# Default standard deviations of the perturbations: feet of flood depth and of first floor
+# height, and the coefficient of variation of the damage ratios
+DEPTH_STD = 0.5
+FFH_STD = 0.5
+DDF_STD = 0.2
+
+DEFAULT_PERCENTILES = [5, 50, 95]
+
+
+class Perturbations():
+    """Random perturbations of an ensemble, drawn reproducibly from a seed
+
+    Keyword Arguments:
+        seed: int -- the seed; the same seed gives the same realizations
+        depthStd: float -- standard deviation in feet of the flood depth of flooded buildings
+        ffhStd: float -- standard deviation in feet of the first floor height
+        ddfStd: float -- standard deviation of the factor applied to the building, content and
+            inventory damage ratios of a (building, realization) pair, one factor for all three
+
+    Notes: Every perturbation has a random stream of its own, and the draws of the chunks follow each
+        other in inventory order, so the realizations of a building do not depend on the chunk size.
+    """
+    def __init__(self, seed=0, depthStd=DEPTH_STD, ffhStd=FFH_STD, ddfStd=DDF_STD):
+        self.depthStd = depthStd
+        self.ffhStd = ffhStd
+        self.ddfStd = ddfStd
+        self.depth, self.ffh, self.ddf = [np.random.default_rng(sequence) for sequence in np.random.SeedSequence(seed).spawn(3)]
+
+    def draw(self, raw, ffh):
+        """Perturbs the depth and first floor height of (building, realization) pairs
+
+        Returns:
+            raw: numpy array -- the perturbed depth; dry buildings stay dry, a flooded building is dry
+                in the realizations where the depth falls to 0 or below
+            ffh: numpy array -- the perturbed first floor height
+            factor: numpy array -- the factor of the damage ratios of each pair, 0 or more
+        """
+        raw = raw.astype(float)
+        depth = raw + self.depth.normal(0, self.depthStd, len(raw))
+        raw = np.where(raw > 0, np.maximum(depth, 0), raw)
+        ffh = ffh + self.ffh.normal(0, self.ffhStd, len(ffh))
+        factor = np.maximum(1 + self.ddf.normal(0, self.ddfStd, len(raw)), 0)
+        return raw, ffh, factor
+
+
+def realizationLosses(attributes, raw, sampled, realizations, perturbations, fields, library, QC_Warning=False):
+    """Computes the losses of every realization of the buildings of a chunk in one batched computation
+
+    Keyword Arguments:
+        attributes: dict -- from udf_engine.prepareInventory
+        raw: numpy array -- sampled depth in the raster data type
+        sampled: numpy array -- False where the depth is not from the grid
+        realizations: int -- realizations of every building
+        perturbations: Perturbations -- the random draws
+        fields: UDFFields -- the field map
+        library: DamageFunctionLibrary -- the compiled lookup tables
+        QC_Warning: bool -- report inconsistencies between user-supplied DDFs and occupancy classes
+
+    Returns:
+        losses: dict -- LOSS_FIELDS name to (records x realizations) numpy array; NaN for the records
+            that are not processed in every realization (missing required fields, or no building DDF)
+    """
+    n = len(raw)
+    tiled = udf_sweep.repeatRecords(attributes, realizations)
+    tiledRaw, tiled['ffh'], factor = perturbations.draw(np.repeat(raw, realizations), tiled['ffh'])
+    result = udf_engine.computeDamage(tiled, tiledRaw, np.repeat(sampled, realizations), '', fields, library, QC_Warning)
+    processed = (result.status == udf_engine.STATUS_PROCESSED).reshape(n, realizations).all(axis=1)
+    losses = {}
+    for name, percent, cost in [('BldgLossUSD', 'BldgDmgPct', 'cost'), ('ContentLossUSD', 'ContDmgPct', 'ccost'),
+                                ('InventoryLossUSD', 'InvDmgPct', 'icost')]:
+        # The damage ratio of the realization stays within 0 and 1
+        damage = np.minimum(result.columns[percent] / 100 * factor, 1)
+        losses[name] = np.where(processed[:, None], (damage * tiled[cost]).reshape(n, realizations), np.nan)
+    losses['TotalLossUSD'] = losses['BldgLossUSD'] + losses['ContentLossUSD'] + losses['InventoryLossUSD']
+    return losses
+
+
+def statisticNames(percentiles):
+    """Column name suffixes of the statistics: 'mean', then 'p5', 'p50', ... for the percentiles"""
+    return ['mean'] + ['p' + format(float(percentile), 'g') for percentile in percentiles]
+
+
+def statistics(values, percentiles):
+    """The mean and percentiles of the realizations, the rows of values (records x realizations)
+
+    Returns:
+        statistics: list -- numpy arrays of the mean then of every percentile, one value per record
+    """
+    if len(values) == 0:
+        return [np.empty(0) for name in statisticNames(percentiles)]
+    with np.errstate(invalid='ignore'):
+        return [values.mean(axis=1)] + list(np.percentile(values, percentiles, axis=1))
+
+
+def ensembleLosses(inventory, depthGrid, fmap, library, realizations=1000, seed=0, depthStd=DEPTH_STD, ffhStd=FFH_STD,
+                   ddfStd=DDF_STD, percentiles=DEFAULT_PERCENTILES, QC_Warning=False, chunkSize=udf_engine.DEFAULT_CHUNK_SIZE,
+                   maxMemory=DEFAULT_MAX_MEMORY):
+    """Computes the loss distribution of every building, and of the inventory, for one depth grid
+
+    Keyword Arguments:
+        inventory: str -- the UDF inventory csv or vector file (GeoPackage, Shapefile, GeoParquet), or a
+            DataFrame or pyarrow Table
+        depthGrid: str -- the depth grid, as a path, an open gdal Dataset, a DepthGrid or an ArrayDepthGrid
+        fmap: FieldMap -- the FAST field map, or a list or dict
+        library: DamageFunctionLibrary -- the compiled lookup tables, or the folder of the lookup tables
+        realizations: int -- realizations of every building
+        seed: int -- seed of the random draws (see Perturbations)
+        depthStd: float -- standard deviation in feet of the flood depth
+        ffhStd: float -- standard deviation in feet of the first floor height
+        ddfStd: float -- standard deviation of the factor of the damage ratios
+        percentiles: list -- percentiles reported with the mean
+        QC_Warning: bool -- report informative inconsistency observations
+        chunkSize: int -- number of (building, realization) pairs computed at once
+        maxMemory: int -- ceiling in bytes of the depth grid blocks kept in memory
+
+    Returns:
+        buildings: DataFrame -- the UserDefinedFltyId of every building, in inventory order, then for
+            every LOSS_FIELDS name its mean and percentiles (e.g. TotalLossUSD_mean, TotalLossUSD_p95);
+            NaN for the buildings without losses
+        aggregate: DataFrame -- Level, Group and the same columns for the sum of the losses of the
+            buildings, for the inventory (Level 'Grid') and by occupancy class and census geography
+            as the summary table (udf_summary)
+    """
+    fields = udf_engine.UDFFields(fmap)
+    if not isinstance(library, DamageFunctionLibrary):
+        library = DamageFunctionLibrary(library)
+    fieldnames, chunks = udf_sweep.inventoryChunks(inventory, max(1, chunkSize // max(1, realizations)), fields)
+    missing = [name for name in fields.required if name not in fieldnames]
+    if missing:
+        raise KeyError('Inventory fields not found: ' + ', '.join(missing))
+    perturbations = Perturbations(seed, depthStd, ffhStd, ddfStd)
+    names = [name + '_' + statistic for name in LOSS_FIELDS for statistic in statisticNames(percentiles)]
+    # The aggregate losses of every realization, LOSS_FIELDS after each other
+    totals = udf_summary.GroupTotals(list(range(len(LOSS_FIELDS) * realizations)))
+
+    grids, gridNames, opened = udf_frame._openGrids([depthGrid], maxMemory)
+    ids = []
+    parts = []
+    records = 0
+    try:
+        for cells in chunks:
+            attributes = udf_engine.prepareInventory(cells, fieldnames, fields, library)
+            raw, sampled = grids[0].sample(attributes['lat'], attributes['lon'])
+            losses = realizationLosses(attributes, raw, sampled, realizations, perturbations, fields, library, QC_Warning)
+            ids.append(cells[:, fieldnames.index(fields.UserDefinedFltyId)])
+            parts.append(np.column_stack([values for name in LOSS_FIELDS for values in statistics(losses[name], percentiles)])
+                         if len(cells) else np.empty((0, len(names))))
+            rows = ~np.isnan(losses['TotalLossUSD'][:, 0])
+            groups = {'OccupancyClass': attributes['OC'][rows]}
+            for level in ['CensusTract', 'CensusBlock']:
+                if level in attributes:
+                    groups[level] = attributes[level][rows]
+            totals.add(dict(enumerate(np.hstack([losses[name][rows] for name in LOSS_FIELDS]).T)), groups)
+            records += len(cells)
+            logging.getLogger('FAST').info('processing record ' + str(records))
+    finally:
+        for grid in opened:
+            grid.close()
+
+    buildings = pd.DataFrame(np.concatenate(parts) if parts else np.empty((0, len(names))), columns=names)
+    buildings.insert(0, fields.UserDefinedFltyId, np.concatenate(ids) if ids else np.empty(0, dtype=object))
+    rows = totals.rows()
+    # (groups x realizations) sums of every loss field
+    sums = np.array([total for level, group, total in rows]).reshape(len(rows), len(LOSS_FIELDS), realizations)
+    aggregate = pd.DataFrame({'Level': [row[0] for row in rows], 'Group': [row[1] for row in rows]})
+    for i, name in enumerate(LOSS_FIELDS):
+        for statistic, values in zip(statisticNames(percentiles), statistics(sums[:, i], percentiles)):
+            aggregate[name + '_' + statistic] = values
+    return buildings, aggregate
@@ -0,0 +1,147 @@
+"""
+    Hazus - Flood UDF in memory
+    ~~~~~
+
+    Runs a UDF inventory held in a pandas DataFrame (or an Arrow table) against
+    depth grids given as paths, open datasets or arrays, and returns the results
+    as DataFrames, without files. The records are processed by the same
+    columnar engine as the csv inventories, chunk by chunk.
+
+    :copyright: © 2019 by FEMA's Natural Hazards and Risk Assesment Program.
+    :license: cc, see LICENSE for more details.
+"""
+
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+from . import udf_engine
+from .damage_functions import DamageFunctionLibrary
+from .depth_grid import DEFAULT_MAX_MEMORY, DepthGrid, PointCache
+
+
+def frameCells(frame):
+    """The cells of an inventory frame as the text a csv of it holds, '' for missing values
+
+    Returns:
+        cells: numpy array -- (records x fields) object array of the cell text, as udf_engine.readInventory
+    """
+    cells = np.empty(frame.shape, dtype=object)
+    for i in range(frame.shape[1]):
+        codes, uniques = pd.factorize(frame.iloc[:, i].to_numpy(dtype=object))
+        cells[:, i] = udf_engine._objects([value if isinstance(value, str) else str(value) for value in uniques] + [''])[codes]
+    return cells
+
+
+def _resultValues(result, key, old=None):
+    """The results of attribute key, missing (NaN, None or NA) for the records they do not include
+
+    Notes: Results that replace an inventory field of the same name (old) keep its text for the
+        records they do not include, so they are text like the field of a csv inventory.
+    """
+    values = result.columns[key]
+    mask = udf_engine._resultMask(result, key)
+    if old is not None:
+        return np.where(mask, udf_engine._text(values, result.integral.get(key)), old)
+    if values.dtype == object:
+        # object columns hold text, None and integer ids
+        codes, uniques = pd.factorize(values)
+        return np.where(mask, udf_engine._objects([str(value) for value in uniques] + [None])[codes], None)
+    if values.dtype.kind == 'f':
+        return np.where(mask, values, np.nan).astype(values.dtype)
+    return pd.arrays.IntegerArray(values, ~mask)
+
+
+def _openGrids(depthGrids, maxMemory):
+    """Opens the depth grids given as a list or a dict of name to grid; returns grids, names and the grids opened here"""
+    items = list(depthGrids.items()) if isinstance(depthGrids, dict) else [(None, grid) for grid in depthGrids]
+    grids, names, opened = [], [], []
+    try:
+        for name, grid in items:
+            if not isinstance(grid, DepthGrid):
+                grid = DepthGrid(grid, maxMemory // max(1, len(items)))
+                opened.append(grid)
+            grids.append(grid)
+            names.append(name if name is not None else os.path.split(grid.path)[1])
+    except Exception:
+        for grid in opened:
+            grid.close()
+        raise
+    return grids, names, opened
+
+
+def damageFrame(inventory, depthGrids, fmap, library, QC_Warning=False, chunkSize=udf_engine.DEFAULT_CHUNK_SIZE,
+                maxMemory=DEFAULT_MAX_MEMORY, wide=False):
+    """Runs an inventory frame against depth grids
+
+    Keyword Arguments:
+        inventory: DataFrame -- the UDF inventory, or a pyarrow Table
+        depthGrids: list -- depth grids as paths, open gdal Datasets, DepthGrids or ArrayDepthGrids; or a
+            dict of grid name (recorded in GridName) to depth grid
+        fmap: FieldMap -- the FAST field map, or a list or dict
+        library: DamageFunctionLibrary -- the compiled lookup tables, or the folder of the lookup tables
+        QC_Warning: bool -- report informative inconsistency observations
+        chunkSize: int -- number of records processed at once
+        maxMemory: int -- ceiling in bytes of the blocks kept in memory of the grids opened here
+        wide: bool -- return one frame with the columns of every grid suffixed with the grid name
+
+    Returns:
+        results: dict -- grid name to the results frame of the grid; with wide, the wide results frame.
+            Frames have the inventory columns and index, then the output attributes: floats with NaN,
+            nullable integers and text with None where the csv cells are empty.
+
+    Notes: Grids given as DepthGrids stay open; the others are opened and closed here.
+    """
+    if not isinstance(inventory, pd.DataFrame):
+        inventory = inventory.to_pandas()
+    fields = udf_engine.UDFFields(fmap)
+    if not isinstance(library, DamageFunctionLibrary):
+        library = DamageFunctionLibrary(library)
+    fieldnames = [str(name) for name in inventory.columns]
+    missing = [name for name in fields.required if name not in fieldnames]
+    if missing:
+        raise KeyError('Inventory fields not found: ' + ', '.join(missing))
+
+    replaced = [name for name in fieldnames if name in fields.output.values()]
+    grids, names, opened = _openGrids(depthGrids, maxMemory)
+    try:
+        suffixes = [udf_engine.gridSuffix(name) for name in names]
+        chunks = [[] for name in ([None] if wide else names)]
+        # An empty inventory still runs one (empty) chunk, for the columns of the results
+        for index, start in enumerate(range(0, max(1, len(inventory)), chunkSize)):
+            frame = inventory.iloc[start:start + chunkSize]
+            cells = frameCells(frame)
+            attributes = udf_engine.prepareInventory(cells, fieldnames, fields, library)
+            old = dict((name, cells[:, i]) for i, name in enumerate(fieldnames) if name in replaced)
+            cache = PointCache()
+            results = []
+            for i, grid in enumerate(grids):
+                raw, sampled = grid.sample(attributes['lat'], attributes['lon'], cache, index)
+                results.append(udf_engine.computeDamage(attributes, raw, sampled, names[i], fields, library, QC_Warning))
+            if wide:
+                columns = dict((fields.output[key], _resultValues(results[0], key, old.get(fields.output[key])))
+                               for key in udf_engine.SHARED_FIELDS)
+                for result, suffix in zip(results, suffixes):
+                    columns.update((key + '_' + suffix, _resultValues(result, key)) for key in udf_engine.GRID_FIELDS)
+                chunks[0].append(pd.DataFrame(columns, index=frame.index))
+            else:
+                for i, result in enumerate(results):
+                    columns = dict((fields.output[key], _resultValues(result, key, old.get(fields.output[key])))
+                                   for key in udf_engine.NEW_FIELDS)
+                    chunks[i].append(pd.DataFrame(columns, index=frame.index))
+            logging.getLogger('FAST').info('processing record ' + str(start + len(frame)))
+    finally:
+        for grid in opened:
+            grid.close()
+
+    frames = []
+    for parts in chunks:
+        out = inventory.copy(deep=False)
+        if parts:
+            results = pd.concat(parts)
+            for name in results.columns:
+                out[name] = results[name].array
+        frames.append(out)
+    return frames[0] if wide else dict(zip(names, frames))
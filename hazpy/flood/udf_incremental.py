@@ -0,0 +1,310 @@
+"""
+    Hazus - Flood UDF incremental runs
+    ~~~~~
+
+    Reruns an inventory against its depth grids, recomputing only the records
+    that are new or changed since the last run. The results of every record are
+    kept in a store folder next to the results: a 64 bit hash of the cells of
+    every inventory record, and for every grid the text each record was written
+    with and the values it added to the counts and summary totals. A record whose
+    hash is in the store is taken from it, the others are computed, and the
+    results files are written in inventory order as a full run writes them.
+    Results of a grid that changed, or of a store made with another field map,
+    inventory header or lookup table version, are not reused.
+
+    :copyright: © 2019 by FEMA's Natural Hazards and Risk Assesment Program.
+    :license: cc, see LICENSE for more details.
+"""
+
+import csv
+import json
+import logging
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from . import grid_cache, udf_engine, udf_output, udf_summary
+from .depth_grid import DEFAULT_MAX_MEMORY, DepthGrid, PointCache, SamplingPlan
+
+# Files of a store folder
+INDEX = 'index.json'
+HASHES = 'hashes.npy'
+
+# Stored columns of the records of a grid, besides their udf_engine.recordStats: the text of the
+# record in the results csv and the sorted copy (null when it is the same) and its Depth_in_Struc
+RECORD_FIELDS = ['row', 'sortedRow', 'key']
+
+
+def rowHashes(cells):
+    """A 64 bit hash of the cells of every inventory record
+
+    Notes: Records with the same cells have the same hash, wherever they are in the inventory.
+        A changed record is taken for an unchanged one only on a hash collision, about one in 2**64.
+    """
+    hashes = np.zeros(len(cells), dtype=np.uint64)
+    for i in range(cells.shape[1]):
+        column = cells[:, i]
+        hashed = pd.util.hash_array(column, categorize=False)
+        # Cells missing from short records are hashed apart from the text 'None'
+        hashed[column == None] = np.iinfo(np.uint64).max
+        hashes = hashes * np.uint64(1000003) ^ hashed
+    return hashes
+
+
+def gridIdentity(path, grid):
+    """The identity of the results of a depth grid: its path, and a key of the files of the DepthGrid it is read from"""
+    return [os.path.abspath(path), grid_cache.cacheKey(grid.path, grid_cache.sourceFiles(grid.dataset))]
+
+
+def recordColumns(attributes, result, rows, sortedRows, keys):
+    """The stored columns of the records of a chunk (RECORD_FIELDS and udf_engine.recordStats)
+
+    Keyword Arguments:
+        attributes: dict -- from udf_engine.prepareInventory
+        result: UDFResult -- the results of the chunk
+        rows, sortedRows, keys: -- the records from udf_engine.formatResults with sort
+    """
+    columns = {
+        'row': udf_engine._objects(rows),
+        'sortedRow': udf_engine._objects([None if sortedRow == row else sortedRow for row, sortedRow in zip(rows, sortedRows)]),
+        'key': keys
+    }
+    columns.update(udf_engine.recordStats(attributes, result))
+    return columns
+
+
+def _merge(n, computed, columns, reused, stored):
+    """The stored columns of a chunk from those of its computed and reused records"""
+    if len(reused) == 0:
+        return columns
+    if len(computed) == 0:
+        return stored
+    merged = {}
+    for name, values in columns.items():
+        merged[name] = np.empty(n, dtype=values.dtype)
+        merged[name][computed] = values
+        merged[name][reused] = stored[name]
+    return merged
+
+
+class ResultStore():
+    """The results of every record of the last run of an inventory, kept in a folder
+
+    Keyword Arguments:
+        folder: str -- the store folder; created by close
+        identity: dict -- what the results depend on besides the grids (inventory header, field map,
+            lookup table version), as json values; a store of another identity is not used
+        grids: list -- the gridIdentity of every depth grid of the run
+
+    Notes: The folder holds an index (json) of the identity and grids, the hash of every record of
+        the inventory (numpy) and a file of the stored columns of every grid (Arrow IPC). The new
+        store is written next to the folder and replaces it on close, so a run that stops partway
+        leaves the store of the last completed run.
+
+        store = ResultStore(folder, identity, grids)
+        positions = store.lookup(hashes)
+        ... for every grid, stored columns of the records found and the chunk's columns:
+        store.stored(i, positions[found])
+        store.write(i, columns)
+        store.append(hashes)
+        store.close()
+    """
+    def __init__(self, folder, identity, grids):
+        self.folder = folder
+        self.identity = json.loads(json.dumps(identity))
+        self.grids = json.loads(json.dumps(grids))
+        self.tables = [None] * len(grids)
+        self.hashes = np.zeros(0, dtype=np.uint64)
+        index = self._load()
+        if index is not None:
+            self.hashes = np.load(os.path.join(folder, HASHES))
+            for i, grid in enumerate(self.grids):
+                if grid in index['grids']:
+                    self.tables[i] = _readTable(os.path.join(folder, 'grid' + str(index['grids'].index(grid)) + '.arrow'))
+        self.order = np.argsort(self.hashes, kind='stable')
+        self.sortedHashes = self.hashes[self.order]
+        self.partial = folder + '.partial'
+        shutil.rmtree(self.partial, ignore_errors=True)
+        os.makedirs(self.partial)
+        self.files = [udf_output.ArrowResults(os.path.join(self.partial, 'grid' + str(i) + '.arrow'), 'arrow', RECORD_FIELDS)
+                      for i in range(len(grids))]
+        self.newHashes = []
+        self.closed = False
+
+    def _load(self):
+        try:
+            with open(os.path.join(self.folder, INDEX)) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return index if index.get('identity') == self.identity else None
+
+    def reusable(self, i):
+        """True if the results of grid i of the last run still hold"""
+        return self.tables[i] is not None
+
+    def lookup(self, hashes):
+        """The record of the last run with every hash, -1 for new or changed records"""
+        if len(self.sortedHashes) == 0:
+            return np.full(len(hashes), -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.sortedHashes, hashes), len(self.sortedHashes) - 1)
+        return np.where(self.sortedHashes[positions] == hashes, self.order[positions], -1)
+
+    def stored(self, i, positions):
+        """The stored columns of grid i of the records of the last run at positions"""
+        table = self.tables[i].take(positions)
+        return dict((name, table.column(name).to_numpy()) for name in table.column_names)
+
+    def write(self, i, columns):
+        """Stores the columns of the records of a chunk for grid i"""
+        import pyarrow as pa
+        arrays = dict((name, pa.array(values, type=pa.string()) if values.dtype == object else pa.array(values))
+                      for name, values in columns.items())
+        self.files[i].write(udf_output.recordBatch(arrays))
+
+    def append(self, hashes):
+        """Stores the hashes of the records of a chunk"""
+        self.newHashes.append(hashes)
+
+    def close(self):
+        """Replaces the store with the results of this run"""
+        if self.closed:
+            return
+        self.closed = True
+        for f in self.files:
+            f.close()
+        np.save(os.path.join(self.partial, HASHES), np.concatenate(self.newHashes) if self.newHashes else np.zeros(0, dtype=np.uint64))
+        with open(os.path.join(self.partial, INDEX), 'w') as f:
+            json.dump({'identity': self.identity, 'grids': self.grids}, f, indent=1)
+        # The memory-mapped tables of the last run are released before the folder is removed
+        self.tables = [None] * len(self.grids)
+        shutil.rmtree(self.folder, ignore_errors=True)
+        os.replace(self.partial, self.folder)
+
+    def discard(self):
+        """Stops without replacing the store"""
+        if self.closed:
+            return
+        self.closed = True
+        for f in self.files:
+            f.close()
+        shutil.rmtree(self.partial, ignore_errors=True)
+
+
+def _readTable(path):
+    import pyarrow as pa
+    return pa.ipc.open_file(pa.memory_map(path)).read_all()
+
+
+def _take(columns, positions):
+    return dict((name, values[positions]) for name, values in columns.items())
+
+
+def runGridsIncremental(UDFOrig, depthGrids, outputPaths, fields, library, storeDir, QC_Warning=False,
+                        chunkSize=udf_engine.DEFAULT_CHUNK_SIZE, maxMemory=DEFAULT_MAX_MEMORY, sortedPaths=None,
+                        runRecords=udf_output.DEFAULT_RUN_RECORDS, summary=False, gridFiles=None, planDir=None):
+    """Runs the inventory against several depth grids like udf_engine.runGrids, recomputing only the
+    records that are new or changed since the last run
+
+    Keyword Arguments:
+        UDFOrig: str -- the UDF inventory csv
+        depthGrids: list -- the depth grids
+        outputPaths: list -- the results csv of every grid
+        fields: UDFFields -- the field map
+        library: DamageFunctionLibrary -- the compiled lookup tables
+        storeDir: str -- the ResultStore folder of the inventory, replaced with the results of this run
+        QC_Warning: bool -- report informative inconsistency observations of the records computed
+        chunkSize: int -- number of records processed at once
+        maxMemory: int -- ceiling in bytes of the depth grid blocks kept in memory, shared by the grids
+        sortedPaths: list -- optional; the copy of every results csv sorted on Depth_in_Struc
+        runRecords: int -- records of a sorted copy kept in memory before they are sorted to a run file
+        summary: bool -- total the results for the summary table (udf_summary)
+        gridFiles: dict -- optional; the file a depth grid is read from, such as its grid_cache copy
+        planDir: str -- optional; the folder of the SamplingPlans of the records computed
+
+    Returns:
+        stats: list -- as udf_engine.runGrids
+
+    Notes: The results files, counts and summary totals are those of a full run. Records are
+        matched on the hash of their cells (rowHashes), so moved records are reused too. A grid is
+        reused when its path and files are those of the last run, wherever it is in depthGrids.
+        Only the records computed are reported by QC_Warning and the unmatched SOID messages.
+    """
+    grids = []
+    files = []
+    sortedFiles = []
+    store = None
+    plan = SamplingPlan(planDir) if planDir is not None else None
+    logger = logging.getLogger('FAST')
+    try:
+        for dgp in depthGrids:
+            grids.append(DepthGrid((gridFiles or {}).get(dgp, dgp), maxMemory // max(1, len(depthGrids))))
+            # Reported for every grid, as by the row engine: incremental runs are flood_damage runs
+            print('Is it UTM? ', grids[-1].isUTM)
+        gridNames = [os.path.split(dgp)[1] for dgp in depthGrids]
+        fieldnames, chunks = udf_engine.readInventory(UDFOrig, chunkSize, fields)
+        header = fields.header(fieldnames)
+        for outputPath in outputPaths:
+            f = open(outputPath, 'w')
+            csv.writer(f, delimiter=',', lineterminator='\n').writerow(header)
+            files.append(f)
+        for sortedPath in sortedPaths or []:
+            sortedFiles.append(udf_output.SortedResults(sortedPath, header, runRecords))
+        identity = {'fieldnames': fieldnames, 'fields': list(fields.fmap), 'library': library.version}
+        store = ResultStore(storeDir, identity, [gridIdentity(dgp, grid) for dgp, grid in zip(depthGrids, grids)])
+        stats = [{'records': 0, 'flooded': 0, 'invalidSOID': 0, 'unmatched': [],
+                  'summary': udf_summary.GroupTotals() if summary else None} for grid in grids]
+        records = 0
+        recomputed = 0
+        for cells in chunks:
+            n = len(cells)
+            hashes = rowHashes(cells)
+            positions = store.lookup(hashes)
+            need = [np.ones(n, dtype=bool) if not store.reusable(i) else positions < 0 for i in range(len(grids))]
+            # Grid-independent attributes of the records computed for any grid
+            rows = np.flatnonzero(np.logical_or.reduce(need))
+            if len(rows):
+                attributes = udf_engine.prepareInventory(cells[rows], fieldnames, fields, library)
+                inventory = udf_engine.inventoryText(cells[rows], fieldnames)
+            for i, grid in enumerate(grids):
+                computed = np.flatnonzero(need[i])
+                reused = np.flatnonzero(~need[i])
+                columns = {}
+                if len(computed):
+                    local = np.searchsorted(rows, computed)
+                    gridAttributes = _take(attributes, local)
+                    raw, sampled = grid.sample(gridAttributes['lat'], gridAttributes['lon'], PointCache(plan))
+                    result = udf_engine.computeDamage(gridAttributes, raw, sampled, gridNames[i], fields, library, QC_Warning)
+                    text, (sortedText, keys) = udf_engine.formatResults(_take(inventory, local), fieldnames, fields, result, True)
+                    columns = recordColumns(gridAttributes, result, text, sortedText, keys)
+                stored = store.stored(i, positions[reused]) if len(reused) else {}
+                columns = _merge(n, computed, columns, reused, stored)
+                text = columns['row'].tolist()
+                udf_engine.writeRows(files[i], text)
+                if sortedFiles:
+                    sortedText = [row if sortedRow is None else sortedRow for row, sortedRow in zip(text, columns['sortedRow'].tolist())]
+                    sortedFiles[i].append(sortedText, columns['key'])
+                udf_engine.addStats(stats[i], udf_engine.totalStats(columns, summary))
+                store.write(i, columns)
+            store.append(hashes)
+            records += n
+            recomputed += len(rows)
+            logger.info('processing record ' + str(records))
+        logger.info('recomputed ' + str(recomputed) + ' of ' + str(records) + ' records')
+        for f in files:
+            f.close()
+        while sortedFiles:
+            sortedFiles.pop(0).close()
+        store.close()
+    finally:
+        for f in files:
+            f.close()
+        for sortedFile in sortedFiles:
+            sortedFile.discard()
+        if store is not None:
+            store.discard()
+        for grid in grids:
+            grid.close()
+    return stats
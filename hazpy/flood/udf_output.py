@@ -0,0 +1,267 @@
+"""
+    Hazus - Flood UDF output writers
+    ~~~~~
+
+    Writers of the UDF results beyond the results csv itself. SortedResults builds the
+    copy of a results csv sorted on Depth_in_Struc while the results are written, with
+    an external merge sort whose memory is bounded by a number of records. ArrowResults
+    writes typed results to Parquet or Arrow IPC files, one row group per chunk.
+
+    :copyright: © 2019 by FEMA's Natural Hazards and Risk Assesment Program.
+    :license: cc, see LICENSE for more details.
+"""
+
+import csv
+import heapq
+import os
+import pickle
+import shutil
+import tempfile
+
+import numpy as np
+
+# File extension of the results of every output format
+OUTPUT_FORMATS = {'csv': '.csv', 'parquet': '.parquet', 'arrow': '.arrow'}
+
+# Records sorted in memory before they are written to a run file
+DEFAULT_RUN_RECORDS = 250000
+
+# Records per pickled batch of a run file, and per write of the merged output
+BATCH_RECORDS = 10000
+
+# Run files merged at once; more runs are merged in several passes
+MAX_OPEN_RUNS = 64
+
+
+def writeRun(path, rows, keys):
+    """Writes records to a run file, sorted on their keys, largest first
+
+    Keyword Arguments:
+        path: str -- the run file
+        rows: list -- csv text of the records
+        keys: numpy array -- sort key (Depth_in_Struc) of the records
+
+    Notes: Records with the same key keep their order, as sorted(..., reverse=True) does.
+    """
+    order = np.argsort(-keys, kind='stable')
+    negated = (-keys[order]).tolist()
+    rows = [rows[i] for i in order.tolist()]
+    with open(path, 'wb') as f:
+        for start in range(0, len(rows), BATCH_RECORDS):
+            pickle.dump((negated[start:start + BATCH_RECORDS], rows[start:start + BATCH_RECORDS]), f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+
+
+class RunFile():
+    """Records added like to SortedResults, written to a single run file on close
+
+    Keyword Arguments:
+        path: str -- the run file, later added to a SortedResults with addRun
+    """
+    def __init__(self, path):
+        self.path = path
+        self.rows = []
+        self.keys = []
+
+    def append(self, rows, keys):
+        self.rows.extend(rows)
+        self.keys.append(np.asarray(keys, dtype=float))
+
+    def close(self):
+        writeRun(self.path, self.rows, np.concatenate(self.keys) if self.keys else np.empty(0))
+        self.rows, self.keys = [], []
+
+
+def _readRun(path):
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                keys, rows = pickle.load(f)
+            except EOFError:
+                return
+            for item in zip(keys, rows):
+                yield item
+
+
+def _merge(paths):
+    """Merges run files; records with equal keys come from the earlier run first"""
+    return heapq.merge(*[_readRun(path) for path in paths], key=lambda item: item[0])
+
+
+class SortedResults():
+    """Writes the copy of a results csv sorted on Depth_in_Struc, deepest first
+
+    Keyword Arguments:
+        path: str -- the sorted csv
+        header: list -- the results header
+        runRecords: int -- records sorted in memory before they are written to a run file
+        folder: str -- where run files are written; a temporary folder next to path by default
+
+    Notes: The records are those of the results csv in their original order. The output is the
+        one of the csv.DictReader/sorted/csv.DictWriter copy the results were sorted with before:
+        ties keep their order and lines end with '\\r\\n'.
+
+        sortedResults = SortedResults(path, header)
+        sortedResults.append(rows, keys)
+        sortedResults.close()
+    """
+    def __init__(self, path, header, runRecords=DEFAULT_RUN_RECORDS, folder=None):
+        self.path = path
+        self.header = header
+        self.runRecords = runRecords
+        self.folder = folder
+        self.ownFolder = False
+        self.runs = []
+        self.runFiles = 0
+        self.rows = []
+        self.keys = []
+        self.buffered = 0
+
+    def _runPath(self):
+        if self.folder is None:
+            self.folder = tempfile.mkdtemp(prefix='udf_sort_', dir=os.path.dirname(os.path.abspath(self.path)))
+            self.ownFolder = True
+        self.runFiles += 1
+        return os.path.join(self.folder, 'sorted' + str(self.runFiles) + '.run')
+
+    def append(self, rows, keys):
+        """Adds records, given as csv text (without line ending) and their Depth_in_Struc"""
+        self.rows.extend(rows)
+        self.keys.append(np.asarray(keys, dtype=float))
+        self.buffered += len(rows)
+        if self.buffered >= self.runRecords:
+            self._spill()
+
+    def addRun(self, path):
+        """Adds records already written to a run file by writeRun; runs are taken in the order added"""
+        self.runs.append(path)
+
+    def spill(self):
+        """Writes the records added so far to a run file, e.g. before a checkpoint commit"""
+        self._spill()
+
+    def _spill(self):
+        if self.buffered:
+            path = self._runPath()
+            writeRun(path, self.rows, np.concatenate(self.keys))
+            self.runs.append(path)
+        self.rows, self.keys, self.buffered = [], [], 0
+
+    def discard(self):
+        """Drops the records and run files without writing the sorted csv"""
+        self.rows, self.keys, self.buffered = [], [], 0
+        if self.ownFolder:
+            shutil.rmtree(self.folder, ignore_errors=True)
+            self.folder, self.ownFolder = None, False
+
+    def close(self):
+        """Merges the records and writes the sorted csv"""
+        try:
+            if self.runs:
+                self._spill()
+            with open(self.path, 'w', newline='') as f_output:
+                csv.writer(f_output, lineterminator='\r\n').writerow(self.header)
+                if self.runs:
+                    runs = self.runs
+                    while len(runs) > MAX_OPEN_RUNS:
+                        merged = []
+                        for start in range(0, len(runs), MAX_OPEN_RUNS):
+                            path = self._runPath()
+                            with open(path, 'wb') as f:
+                                batch = []
+                                for item in _merge(runs[start:start + MAX_OPEN_RUNS]):
+                                    batch.append(item)
+                                    if len(batch) == BATCH_RECORDS:
+                                        pickle.dump(tuple(zip(*batch)), f, protocol=pickle.HIGHEST_PROTOCOL)
+                                        batch = []
+                                if batch:
+                                    pickle.dump(tuple(zip(*batch)), f, protocol=pickle.HIGHEST_PROTOCOL)
+                            merged.append(path)
+                        runs = merged
+                    batch = []
+                    for item in _merge(runs):
+                        batch.append(item[1])
+                        if len(batch) == BATCH_RECORDS:
+                            f_output.write('\r\n'.join(batch) + '\r\n')
+                            batch = []
+                    if batch:
+                        f_output.write('\r\n'.join(batch) + '\r\n')
+                elif self.buffered:
+                    keys = np.concatenate(self.keys)
+                    order = np.argsort(-keys, kind='stable')
+                    f_output.write('\r\n'.join([self.rows[i] for i in order.tolist()]) + '\r\n')
+        finally:
+            self.discard()
+
+
+def recordBatch(arrays):
+    """A pyarrow RecordBatch of a dict of column name to pyarrow array"""
+    import pyarrow as pa
+    return pa.RecordBatch.from_arrays(list(arrays.values()), names=list(arrays))
+
+
+def saveBatch(path, batch):
+    """Writes a RecordBatch to an Arrow IPC stream file"""
+    import pyarrow as pa
+    with pa.OSFile(path, 'wb') as sink:
+        with pa.ipc.new_stream(sink, batch.schema) as writer:
+            writer.write_batch(batch)
+
+
+def loadBatch(path):
+    """Reads a RecordBatch written by saveBatch, memory-mapping the file"""
+    import pyarrow as pa
+    return pa.ipc.open_stream(pa.memory_map(path)).read_next_batch()
+
+
+class ArrowResults():
+    """Writes UDF results to a Parquet or Arrow IPC file, streamed one row group per chunk
+
+    Keyword Arguments:
+        path: str -- the results file
+        format: str -- 'parquet' or 'arrow' (the Arrow IPC file format, also known as Feather V2)
+        header: list -- the results header, the text columns of a file without records
+
+    Notes: Requires pyarrow. The schema is the one of the first chunk: inventory fields are text,
+        the output attributes are typed, with nulls where the csv cells are empty.
+
+        arrowResults = ArrowResults(path, 'parquet', header)
+        arrowResults.write(recordBatch(udf_engine.resultArrays(inventory, fields, result)))
+        arrowResults.close()
+    """
+    def __init__(self, path, format, header):
+        if format not in ['parquet', 'arrow']:
+            raise ValueError('Unknown results format: ' + str(format))
+        self.path = path
+        self.format = format
+        self.header = header
+        self.writer = None
+        self.closed = False
+
+    def _open(self, schema):
+        import pyarrow as pa
+        if self.format == 'parquet':
+            import pyarrow.parquet as pq
+            self.writer = pq.ParquetWriter(self.path, schema)
+        else:
+            self.writer = pa.ipc.new_file(self.path, schema)
+
+    def write(self, batch):
+        """Writes the records of a chunk, given as a RecordBatch, as one row group"""
+        if self.writer is None:
+            self._open(batch.schema)
+        if self.format == 'parquet':
+            self.writer.write_batch(batch, row_group_size=max(1, batch.num_rows))
+        else:
+            self.writer.write_batch(batch)
+
+    def close(self):
+        """Finishes the file; one without records has the header as text columns"""
+        if self.closed:
+            return
+        self.closed = True
+        if self.writer is None:
+            import pyarrow as pa
+            # Repeated header names are written once, as the columns of the records are
+            self._open(pa.schema([(name, pa.string()) for name in dict.fromkeys(self.header)]))
+        self.writer.close()
@@ -0,0 +1,426 @@
+"""
+    Hazus - Flood UDF process pool
+    ~~~~~
+
+    Runs a UDF inventory against its depth grids in a pool of worker
+    processes. The inventory is split into chunks of rows stored in a
+    temporary folder as memory-mapped arrays; workers compute the attributes
+    of each chunk once and then each chunk against each grid, and the results
+    are joined back in the original row order.
+
+    :copyright: © 2019 by FEMA's Natural Hazards and Risk Assesment Program.
+    :license: cc, see LICENSE for more details.
+"""
+
+import csv
+import json
+import logging
+import multiprocessing
+import os
+import pickle
+import shutil
+import tempfile
+
+import numpy as np
+
+from . import udf_checkpoint, udf_engine, udf_output, udf_summary
+from .damage_functions import DamageFunctionLibrary
+from .depth_grid import DEFAULT_MAX_MEMORY, DepthGrid, PointCache, SamplingPlan, setGDALCache
+from .footprints import zonalDepths
+
+
+def _saveColumn(path, values):
+    """Saves a column as a .npy file; object columns as codes plus their distinct values"""
+    if values.dtype != object:
+        np.save(path + '.npy', values)
+        return
+    # Values are told apart by type as well, so 0, 0.0 and False keep their own codes
+    index = {}
+    codes = np.fromiter((index.setdefault((value.__class__, value), len(index)) for value in values.tolist()),
+                        dtype=np.int64, count=len(values))
+    np.save(path + '.codes.npy', codes)
+    with open(path + '.values.pkl', 'wb') as f:
+        pickle.dump([key[1] for key in index], f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _loadColumn(path):
+    """Loads a column saved by _saveColumn, memory-mapping its arrays"""
+    if os.path.exists(path + '.npy'):
+        return np.load(path + '.npy', mmap_mode='r')
+    with open(path + '.values.pkl', 'rb') as f:
+        values = udf_engine._objects(pickle.load(f))
+    return values[np.load(path + '.codes.npy', mmap_mode='r')]
+
+
+class InventoryStore():
+    """Inventory chunks stored in a folder for worker processes
+
+    Keyword Arguments:
+        folder: str -- an empty folder for the chunk files
+
+    Notes: The main process stores the cells of each chunk. Workers add the attributes from
+        udf_engine.prepareInventory and the inventory text from udf_engine.inventoryText.
+        Numeric columns are memory-mapped when loaded, so the workers share the pages of the
+        operating system cache instead of private copies.
+    """
+    def __init__(self, folder):
+        self.folder = folder
+        self.fieldnames = []
+        self.chunks = 0
+
+    def path(self, index, group, name=''):
+        return os.path.join(self.folder, 'chunk' + str(index) + '.' + group + ('.' + str(name) if name != '' else ''))
+
+    def appendCells(self, cells):
+        """Stores the cells of the next chunk"""
+        for i in range(len(self.fieldnames)):
+            _saveColumn(self.path(self.chunks, 'cells', i), cells[:, i])
+        self.chunks += 1
+
+    def loadCells(self, index):
+        """Returns the (records x fields) cells of a chunk"""
+        columns = [_loadColumn(self.path(index, 'cells', i)) for i in range(len(self.fieldnames))]
+        cells = np.empty((len(columns[0]) if columns else 0, len(columns)), dtype=object)
+        for i, column in enumerate(columns):
+            cells[:, i] = column
+        return cells
+
+    def savePrepared(self, index, attributes, inventory):
+        """Stores the attributes and inventory text of a chunk"""
+        for key, values in attributes.items():
+            _saveColumn(self.path(index, 'attributes', key), values)
+        for i, name in enumerate(self.fieldnames):
+            _saveColumn(self.path(index, 'inventory', i), inventory[name])
+        with open(self.path(index, 'keys.json'), 'w') as f:
+            json.dump(list(attributes), f)
+
+    def loadPrepared(self, index):
+        """Returns the attributes and inventory text of a chunk"""
+        with open(self.path(index, 'keys.json')) as f:
+            keys = json.load(f)
+        attributes = dict((key, _loadColumn(self.path(index, 'attributes', key))) for key in keys)
+        inventory = dict((name, _loadColumn(self.path(index, 'inventory', i))) for i, name in enumerate(self.fieldnames))
+        return attributes, inventory
+
+    def save(self):
+        """Writes the manifest read by open"""
+        with open(os.path.join(self.folder, 'manifest.json'), 'w') as f:
+            json.dump({'fieldnames': self.fieldnames, 'chunks': self.chunks}, f)
+
+    @staticmethod
+    def open(folder):
+        with open(os.path.join(folder, 'manifest.json')) as f:
+            manifest = json.load(f)
+        store = InventoryStore(folder)
+        store.fieldnames = manifest['fieldnames']
+        store.chunks = manifest['chunks']
+        return store
+
+
+# State of a worker process, set once by _initWorker
+_worker = {}
+
+
+def _initWorker(LUT_Dir, folder, fmap, QC_Warning, maxMemory, footprints=None, zonalStatistic='max', gridFiles=None, planDir=None):
+    _worker['library'] = DamageFunctionLibrary(LUT_Dir)
+    _worker['store'] = InventoryStore.open(folder)
+    _worker['fields'] = udf_engine.UDFFields(fmap)
+    _worker['QC_Warning'] = QC_Warning
+    _worker['maxMemory'] = maxMemory
+    setGDALCache(maxMemory)
+    _worker['footprints'] = footprints
+    _worker['zonalStatistic'] = zonalStatistic
+    _worker['gridFiles'] = gridFiles or {}
+    # Pixel indices saved by one worker are loaded by the others
+    _worker['plan'] = SamplingPlan(planDir) if planDir is not None else None
+    # Depth grids are opened read-only by each worker the first time it needs them
+    _worker['grids'] = {}
+
+
+def _prepareChunk(task):
+    """Computes the grid-independent attributes of a chunk; with wide, its shared wide table columns"""
+    index, wide, format = task
+    library, store, fields = _worker['library'], _worker['store'], _worker['fields']
+    cells = store.loadCells(index)
+    attributes = udf_engine.prepareInventory(cells, store.fieldnames, fields, library)
+    inventory = udf_engine.inventoryText(cells, store.fieldnames)
+    store.savePrepared(index, attributes, inventory)
+    if wide:
+        # The shared columns of the wide table do not depend on the depth
+        dry = np.zeros(len(cells), dtype=np.float64)
+        result = udf_engine.computeDamage(attributes, dry, dry > 0, '', fields, library)
+        if format == 'csv':
+            columns = udf_engine.wideSharedText(inventory, fields, result)
+            with open(store.path(index, 'shared.pkl'), 'wb') as f:
+                pickle.dump(udf_engine.joinRows(columns, fields.wideHeader(store.fieldnames, [])), f, protocol=pickle.HIGHEST_PROTOCOL)
+        else:
+            arrays = udf_engine.wideArrays(udf_engine.inventoryArrays(cells, store.fieldnames), fields, [result], [])
+            udf_output.saveBatch(store.path(index, 'shared.arrows'), udf_output.recordBatch(arrays))
+    return len(cells)
+
+
+def _grid(dgp):
+    """The open depth grid of a worker, read from its file in gridFiles if any"""
+    if dgp not in _worker['grids']:
+        _worker['grids'][dgp] = DepthGrid(_worker['gridFiles'].get(dgp, dgp), _worker['maxMemory'])
+    return _worker['grids'][dgp]
+
+
+def _sample(grid, attributes, index, cache=None):
+    """Samples a grid at the points, or over the footprints, of the buildings of a chunk"""
+    footprints, store = _worker['footprints'], _worker['store']
+    if cache is None and _worker['plan'] is not None:
+        cache = PointCache(_worker['plan'])
+    if footprints is None:
+        return grid.sample(attributes['lat'], attributes['lon'], cache, index)
+    positions = footprints.lookup(store.loadCells(index)[:, store.fieldnames.index(_worker['fields'].UserDefinedFltyId)])
+    return zonalDepths(grid, footprints, positions, attributes['lat'], attributes['lon'], _worker['zonalStatistic'], cache, index)
+
+
+def _runChunk(task):
+    """Runs one chunk against one grid, writing its results rows, their sorted run and/or its wide table columns"""
+    index, gridIndex, dgp, rows, sort, wide, format, summary = task
+    library, store, fields = _worker['library'], _worker['store'], _worker['fields']
+    grid = _grid(dgp)
+    attributes, inventory = store.loadPrepared(index)
+    raw, sampled = _sample(grid, attributes, index)
+    result = udf_engine.computeDamage(attributes, raw, sampled, os.path.split(dgp)[1], fields, library, _worker['QC_Warning'])
+    if rows and format != 'csv':
+        inventory = udf_engine.inventoryArrays(store.loadCells(index), store.fieldnames)
+        arrays = udf_engine.resultArrays(inventory, fields, result)
+        udf_output.saveBatch(store.path(index, 'grid' + str(gridIndex) + '.arrows'), udf_output.recordBatch(arrays))
+    elif rows:
+        run = udf_output.RunFile(store.path(index, 'grid' + str(gridIndex) + '.run')) if sort else None
+        with open(store.path(index, 'grid' + str(gridIndex) + '.csv'), 'w') as file_out:
+            udf_engine.writeResults(file_out, inventory, store.fieldnames, fields, result, run)
+        if run is not None:
+            run.close()
+    if wide and format != 'csv':
+        arrays = udf_engine.wideGridArrays([result], [udf_engine.gridSuffix(dgp)])
+        udf_output.saveBatch(store.path(index, 'grid' + str(gridIndex) + '.wide.arrows'), udf_output.recordBatch(arrays))
+    elif wide:
+        columns = udf_engine.wideGridText(result, udf_engine.gridSuffix(dgp))
+        with open(store.path(index, 'grid' + str(gridIndex) + '.pkl'), 'wb') as f:
+            pickle.dump(udf_engine.joinRows(columns, list(columns)), f, protocol=pickle.HIGHEST_PROTOCOL)
+    return udf_engine.chunkStats(attributes, result, summary)
+
+
+def _aalChunk(task):
+    """Runs one chunk against every grid and writes its rows of the AAL table"""
+    index, depthGrids, weights, suffixes, detail, format, summary = task
+    library, store, fields = _worker['library'], _worker['store'], _worker['fields']
+    attributes, inventory = store.loadPrepared(index)
+    cache = PointCache(_worker['plan'])
+    results = []
+    for dgp in depthGrids:
+        raw, sampled = _sample(_grid(dgp), attributes, index, cache)
+        results.append(udf_engine.computeDamage(attributes, raw, sampled, os.path.split(dgp)[1], fields, library, _worker['QC_Warning']))
+    if format != 'csv':
+        inventory = udf_engine.inventoryArrays(store.loadCells(index), store.fieldnames)
+        arrays = udf_engine.aalArrays(inventory, fields, results, weights, suffixes, detail)
+        udf_output.saveBatch(store.path(index, 'aal.arrows'), udf_output.recordBatch(arrays))
+    else:
+        columns = udf_engine.aalText(inventory, fields, results, weights, suffixes, detail)
+        with open(store.path(index, 'aal.pkl'), 'wb') as f:
+            pickle.dump(udf_engine.joinRows(columns, fields.aalHeader(store.fieldnames, suffixes, detail)), f, protocol=pickle.HIGHEST_PROTOCOL)
+    return [udf_engine.chunkStats(attributes, result, summary) for result in results]
+
+
+def _mergeRuns(task):
+    """Merges the sorted runs of the chunks of a grid into its sorted copy"""
+    sortedPath, gridIndex, header = task
+    store = _worker['store']
+    sortedResults = udf_output.SortedResults(sortedPath, header)
+    for index in range(store.chunks):
+        sortedResults.addRun(store.path(index, 'grid' + str(gridIndex) + '.run'))
+    sortedResults.close()
+
+
+def runGridsParallel(UDFOrig, depthGrids, outputPaths, fmap, LUT_Dir, QC_Warning=False, chunkSize=udf_engine.DEFAULT_CHUNK_SIZE,
+                     maxMemory=DEFAULT_MAX_MEMORY, widePath=None, sortedPaths=None, workers=2, format='csv', summary=False,
+                     aalPath=None, returnPeriods=None, aalDetail=False, footprints=None, zonalStatistic='max', gridFiles=None,
+                     checkpointDir=None, resume=False, checkpointRecords=udf_checkpoint.DEFAULT_CHECKPOINT_RECORDS,
+                     planDir=None):
+    """Runs the inventory against one or more depth grids in a pool of worker processes
+
+    Keyword Arguments:
+        UDFOrig: str -- the UDF inventory csv
+        depthGrids: list -- the depth grids
+        outputPaths: list -- the results csv of every grid, or None to skip the per grid csvs
+        fmap: list -- the FAST field map
+        LUT_Dir: str -- folder where the lookup table libraries reside
+        QC_Warning: bool -- report informative inconsistency observations
+        chunkSize: int -- number of records processed at once, the unit of work of the workers
+        maxMemory: int -- ceiling in bytes of the depth grid blocks kept in memory, shared by the workers
+        widePath: str -- optional; a single results csv with the columns of every grid side by side
+        sortedPaths: list -- optional; the sorted copy of every results csv, merged by the workers from
+            the sorted runs of the chunks
+        workers: int -- number of worker processes
+        format: str -- 'csv', or 'parquet' or 'arrow' for typed results written by udf_output.ArrowResults
+        summary: bool -- total the results for the summary table; the workers total every chunk
+        aalPath: str -- optional; the AAL table (see udf_engine.runGrids). A worker runs a chunk against
+            every grid at once to compute its AAL.
+        returnPeriods: list -- with aalPath, the return period in years of every grid
+        aalDetail: bool -- with aalPath, also write the losses of every return period in the AAL table
+        footprints: Footprints -- optional; sample the grids over the footprints of the buildings, passed
+            to every worker
+        zonalStatistic: str -- with footprints, the statistic of the depth of a footprint
+        gridFiles: dict -- optional; the file a depth grid is read from by the workers, by depth grid
+        checkpointDir: str -- optional; keep the chunk files in this folder and commit the progress of the
+            run to it (see udf_checkpoint), instead of a temporary folder
+        resume: bool -- with checkpointDir, carry on from the last commit of an interrupted run
+        checkpointRecords: int -- with checkpointDir, records prepared or run between commits, at least
+        planDir: str -- optional; the folder of the SamplingPlans of the chunks, shared by the workers
+
+    Returns:
+        stats: list -- as udf_engine.runGrids, in the order of depthGrids
+
+    Notes: The main process only splits the inventory into chunks. Workers compute the attributes
+        of each chunk once, then every (chunk, grid) pair, writing the rows of the chunk to a
+        temporary file. The files are joined in chunk order, so the results keep the row order
+        of the inventory.
+
+        A resumed run keeps the stored inventory and the prepared chunks and (chunk, grid) results
+        of the last commit, and joins the results files again.
+
+        Windows (and macOS) start the workers with spawn, which imports the calling script in every
+        worker: a script that calls this must do so under if __name__ == '__main__':, or each worker
+        starts a pool of its own. Each worker also loads the lookup tables and opens the depth grids;
+        with fewer cores than workers the pool is slower than workers = 1.
+    """
+    fields = udf_engine.UDFFields(fmap)
+    outputDir = os.path.dirname(os.path.abspath(widePath or aalPath or outputPaths[0]))
+    aalSuffixes = [udf_engine.returnPeriodSuffix(returnPeriod) for returnPeriod in returnPeriods or []]
+    if aalPath is not None:
+        if len(aalSuffixes) != len(depthGrids):
+            raise ValueError('AAL needs the return period of every depth grid')
+        weights = udf_engine.aalWeights(returnPeriods)
+    checkpoint = None
+    state = None
+    if checkpointDir is not None:
+        identity = udf_checkpoint.runIdentity('runGridsParallel', UDFOrig, depthGrids,
+                                              (outputPaths or []) + (sortedPaths or []) + [widePath, aalPath],
+                                              fields=list(fields.fmap), format=format, chunkSize=chunkSize, summary=summary,
+                                              returnPeriods=returnPeriods, aalDetail=aalDetail,
+                                              footprints=footprints is not None, zonalStatistic=zonalStatistic)
+        checkpoint = udf_checkpoint.Checkpoint(checkpointDir, identity, resume)
+        folder = checkpoint.folder
+        state = checkpoint.state()
+    else:
+        folder = tempfile.mkdtemp(prefix='udf_', dir=outputDir)
+    pool = None
+    logger = logging.getLogger('FAST')
+    try:
+        stats = [{'records': 0, 'flooded': 0, 'invalidSOID': 0, 'unmatched': [],
+                  'summary': udf_summary.GroupTotals() if summary else None} for dgp in depthGrids]
+        # Chunks prepared and their records, and tasks run, in order
+        prepared = records = done = 0
+        if state is not None:
+            store = InventoryStore.open(folder)
+            stats, prepared, records, done = state['stats'], state['prepared'], state['records'], state['done']
+            logger.info('resuming after record ' + str(min(gridStats['records'] for gridStats in stats)))
+        else:
+            store = InventoryStore(folder)
+            store.fieldnames, chunks = udf_engine.readInventory(UDFOrig, chunkSize, fields)
+            for cells in chunks:
+                store.appendCells(cells)
+            store.save()
+
+        def commit():
+            checkpoint.commit(prepared, records, {},
+                              {'stats': stats, 'prepared': prepared, 'records': records, 'done': done},
+                              [(os.path.split(dgp)[1], gridStats['records']) for dgp, gridStats in zip(depthGrids, stats)])
+
+        if checkpoint is not None and state is None:
+            commit()
+        committed = records
+
+        gridMemory = maxMemory // max(1, workers * len(depthGrids))
+        pool = multiprocessing.Pool(workers, _initWorker, (LUT_Dir, folder, fmap, QC_Warning, gridMemory, footprints,
+                                                            zonalStatistic, gridFiles, planDir))
+        for count in pool.imap(_prepareChunk, [(index, widePath is not None, format) for index in range(prepared, store.chunks)]):
+            prepared += 1
+            records += count
+            logger.info('processing record ' + str(records))
+            if checkpoint is not None and (records - committed >= checkpointRecords or prepared == store.chunks):
+                commit()
+                committed = records
+
+        if aalPath is not None:
+            tasks = [(index, depthGrids, weights, aalSuffixes, aalDetail, format, summary) for index in range(store.chunks)]
+        else:
+            tasks = [(index, i, dgp, bool(outputPaths), bool(outputPaths and sortedPaths), widePath is not None, format, summary)
+                     for index in range(store.chunks) for i, dgp in enumerate(depthGrids)]
+        committed = sum(gridStats['records'] for gridStats in stats)
+        for task, taskStats in zip(tasks[done:], pool.imap(_aalChunk if aalPath is not None else _runChunk, tasks[done:])):
+            for i, chunkStats in enumerate(taskStats) if aalPath is not None else [(task[1], taskStats)]:
+                udf_engine.addStats(stats[i], chunkStats)
+            done += 1
+            total = sum(gridStats['records'] for gridStats in stats)
+            if checkpoint is not None and (total - committed >= checkpointRecords or done == len(tasks)):
+                commit()
+                committed = total
+
+        for i, outputPath in enumerate(outputPaths or [] if format != 'csv' else []):
+            arrowResults = udf_output.ArrowResults(outputPath, format, fields.header(store.fieldnames))
+            try:
+                for index in range(store.chunks):
+                    arrowResults.write(udf_output.loadBatch(store.path(index, 'grid' + str(i) + '.arrows')))
+            finally:
+                arrowResults.close()
+        for i, outputPath in enumerate(outputPaths or [] if format == 'csv' else []):
+            with open(outputPath, 'w') as file_out:
+                csv.writer(file_out, delimiter=',', lineterminator='\n').writerow(fields.header(store.fieldnames))
+                for index in range(store.chunks):
+                    with open(store.path(index, 'grid' + str(i) + '.csv')) as f:
+                        shutil.copyfileobj(f, file_out)
+        if outputPaths and sortedPaths:
+            header = fields.header(store.fieldnames)
+            pool.map(_mergeRuns, [(sortedPath, i, header) for i, sortedPath in enumerate(sortedPaths)], chunksize=1)
+
+        suffixes = [udf_engine.gridSuffix(dgp) for dgp in depthGrids]
+        if widePath is not None and format != 'csv':
+            arrowResults = udf_output.ArrowResults(widePath, format, fields.wideHeader(store.fieldnames, suffixes))
+            try:
+                for index in range(store.chunks):
+                    arrays = {}
+                    for name in ['shared.arrows'] + ['grid' + str(i) + '.wide.arrows' for i in range(len(depthGrids))]:
+                        batch = udf_output.loadBatch(store.path(index, name))
+                        arrays.update(zip(batch.schema.names, batch.columns))
+                    arrowResults.write(udf_output.recordBatch(arrays))
+            finally:
+                arrowResults.close()
+        elif widePath is not None:
+            with open(widePath, 'w') as file_out:
+                csv.writer(file_out, delimiter=',', lineterminator='\n').writerow(fields.wideHeader(store.fieldnames, suffixes))
+                for index in range(store.chunks):
+                    parts = []
+                    for name in ['shared.pkl'] + ['grid' + str(i) + '.pkl' for i in range(len(depthGrids))]:
+                        with open(store.path(index, name), 'rb') as f:
+                            parts.append(pickle.load(f))
+                    if parts[0]:
+                        file_out.write('\n'.join(map(','.join, zip(*parts))) + '\n')
+        if aalPath is not None and format != 'csv':
+            arrowResults = udf_output.ArrowResults(aalPath, format, fields.aalHeader(store.fieldnames, aalSuffixes, aalDetail))
+            try:
+                for index in range(store.chunks):
+                    arrowResults.write(udf_output.loadBatch(store.path(index, 'aal.arrows')))
+            finally:
+                arrowResults.close()
+        elif aalPath is not None:
+            with open(aalPath, 'w') as file_out:
+                csv.writer(file_out, delimiter=',', lineterminator='\n').writerow(fields.aalHeader(store.fieldnames, aalSuffixes, aalDetail))
+                for index in range(store.chunks):
+                    with open(store.path(index, 'aal.pkl'), 'rb') as f:
+                        rows = pickle.load(f)
+                    if rows:
+                        file_out.write('\n'.join(rows) + '\n')
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if checkpoint is None:
+            shutil.rmtree(folder, ignore_errors=True)
+    if checkpoint is not None:
+        checkpoint.close()
+    return stats
@@ -0,0 +1,113 @@
+"""
+    Hazus - Flood UDF pipeline
+    ~~~~~
+
+    Runs the stages of a UDF run in threads connected by bounded queues: the
+    inventory reader, the raster reads, the loss calculation and formatting, and
+    the results writer (the thread iterating the last stage). A stage works on one
+    chunk while the next stage works on the previous one, so disk and network
+    reads and writes overlap the calculation and the run goes at the pace of its
+    slowest stage. The queues hold a few chunks at most, which bounds memory.
+
+    :copyright: © 2019 by FEMA's Natural Hazards and Risk Assesment Program.
+    :license: cc, see LICENSE for more details.
+"""
+
+import queue
+import threading
+
+# Chunks waiting between two stages
+QUEUE_SIZE = 2
+
+# Seconds a stage waits on a full queue before it checks whether it was stopped
+POLL_INTERVAL = 0.1
+
+_ITEM = 0
+_DONE = 1
+_ERROR = 2
+
+
+class Stage():
+    """Applies function to the items of source in a thread, giving the results in order
+
+    Keyword Arguments:
+        source: iterable -- the items, an inventory reader or the previous Stage
+        function: callable -- optional; applied to every item, the items are passed on as they are without it
+        queueSize: int -- results waiting for the next stage
+        name: str -- optional; the name of the thread
+
+    Notes: Iterating the stage gives the results; an exception raised by the source or the
+        function is raised again there. close stops the thread and the stages before it,
+        it is called once the results are all taken or the run failed.
+
+        stage = Stage(Stage(chunks), compute)
+        try:
+            for result in stage:
+                write(result)
+        finally:
+            stage.close()
+    """
+    def __init__(self, source, function=None, queueSize=QUEUE_SIZE, name=None):
+        self.source = source
+        self.function = function
+        self.queue = queue.Queue(queueSize)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self.thread.start()
+
+    def _put(self, kind, value):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put((kind, value), timeout=POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run(self):
+        try:
+            for item in self.source:
+                if self.stopped.is_set():
+                    return
+                if not self._put(_ITEM, item if self.function is None else self.function(item)):
+                    return
+            self._put(_DONE, None)
+        except BaseException as e:
+            self._put(_ERROR, e)
+        finally:
+            close = getattr(self.source, 'close', None)
+            if close is not None:
+                close()
+
+    def __iter__(self):
+        while True:
+            kind, value = self.queue.get()
+            if kind == _ITEM:
+                yield value
+            elif kind == _ERROR:
+                raise value
+            else:
+                return
+
+    def close(self):
+        """Stops the thread, and the stages before it, and waits for them"""
+        self.stopped.set()
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+
+
+def pipeline(source, functions, queueSize=QUEUE_SIZE):
+    """Chains a reader stage of source and a stage for every function
+
+    Keyword Arguments:
+        source: iterable -- the items, read in a thread of their own
+        functions: list -- the functions applied one after the other, each in its thread
+        queueSize: int -- results waiting between two stages
+
+    Returns:
+        stage: Stage -- the last stage, iterated by the writer
+    """
+    stage = Stage(source, queueSize=queueSize, name='udf-read')
+    for i, function in enumerate(functions):
+        stage = Stage(stage, function, queueSize, 'udf-stage' + str(i + 1))
+    return stage
@@ -0,0 +1,143 @@
+"""
+    Hazus - Flood UDF summary
+    ~~~~~
+
+    Totals of the losses, debris and exposure of a UDF run by grid, occupancy
+    class and census geography. The totals of every chunk are added up while the
+    results are written, and saved as a small summary table at the end of the run,
+    so the results do not have to be read again to total them.
+
+    :copyright: © 2019 by FEMA's Natural Hazards and Risk Assesment Program.
+    :license: cc, see LICENSE for more details.
+"""
+
+import csv
+
+import numpy as np
+import pandas as pd
+
+# Columns totalled by the summary table. Records counts the records with results (those with the
+# required fields), Exposed the ones with flooding.
+SUMMARY_FIELDS = ['Records', 'Exposed', 'BldgLossUSD', 'ContentLossUSD', 'InventoryLossUSD', 'Debris_Tot']
+COUNT_FIELDS = ['Records', 'Exposed']
+
+# Levels of the summary table, in their order; Grid is the total of the grid
+LEVELS = ['Grid', 'OccupancyClass', 'CensusTract', 'CensusBlock']
+
+# Inventory fields of the census geography, by their FAST names
+CENSUS_FIELDS = ['CensusTract', 'CensusBlock']
+
+
+def censusFields(fieldnames):
+    """The inventory fields holding census geography
+
+    Returns:
+        census: dict -- summary level ('CensusTract', 'CensusBlock') to the inventory field of the level
+    """
+    return dict((level, level) for level in CENSUS_FIELDS if level in fieldnames)
+
+
+def blockGroups(blocks, tracts=None):
+    """The CensusBlock groups of the summary table
+
+    Keyword Arguments:
+        blocks: numpy array -- CensusBlock text of every record
+        tracts: numpy array -- optional; CensusTract text of every record
+
+    Returns:
+        groups: numpy array -- the block of every record: the block itself if it is a 15 digit GEOID,
+            else '<CensusTract>/<CensusBlock>', as block numbers repeat from tract to tract. '' where
+            there is no block.
+    """
+    if tracts is None:
+        tracts = np.full(len(blocks), '', dtype=object)
+    groups = np.empty(len(blocks), dtype=object)
+    groups[:] = [block if block == '' or (len(block) == 15 and block.isdigit()) else tract + '/' + block
+                 for tract, block in zip(tracts.tolist(), blocks.tolist())]
+    return groups
+
+
+class GroupTotals():
+    """Running totals of the summary fields by level and group
+
+    Keyword Arguments:
+        fields: list -- optional; the fields totalled, SUMMARY_FIELDS by default
+
+    Notes: Chunks are added in inventory order; totals of chunks computed elsewhere (by worker
+        processes) are added with update in the same order, which gives the same sums.
+
+        totals = GroupTotals()
+        totals.add(values, {'OccupancyClass': OC})
+        totals.rows()
+    """
+    def __init__(self, fields=None):
+        self.fields = SUMMARY_FIELDS if fields is None else fields
+        self.totals = {}
+
+    def _add(self, level, group, values):
+        key = (level, group)
+        if key in self.totals:
+            self.totals[key] = self.totals[key] + values
+        else:
+            self.totals[key] = values
+
+    def add(self, values, groups):
+        """Adds the records of a chunk
+
+        Keyword Arguments:
+            values: dict -- field to numpy array, one value per record
+            groups: dict -- level to the text of the group of every record
+        """
+        frame = pd.DataFrame(dict((name, values[name]) for name in self.fields))
+        self._add('Grid', '', frame.sum().to_numpy(dtype=float))
+        for level, keys in groups.items():
+            sums = frame.groupby(np.asarray(keys, dtype=object), sort=False).sum()
+            for group, row in zip(sums.index.tolist(), sums.to_numpy(dtype=float)):
+                self._add(level, group, row)
+
+    def update(self, other):
+        """Adds the totals of another GroupTotals"""
+        for (level, group), values in other.totals.items():
+            self._add(level, group, values)
+
+    def rows(self):
+        """The totals as (level, group, values) in level then group order; the Grid level is always there"""
+        if ('Grid', '') not in self.totals:
+            self.totals[('Grid', '')] = np.zeros(len(self.fields))
+        keys = sorted(self.totals, key=lambda key: (LEVELS.index(key[0]), key[1]))
+        return [(level, group, self.totals[(level, group)]) for level, group in keys]
+
+
+def writeSummary(path, gridNames, totals, format='csv'):
+    """Writes the summary table of a run
+
+    Keyword Arguments:
+        path: str -- the summary table
+        gridNames: list -- the name of every grid, recorded in GridName
+        totals: list -- the GroupTotals of every grid
+        format: str -- 'csv', or 'parquet' or 'arrow' (requires pyarrow)
+
+    Notes: Columns are GridName, Level, Group and SUMMARY_FIELDS. A record holds the totals of
+        the records of a grid in one group of a level, the Grid level holding the grid totals.
+    """
+    records = []
+    for gridName, gridTotals in zip(gridNames, totals):
+        for level, group, values in gridTotals.rows():
+            records.append([gridName, level, group] + [int(value) if name in COUNT_FIELDS else float(value)
+                                                       for name, value in zip(SUMMARY_FIELDS, values.tolist())])
+    header = ['GridName', 'Level', 'Group'] + SUMMARY_FIELDS
+    if format == 'csv':
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f, delimiter=',', lineterminator='\n')
+            writer.writerow(header)
+            writer.writerows(records)
+        return
+    import pyarrow as pa
+    from .udf_output import ArrowResults
+    types = [pa.string()] * 3 + [pa.int64() if name in COUNT_FIELDS else pa.float64() for name in SUMMARY_FIELDS]
+    arrays = [pa.array([record[i] for record in records], type=types[i]) for i in range(len(header))]
+    summary = ArrowResults(path, format, header)
+    try:
+        summary.write(pa.RecordBatch.from_arrays(arrays, names=header))
+    finally:
+        summary.close()
@@ -0,0 +1,160 @@
+"""
+    Hazus - Flood UDF scenario sweeps
+    ~~~~~
+
+    Losses of a UDF inventory under many first floor height scenarios, such as
+    elevating every building by 1 to 10 feet, from a single sample of the depth
+    grid. Every record of a chunk is repeated once per scenario with the first
+    floor height of the scenario and the losses of all the scenarios are
+    computed in one batched pass of the columnar engine, so the damage of a
+    building archetype at a depth is still only looked up once.
+
+    :copyright: © 2019 by FEMA's Natural Hazards and Risk Assesment Program.
+    :license: cc, see LICENSE for more details.
+"""
+
+import logging
+
+import numpy as np
+import pandas as pd
+
+from . import udf_engine, udf_frame
+from .damage_functions import DamageFunctionLibrary
+from .depth_grid import DEFAULT_MAX_MEMORY
+
+# Loss matrices of a sweep; TotalLossUSD is the sum of the other three
+LOSS_FIELDS = ['BldgLossUSD', 'ContentLossUSD', 'InventoryLossUSD', 'TotalLossUSD']
+
+
+def inventoryChunks(inventory, chunkSize=udf_engine.DEFAULT_CHUNK_SIZE, fields=None):
+    """Reads an inventory given as a csv or vector file, a DataFrame or a pyarrow Table in chunks of records
+
+    Keyword Arguments:
+        fields: UDFFields -- of the field map, the fields read from a vector inventory (see udf_engine.readInventory)
+
+    Returns:
+        fieldnames: list -- the inventory fields
+        chunks: iterable -- (records x fields) object arrays of the cell text, as udf_engine.readInventory
+    """
+    if isinstance(inventory, str):
+        return udf_engine.readInventory(inventory, chunkSize, fields)
+    if not isinstance(inventory, pd.DataFrame):
+        inventory = inventory.to_pandas()
+    fieldnames = [str(name) for name in inventory.columns]
+    return fieldnames, (udf_frame.frameCells(inventory.iloc[start:start + chunkSize])
+                        for start in range(0, len(inventory), chunkSize))
+
+
+def scenarioHeights(ffh, start, offsets=None, firstFloorHeights=None):
+    """The first floor heights of the records of a chunk in every scenario
+
+    Keyword Arguments:
+        ffh: numpy array -- the inventory first floor heights of the chunk
+        start: int -- position of the chunk in the inventory
+        offsets: numpy array -- added to the first floor heights; one per scenario, or (records x scenarios)
+        firstFloorHeights: numpy array -- (records x scenarios) first floor heights replacing the inventory ones
+
+    Returns:
+        heights: numpy array -- (chunk records x scenarios)
+    """
+    scenarios = offsets if firstFloorHeights is None else firstFloorHeights
+    if scenarios.ndim == 2:
+        scenarios = scenarios[start:start + len(ffh)]
+        if len(scenarios) < len(ffh):
+            raise ValueError('The scenarios have fewer records than the inventory')
+    if firstFloorHeights is not None:
+        return scenarios.astype(float)
+    return ffh[:, None] + scenarios
+
+
+def repeatRecords(attributes, count):
+    """Repeats every record of a chunk count times, the copies of a record next to each other"""
+    return dict((key, np.repeat(values, count)) for key, values in attributes.items())
+
+
+def scenarioLosses(attributes, raw, sampled, heights, fields, library, QC_Warning=False):
+    """Computes the losses of a chunk in every scenario in one batched computation
+
+    Keyword Arguments:
+        attributes: dict -- from udf_engine.prepareInventory
+        raw: numpy array -- sampled depth in the raster data type
+        sampled: numpy array -- False where the depth is not from the grid
+        heights: numpy array -- (records x scenarios) first floor heights, from scenarioHeights
+        fields: UDFFields -- the field map
+        library: DamageFunctionLibrary -- the compiled lookup tables
+        QC_Warning: bool -- report inconsistencies between user-supplied DDFs and occupancy classes
+
+    Returns:
+        losses: dict -- LOSS_FIELDS name to (records x scenarios) numpy array; NaN for the records that
+            are not processed (missing required fields or first floor height, or no building DDF)
+    """
+    n, scenarios = heights.shape
+    tiled = repeatRecords(attributes, scenarios)
+    tiled['ffh'] = heights.ravel()
+    tiled['valid'] = tiled['valid'] & np.isfinite(tiled['ffh'])
+    result = udf_engine.computeDamage(tiled, np.repeat(raw, scenarios), np.repeat(sampled, scenarios), '',
+                                      fields, library, QC_Warning)
+    processed = result.status == udf_engine.STATUS_PROCESSED
+    losses = dict((name, np.where(processed, result.columns[name], np.nan).reshape(n, scenarios))
+                  for name in LOSS_FIELDS[:3])
+    losses['TotalLossUSD'] = losses['BldgLossUSD'] + losses['ContentLossUSD'] + losses['InventoryLossUSD']
+    return losses
+
+
+def sweepFirstFloorHeights(inventory, depthGrid, fmap, library, offsets=None, firstFloorHeights=None, QC_Warning=False,
+                           chunkSize=udf_engine.DEFAULT_CHUNK_SIZE, maxMemory=DEFAULT_MAX_MEMORY):
+    """Computes the losses of an inventory for first floor height scenarios against one depth grid
+
+    Keyword Arguments:
+        inventory: str -- the UDF inventory csv or vector file (GeoPackage, Shapefile, GeoParquet), or a
+            DataFrame or pyarrow Table
+        depthGrid: str -- the depth grid, as a path, an open gdal Dataset, a DepthGrid or an ArrayDepthGrid
+        fmap: FieldMap -- the FAST field map, or a list or dict
+        library: DamageFunctionLibrary -- the compiled lookup tables, or the folder of the lookup tables
+        offsets: list -- feet added to the first floor height of every building, one per scenario (e.g.
+            [0, 1, 2, 3]); or a (buildings x scenarios) array of the offset of every building
+        firstFloorHeights: numpy array -- instead of offsets, the (buildings x scenarios) first floor
+            heights; NaN leaves a building out of a scenario
+        QC_Warning: bool -- report informative inconsistency observations
+        chunkSize: int -- number of (building, scenario) pairs computed at once
+        maxMemory: int -- ceiling in bytes of the depth grid blocks kept in memory
+
+    Returns:
+        losses: dict -- LOSS_FIELDS name to the (buildings x scenarios) loss matrix, buildings in inventory
+            order; NaN for the buildings without losses (see scenarioLosses)
+
+    Notes: The grid is sampled once per chunk of buildings, whatever the number of scenarios.
+    """
+    if (offsets is None) == (firstFloorHeights is None):
+        raise ValueError('Give either offsets or firstFloorHeights')
+    scenarios = np.asarray(offsets if firstFloorHeights is None else firstFloorHeights, dtype=float)
+    if (scenarios.ndim == 1 and firstFloorHeights is not None) or scenarios.ndim not in [1, 2]:
+        raise ValueError('firstFloorHeights must be a (buildings x scenarios) array')
+    offsets, firstFloorHeights = (scenarios, None) if firstFloorHeights is None else (None, scenarios)
+    count = scenarios.shape[-1]
+    fields = udf_engine.UDFFields(fmap)
+    if not isinstance(library, DamageFunctionLibrary):
+        library = DamageFunctionLibrary(library)
+    fieldnames, chunks = inventoryChunks(inventory, max(1, chunkSize // max(1, count)), fields)
+    missing = [name for name in fields.required if name not in fieldnames]
+    if missing:
+        raise KeyError('Inventory fields not found: ' + ', '.join(missing))
+
+    grids, names, opened = udf_frame._openGrids([depthGrid], maxMemory)
+    parts = []
+    records = 0
+    try:
+        for cells in chunks:
+            attributes = udf_engine.prepareInventory(cells, fieldnames, fields, library)
+            raw, sampled = grids[0].sample(attributes['lat'], attributes['lon'])
+            heights = scenarioHeights(attributes['ffh'], records, offsets, firstFloorHeights)
+            parts.append(scenarioLosses(attributes, raw, sampled, heights, fields, library, QC_Warning))
+            records += len(cells)
+            logging.getLogger('FAST').info('processing record ' + str(records))
+    finally:
+        for grid in opened:
+            grid.close()
+    if scenarios.ndim == 2 and len(scenarios) != records:
+        raise ValueError('The scenarios have ' + str(len(scenarios)) + ' records, the inventory ' + str(records))
+    return dict((name, np.concatenate([part[name] for part in parts]) if parts else np.empty((0, count)))
+                for name in LOSS_FIELDS)
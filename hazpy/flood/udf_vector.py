@@ -0,0 +1,291 @@
+"""
+    Hazus - Flood UDF vector inventories
+    ~~~~~
+
+    Reads a UDF inventory held as a point or footprint layer, such as a
+    GeoPackage, a Shapefile or a GeoParquet file, without exporting it to csv
+    first. Only the fields of the field map (and the census fields the summary
+    groups on) are read: GeoParquet columns are projected by pyarrow, ogr
+    layers ignore the other fields. Records are streamed as Arrow batches,
+    through the Arrow stream of the layer with gdal 3.6 and later, and handed
+    to the UDF engine as the chunks of cell text readInventory gives for a
+    csv. A latitude or longitude field of the field map that is not a field of
+    the layer is taken from the geometry: the point, or a point on the surface
+    of a footprint, in WGS84.
+
+    :copyright: © 2019 by FEMA's Natural Hazards and Risk Assesment Program.
+    :license: cc, see LICENSE for more details.
+"""
+
+import json
+import os
+
+import numpy as np
+from osgeo import ogr, osr
+
+from . import udf_summary
+from .footprints import wgs84Transform
+
+# Inventories read with pyarrow, and with ogr
+PARQUET_FORMATS = ['.parquet', '.geoparquet']
+OGR_FORMATS = ['.gpkg', '.shp', '.fgb', '.geojson', '.gdb', '.sqlite']
+
+# Spatial references of GeoParquet geometries that already are WGS84 longitude/latitude
+LONLAT_CRS = [('OGC', 'CRS84'), ('EPSG', 4326)]
+
+
+def isVector(path):
+    """True for an inventory read by readVector rather than as a csv"""
+    extension = os.path.splitext(str(path).rstrip('/\\'))[1].lower()
+    return extension in PARQUET_FORMATS or extension in OGR_FORMATS
+
+
+def projection(available, columns, latitude=None, longitude=None):
+    """The fields of a vector inventory that are read
+
+    Keyword Arguments:
+        available: list -- the attribute fields of the layer
+        columns: list -- the fields of the field map, or None for every field
+        latitude: str -- the latitude field of the field map
+        longitude: str -- the longitude field of the field map
+
+    Returns:
+        read: list -- the attribute fields read, in the order of the layer; census fields are read too
+        derived: list -- (field, 'x' or 'y') of the latitude/longitude fields taken from the geometry
+    """
+    if columns is None:
+        read = list(available)
+    else:
+        wanted = set(columns) | set(udf_summary.censusFields(available).values())
+        read = [name for name in available if name in wanted]
+    derived = [(name, axis) for name, axis in [(latitude, 'y'), (longitude, 'x')] if name and name not in available]
+    return read, derived
+
+
+def _text(column):
+    """The cell text of an Arrow column, '' where it is null"""
+    import pyarrow as pa
+    if not (pa.types.is_string(column.type) or pa.types.is_large_string(column.type)):
+        column = column.cast(pa.string())
+    return column.fill_null('').to_numpy(zero_copy_only=False)
+
+
+def _coordinateText(values):
+    """The cell text of coordinates, '' for NaN"""
+    return np.array(['' if value != value else repr(value) for value in values.tolist()], dtype=object)
+
+
+def pointCoordinates(wkb, transform=None):
+    """The x and y of every WKB geometry of an Arrow binary array
+
+    Keyword Arguments:
+        wkb: pyarrow array -- WKB geometries
+        transform: osr.CoordinateTransformation -- to WGS84 longitude/latitude, or None
+
+    Returns:
+        x, y: numpy array -- the point, or a point on the surface of other geometries; NaN for
+            null or empty geometries
+
+    Notes: 2D little endian points, most inventories, are decoded together from the buffers of
+        the array; other geometries are read one by one by ogr.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    if isinstance(wkb, pa.ChunkedArray):
+        wkb = wkb.combine_chunks()
+    count = len(wkb)
+    x = np.full(count, np.nan)
+    y = np.full(count, np.nan)
+    valid = ~np.asarray(wkb.is_null().to_numpy(zero_copy_only=False), dtype=bool)
+    lengths = pc.binary_length(wkb).fill_null(0).to_numpy(zero_copy_only=False)
+    fast = np.zeros(count, dtype=bool)
+    data = wkb.buffers()[2]
+    if count and data is not None:
+        offsetType = np.int64 if pa.types.is_large_binary(wkb.type) else np.int32
+        starts = np.frombuffer(wkb.buffers()[1], dtype=offsetType)[wkb.offset:wkb.offset + count].astype(np.int64)
+        points = np.flatnonzero(valid & (lengths == 21))
+        if len(points):
+            wkbs = np.frombuffer(data, dtype=np.uint8)[starts[points][:, None] + np.arange(21)]
+            kinds = np.ascontiguousarray(wkbs[:, 1:5]).view('<u4').ravel()
+            decoded = (wkbs[:, 0] == 1) & (kinds == 1)
+            coordinates = np.ascontiguousarray(wkbs[decoded, 5:21]).view('<f8')
+            points = points[decoded]
+            x[points], y[points] = coordinates[:, 0], coordinates[:, 1]
+            fast[points] = True
+    for i in np.flatnonzero(valid & ~fast):
+        geometry = ogr.CreateGeometryFromWkb(wkb[int(i)].as_py())
+        if geometry is None or geometry.IsEmpty():
+            continue
+        if ogr.GT_Flatten(geometry.GetGeometryType()) != ogr.wkbPoint:
+            geometry = geometry.PointOnSurface() or geometry.Centroid()
+        x[i], y[i] = geometry.GetX(), geometry.GetY()
+    if transform is not None:
+        found = np.flatnonzero(~np.isnan(x))
+        if len(found):
+            transformed = np.array(transform.TransformPoints(np.column_stack([x[found], y[found]]).tolist()), dtype=float)
+            x[found], y[found] = transformed[:, 0], transformed[:, 1]
+    return x, y
+
+
+def batchCells(batch, read, derived, geometry=None, transform=None):
+    """The (records x fields) object array of the cell text of an Arrow batch
+
+    Keyword Arguments:
+        batch: pyarrow RecordBatch -- records of the inventory
+        read: list -- the attribute fields of the batch to keep
+        derived: list -- (field, 'x' or 'y') of the fields taken from the geometry
+        geometry: str -- the WKB geometry column of the batch, needed for derived fields
+        transform: osr.CoordinateTransformation -- of the geometry to WGS84, or None
+    """
+    cells = np.empty((batch.num_rows, len(read) + len(derived)), dtype=object)
+    for i, name in enumerate(read):
+        cells[:, i] = _text(batch.column(batch.schema.get_field_index(name)))
+    if derived:
+        x, y = pointCoordinates(batch.column(batch.schema.get_field_index(geometry)), transform)
+        for i, (name, axis) in enumerate(derived):
+            cells[:, len(read) + i] = _coordinateText(x if axis == 'x' else y)
+    return cells
+
+
+def rechunk(parts, chunkSize):
+    """Regroups (records x fields) arrays of any number of records into chunks of chunkSize records"""
+    pending = []
+    records = 0
+    for cells in parts:
+        if not len(cells):
+            continue
+        pending.append(cells)
+        records += len(cells)
+        while records >= chunkSize:
+            cells = np.concatenate(pending) if len(pending) > 1 else pending[0]
+            yield cells[:chunkSize]
+            pending = [cells[chunkSize:]] if len(cells) > chunkSize else []
+            records -= chunkSize
+    if records:
+        yield np.concatenate(pending) if len(pending) > 1 else pending[0]
+
+
+def _parquetTransform(crs):
+    """The transformation to WGS84 of the crs (PROJJSON or text) of a GeoParquet geometry column
+
+    Notes: None for longitude/latitude, and for a column of unknown crs (null), taken as longitude/latitude.
+    """
+    if crs is None:
+        return None
+    if isinstance(crs, dict):
+        identifier = crs.get('id') or {}
+        if (identifier.get('authority'), identifier.get('code')) in LONLAT_CRS:
+            return None
+        crs = json.dumps(crs)
+    elif crs.upper() in [authority + ':' + str(code) for authority, code in LONLAT_CRS]:
+        return None
+    srs = osr.SpatialReference()
+    srs.SetFromUserInput(crs)
+    return wgs84Transform(srs)
+
+
+def readParquet(path, chunkSize, columns=None, latitude=None, longitude=None):
+    """Reads the records of a (Geo)Parquet inventory in chunks; see readVector"""
+    import pyarrow.parquet as pq
+    parquet = pq.ParquetFile(path)
+    available = list(parquet.schema_arrow.names)
+    geo = json.loads((parquet.schema_arrow.metadata or {}).get(b'geo', b'{}'))
+    geometry = geo.get('primary_column')
+    if geometry in available:
+        available.remove(geometry)
+    read, derived = projection(available, columns, latitude, longitude)
+    if derived and geometry is None:
+        raise ValueError('No ' + ' or '.join(name for name, axis in derived) + ' field or geometry in ' + path)
+    # A column without a crs is in OGC:CRS84 longitude/latitude
+    crs = geo['columns'][geometry].get('crs', {'id': {'authority': 'OGC', 'code': 'CRS84'}}) if derived else None
+    transform = _parquetTransform(crs)
+    batches = parquet.iter_batches(batch_size=chunkSize, columns=read + ([geometry] if derived else []))
+    chunks = rechunk((batchCells(batch, read, derived, geometry, transform) for batch in batches), chunkSize)
+    return read + [name for name, axis in derived], chunks
+
+
+def _featureCells(features, read, derived, transform):
+    """The (records x fields) object array of the cell text of ogr features"""
+    cells = np.empty((len(features), len(read) + len(derived)), dtype=object)
+    for row, feature in enumerate(features):
+        for i, name in enumerate(read):
+            index = feature.GetFieldIndex(name)
+            cells[row, i] = feature.GetFieldAsString(index) if feature.IsFieldSetAndNotNull(index) else ''
+        if derived:
+            geometry = feature.GetGeometryRef()
+            x = y = np.nan
+            if geometry is not None and not geometry.IsEmpty():
+                if ogr.GT_Flatten(geometry.GetGeometryType()) != ogr.wkbPoint:
+                    geometry = geometry.PointOnSurface() or geometry.Centroid()
+                else:
+                    geometry = geometry.Clone()
+                if transform is not None:
+                    geometry.Transform(transform)
+                x, y = geometry.GetX(), geometry.GetY()
+            for i, (name, axis) in enumerate(derived):
+                cells[row, len(read) + i] = '' if x != x else repr(x if axis == 'x' else y)
+    return cells
+
+
+def readLayer(path, chunkSize, columns=None, latitude=None, longitude=None, layerName=None):
+    """Reads the records of a layer ogr reads (GeoPackage, Shapefile, ...) in chunks; see readVector"""
+    source = ogr.Open(str(path))
+    if source is None:
+        raise IOError('Could not open ' + str(path))
+    layer = source.GetLayer() if layerName is None else source.GetLayerByName(layerName)
+    definition = layer.GetLayerDefn()
+    available = [definition.GetFieldDefn(i).GetName() for i in range(definition.GetFieldCount())]
+    read, derived = projection(available, columns, latitude, longitude)
+    if derived and layer.GetGeomType() == ogr.wkbNone:
+        raise ValueError('No ' + ' or '.join(name for name, axis in derived) + ' field or geometry in ' + str(path))
+    ignored = [name for name in available if name not in read] + ['OGR_STYLE']
+    layer.SetIgnoredFields(ignored + ([] if derived else ['OGR_GEOMETRY']))
+    transform = wgs84Transform(layer.GetSpatialRef()) if derived else None
+
+    def batches():
+        if hasattr(layer, 'GetArrowStreamAsPyArrow'):
+            # gdal 3.6 and later: the layer is read as Arrow batches
+            stream = layer.GetArrowStreamAsPyArrow(['MAX_FEATURES_IN_BATCH=' + str(chunkSize), 'INCLUDE_FID=NO',
+                                                    'GEOMETRY_ENCODING=WKB'])
+            geometry = layer.GetGeometryColumn() or 'wkb_geometry'
+            for batch in stream:
+                yield batchCells(batch, read, derived, geometry, transform)
+            return
+        features = []
+        for feature in layer:
+            features.append(feature)
+            if len(features) == chunkSize:
+                yield _featureCells(features, read, derived, transform)
+                features = []
+        yield _featureCells(features, read, derived, transform)
+
+    def chunks(source=source):
+        # The layer is only valid while its data source is open
+        yield from rechunk(batches(), chunkSize)
+    return read + [name for name, axis in derived], chunks()
+
+
+def readVector(path, chunkSize, columns=None, latitude=None, longitude=None):
+    """Reads a UDF inventory held as a vector dataset in chunks of records
+
+    Keyword Arguments:
+        path: str -- a GeoParquet/Parquet file, or a GeoPackage, Shapefile or other dataset ogr reads
+            (its first layer)
+        chunkSize: int -- number of records per chunk
+        columns: list -- the fields to read, e.g. those of the field map, or None for every field.
+            Census fields are read too.
+        latitude: str -- the latitude field of the field map, taken from the geometry if the layer
+            has no field of that name
+        longitude: str -- the longitude field of the field map, likewise
+
+    Returns:
+        fieldnames: list -- the fields read, in the order of the layer, then the fields taken from
+            the geometry
+        chunks: generator -- (records x fields) object arrays of the cell text, as
+            udf_engine.readInventory. Null values are ''; numbers are written the way Arrow casts
+            them to text.
+    """
+    extension = os.path.splitext(str(path).rstrip('/\\'))[1].lower()
+    if extension in PARQUET_FORMATS:
+        return readParquet(path, chunkSize, columns, latitude, longitude)
+    return readLayer(path, chunkSize, columns, latitude, longitude)
@@ -1,7 +1,28 @@
+from . import udf_engine, udf_sweep
+from .depth_grid import DEFAULT_MAX_MEMORY
+
+
 class WhatIf():
     def __init__(self):
         pass
 
+    @staticmethod
+    def firstFloorHeightSweep(inventory, LUT_Dir, DepthGrid, fmap, offsets=None, firstFloorHeights=None, QC_Warning=False,
+                              chunkSize=udf_engine.DEFAULT_CHUNK_SIZE, maxMemory=DEFAULT_MAX_MEMORY):
+        # inventory = the UDF inventory csv (full pathname), or a pandas DataFrame or pyarrow Table
+        # LUT_Dir = folder name where the Lookup table libraries reside, or a DamageFunctionLibrary already compiled
+        # DepthGrid = the flood depth grid, as a path, an open gdal Dataset or an ArrayDepthGrid
+        # fmap = FieldMap, or the field map list or a dict of attribute to field
+        # offsets = feet added to the first floor height of every building, one per scenario, e.g. [0, 1, 2, ..., 10]
+        #           for elevation studies; or a (buildings x scenarios) array with an offset per building
+        # firstFloorHeights = instead of offsets, a (buildings x scenarios) array of the first floor heights of every
+        #                     building in every scenario, NaN to leave a building out of a scenario
+        # chunkSize = number of (building, scenario) pairs computed at once
+        # Returns a dict of BldgLossUSD, ContentLossUSD, InventoryLossUSD and TotalLossUSD to the (buildings x scenarios)
+        # loss matrix, buildings in inventory order. The depth grid is sampled once for all the scenarios.
+        return udf_sweep.sweepFirstFloorHeights(inventory, DepthGrid, fmap, LUT_Dir, offsets, firstFloorHeights,
+                                                QC_Warning, chunkSize, maxMemory)
+
     def includeFloodWarningParameters(self):
         pass
 
@@ -26,6 +26,7 @@ import subprocess
 from osgeo import ogr
 ogr.UseExceptions()
 
+from ..flood.grid_cache import gridPath
 from .hazuspackageregiondataframe import HazusPackageRegionDataFrame
 
 
@@ -1584,11 +1585,14 @@ class HazusPackageRegion():
             print(e)
             raise 
         
-    def getHazardGeoDataFrame(self, round=True):
+    def getHazardGeoDataFrame(self, round=True, gridCache=None):
         """ Queries the local Hazus SQL Server database and returns a geodataframe of the hazard
 
             Keyword Arguments:
                 round: boolean -- if True, the hazard rasters will be rounded to the nearest integer (default: True)
+                gridCache: str or bool -- folder the flood and tsunami rasters are cached in as tiled, compressed
+                    GeoTIFFs (default: None, hazpy.flood.grid_cache.DEFAULT_CACHE_DIR, ~/.hazpy/grids); False reads
+                    the rasters directly. Delete the folder to clear the cache.
 
             Returns:
                 hazardGDF: geopandas GeoDataFrame -- a geodataframe containing the spatial hazard data
@@ -1716,7 +1720,7 @@ class HazusPackageRegion():
                     if hazardPathDicts[idx]['returnPeriod'] == self.returnPeriod.strip() or self.returnPeriod == 'Mix0':
                         try:
                             if hazardPathDicts[idx]['path'].exists():
-                                raster = rio.open(hazardPathDicts[idx]['path'])
+                                raster = rio.open(gridPath(hazardPathDicts[idx]['path'], gridCache))
                                 affine = raster.meta.get('transform')
                                 crs = raster.meta.get('crs')
                                 band = raster.read(1)
@@ -1807,7 +1811,7 @@ class HazusPackageRegion():
                     pass
             #TSUNAMI
             if hazard == 'tsunami':
-                raster = rio.open(Path.joinpath(self.tempDir, 'maxdg_ft/w001001.adf')) #needs testing
+                raster = rio.open(gridPath(Path.joinpath(self.tempDir, 'maxdg_ft/w001001.adf'), gridCache)) #needs testing
                 affine = raster.meta.get('transform')
                 crs = raster.meta.get('crs')
                 band = raster.read(1)
@@ -22,6 +22,7 @@ import rasterio as rio
 from rasterio import features
 import numpy as np
 
+from ..flood.grid_cache import gridPath
 from .studyregiondataframe import StudyRegionDataFrame
 from .report import Report
 
@@ -842,11 +843,14 @@ class StudyRegion:
             print(exc_type, exc_tb.tb_lineno)
             print("Unexpected error:", sys.exc_info()[0])
 
-    def getHazardGeoDataFrame(self, round=True):
+    def getHazardGeoDataFrame(self, round=True, gridCache=None):
         """Queries the local Hazus SQL Server database and returns a geodataframe of the hazard
 
         Keyword Arguments:
             round: boolean -- if True, the hazard rasters will be rounded to the nearest integer (default: True)
+            gridCache: str or bool -- folder the flood and tsunami rasters are cached in as tiled, compressed
+                GeoTIFFs (default: None, hazpy.flood.grid_cache.DEFAULT_CACHE_DIR, ~/.hazpy/grids); False reads
+                the rasters directly. Delete the folder to clear the cache.
 
         Returns:
             hazardGDF: geopandas GeoDataFrame -- a geodataframe containing the spatial hazard data
@@ -1023,7 +1027,7 @@ class StudyRegion:
                     ):
              #           print('\n{} Idx {} has data\n'.format(self.returnPeriod, idx))
                         try:
-                            raster = rio.open(hazardPathDicts[idx]["path"])
+                            raster = rio.open(gridPath(hazardPathDicts[idx]["path"], gridCache))
                             affine = raster.meta.get("transform")
                             crs = raster.meta.get("crs")
                             band = raster.read(1)
@@ -1149,8 +1153,11 @@ class StudyRegion:
 
             if hazard == "tsunami":
                 raster = rio.open(
-                    r"C:\HazusData\Regions\{s}\maxdg_dft\w001001.adf".format(
-                        s=self.name
+                    gridPath(
+                        r"C:\HazusData\Regions\{s}\maxdg_dft\w001001.adf".format(
+                            s=self.name
+                        ),
+                        gridCache,
                     )
                 )
                 affine = raster.meta.get("transform")
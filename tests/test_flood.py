@@ -1,6 +1,33 @@
+import csv
+import filecmp
+import logging
+import os
+import tempfile
+import time
 import unittest
+import numpy as np
 from hazpy.flood import Flood
 from hazpy.flood import UDF
+from hazpy.flood import udf_engine
+from hazpy.flood import FieldMap
+from hazpy.flood.damage_functions import DamageFunctionLibrary, DamageFunctionTable, DEPTH_COLUMNS, LUT_FILES, LUT_KEYS, CACHE_FILE
+from hazpy.flood.depth_grid import ArrayDepthGrid, DepthGrid, GDAL_CACHE_MAX, PointCache, SamplingPlan, mortonKeys, setGDALCache
+from hazpy.flood.footprints import Footprints, zonalDepths
+from hazpy.flood import grid_cache
+from hazpy.flood import udf_checkpoint
+from hazpy.flood import udf_parallel
+from hazpy.flood import udf_pipeline
+from hazpy.flood import udf_ensemble
+from hazpy.flood import udf_incremental
+from hazpy.flood import udf_summary
+from hazpy.flood import udf_sweep
+from hazpy.flood import udf_vector
+from hazpy.flood.udf_output import ArrowResults, SortedResults, recordBatch
+from osgeo import gdal, osr
+
+# The field map of the _udfFixture inventory, and the files of a flood_damage run
+UDF_FMAP = ['ID', 'Occ', 'Cost', 'Area', 'NumStories', 'FoundationType', 'FFH', '', 'BDDF', '', '', '', '', 'Lat', 'Lon', '']
+UDF_RESULTS = ['inventory_depth.csv', 'inventory_depth_sorted.csv']
 
 class TestFlood(unittest.TestCase):
 
@@ -17,4 +44,772 @@ class TestFlood(unittest.TestCase):
         # TODO move method to the GUI because hazpy cannot perform it on it's own
         pass
 
+    def testUDFFields(self):
+        fmap = ['ID', 'Occ', 'Cost', 'Area', 'NumStories', 'FoundationType', 'FFH', '', 'BDDF', '', '', '', '', 'Lat', 'Lon', '']
+        fields = udf_engine.UDFFields(fmap)
+        header = fields.header(['ID', 'BDDF'])
+        self.assertEqual(header[:3], ['ID', 'BDDF', 'Depth_Grid'])
+        self.assertEqual(header.count('BDDF'), 2)
+        self.assertEqual(header[-1], 'GridName')
+
+    def testUDFWideHeader(self):
+        fmap = ['ID', 'Occ', 'Cost', 'Area', 'NumStories', 'FoundationType', 'FFH', '', '', '', '', '', '', 'Lat', 'Lon', '']
+        header = udf_engine.UDFFields(fmap).wideHeader(['ID'], ['rp100', 'rp500'])
+        self.assertEqual(header[:4], ['ID', 'SOID', 'ContentCostUSD', 'InventoryCostUSD'])
+        self.assertIn('BldgLossUSD_rp100', header)
+        self.assertIn('BldgLossUSD_rp500', header)
+        self.assertNotIn('GridName_rp100', header)
+
+    def testSpecificOccupancyId(self):
+        self.assertEqual(udf_engine._specificOccupancyId('RES1', 4.0, 2.0), 'R12B')
+        self.assertEqual(udf_engine._specificOccupancyId('COM1', 7.0, 2.0), 'C1LN')
+
+    def testIntegralText(self):
+        values = np.array([0.0, 1.5, np.nan, -0.0, 0.0])
+        text = udf_engine._text(values, np.array([True, False, True, False, True]))
+        self.assertEqual(text.tolist(), ['0', '1.5', '', '-0.0', '0'])
+
+    def testArchetypes(self):
+        occupancy = np.array(['RES1', 'RES1', 'COM1', 'RES1', None], dtype=object)
+        depth = np.array([1.5, 1.5, 1.5, 2.0, 1.5])
+        codes, first = udf_engine._archetypes([occupancy, depth])
+        self.assertEqual(codes.tolist(), [0, 0, 1, 2, 3])
+        self.assertEqual(first.tolist(), [0, 2, 3, 4])
+
+    def testRecordErrors(self):
+        cells = np.array(['1000', None], dtype=object)
+        with self.assertRaisesRegex(ValueError, 'Record 8: no Cost value'):
+            udf_engine._numbers(cells, True, 'Cost', np.array(['7', '8'], dtype=object))
+        fmap = ['ID', 'Occ', 'Cost', 'Area', 'NumStories', 'FoundationType', 'FFH', '', 'BDDF', '', '', '', '', 'Lat', 'Lon', '']
+        attributes = {'valid': np.array([True, True]), 'uid': np.array(['7', '8'], dtype=object),
+                      'bddf': np.array(['3', None], dtype=object), 'bddfValue': np.array(['3', 'x3'], dtype=object)}
+        with self.assertRaisesRegex(ValueError, "Record 8: BDDF value 'x3' is not a DDF ID"):
+            udf_engine._selectDDF(attributes, np.array([True, True]), udf_engine.UDFFields(fmap), None, 'bddf', None)
+
+    def testDamageFunctionTable(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'ddf.csv')
+            with open(path, 'w') as f:
+                f.write(','.join(['SpecificOccupId', 'DDF_ID'] + DEPTH_COLUMNS) + '\n')
+                f.write(','.join(['R12N', '105'] + [str(d) for d in range(len(DEPTH_COLUMNS))]) + '\n')
+                f.write(','.join(['R12N', '106'] + ['0'] * len(DEPTH_COLUMNS)) + '\n')
+            table = DamageFunctionTable(path, 'SpecificOccupId')
+            positions = table.lookup(['R12N', 'C1LN'])
+            self.assertEqual(list(positions), [0, -1])
+            self.assertEqual(table.get('R12N')['DDF_ID'], '105')
+            damage = table.interpolate(positions[:1], np.array([0.5]))
+            self.assertAlmostEqual(damage[0], 0.045)
+
+    def testDepthGridBlocks(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'depth.tif')
+            raster = gdal.GetDriverByName('GTiff').Create(path, 64, 64, 1, gdal.GDT_Float32,
+                                                          ['TILED=YES', 'BLOCKXSIZE=16', 'BLOCKYSIZE=16'])
+            raster.SetGeoTransform((-90.0, 0.01, 0, 30.0, 0, -0.01))
+            srs = osr.SpatialReference()
+            srs.ImportFromEPSG(4326)
+            raster.SetProjection(srs.ExportToWkt())
+            band = raster.GetRasterBand(1)
+            band.SetNoDataValue(-9999)
+            band.WriteArray(np.arange(64 * 64, dtype=np.float32).reshape(64, 64))
+            raster = None
+
+            grid = DepthGrid(path, maxMemory=16 * 16 * 4)
+            lat = np.array([29.995, 29.985, 29.405, 31.0, np.nan])
+            lon = np.array([-89.995, -89.975, -89.405, -89.995, -89.995])
+            raw, sampled = grid.sample(lat, lon)
+            grid.close()
+            self.assertEqual(list(sampled), [True, True, True, False, False])
+            self.assertEqual(raw.tolist(), [0.0, 66.0, 59.0 * 64 + 59, 0.0, 0.0])
+            self.assertEqual(grid.blockReads, 2)
+
+    def testGDALCache(self):
+        cacheMax = gdal.GetCacheMax()
+        try:
+            setGDALCache(4 * GDAL_CACHE_MAX)
+            self.assertEqual(gdal.GetCacheMax(), GDAL_CACHE_MAX)
+            setGDALCache(GDAL_CACHE_MAX // 4)
+            self.assertEqual(gdal.GetCacheMax(), GDAL_CACHE_MAX // 4)
+        finally:
+            gdal.SetCacheMax(cacheMax)
+
+    def testInventoryStoreColumns(self):
+        with tempfile.TemporaryDirectory() as folder:
+            values = np.empty(5, dtype=object)
+            values[:] = ['RES1', None, 0, 0.0, 'RES1']
+            udf_parallel._saveColumn(os.path.join(folder, 'OC'), values)
+            loaded = udf_parallel._loadColumn(os.path.join(folder, 'OC'))
+            self.assertEqual([type(value) for value in loaded], [str, type(None), int, float, str])
+            udf_parallel._saveColumn(os.path.join(folder, 'ffh'), np.array([1.5, np.nan]))
+            self.assertEqual(udf_parallel._loadColumn(os.path.join(folder, 'ffh'))[0], 1.5)
+
+    def testPipeline(self):
+        stage = udf_pipeline.pipeline(iter(range(10)), [lambda x: x * 2, str], queueSize=1)
+        self.assertEqual(list(stage), [str(x * 2) for x in range(10)])
+        stage.close()
+        stage = udf_pipeline.pipeline(iter(range(10)), [lambda x: 1 // (5 - x)])
+        with self.assertRaises(ZeroDivisionError):
+            list(stage)
+        stage.close()
+
+    def testSummaryTotals(self):
+        self.assertEqual(udf_summary.censusFields(['ID', 'CensusBlock', 'CensusTract', 'Blockade']), {'CensusTract': 'CensusTract', 'CensusBlock': 'CensusBlock'})
+        self.assertEqual(udf_summary.censusFields(['ID', 'Census_Block', 'TRACT', 'subtract']), {})
+        blocks = udf_summary.blockGroups(np.array(['1001', '1001', '', '220710017001001'], dtype=object),
+                                         np.array(['22071001700', '22071001800', '22071001800', ''], dtype=object))
+        self.assertEqual(blocks.tolist(), ['22071001700/1001', '22071001800/1001', '', '220710017001001'])
+        values = dict((name, np.array([1, 0, 1])) for name in udf_summary.SUMMARY_FIELDS)
+        values['BldgLossUSD'] = np.array([10.0, 0.0, 2.5])
+        totals = udf_summary.GroupTotals()
+        totals.add(values, {'OccupancyClass': np.array(['RES1', 'COM1', 'RES1'], dtype=object)})
+        chunk = udf_summary.GroupTotals()
+        chunk.add(values, {'OccupancyClass': np.array(['COM1', 'COM1', 'COM1'], dtype=object)})
+        totals.update(chunk)
+        rows = [(level, group, list(values[:3])) for level, group, values in totals.rows()]
+        self.assertEqual(rows, [('Grid', '', [4, 4, 25.0]), ('OccupancyClass', 'COM1', [2, 2, 12.5]), ('OccupancyClass', 'RES1', [2, 2, 12.5])])
+
+    def testAALWeights(self):
+        self.assertEqual(udf_engine.aalWeights([100, 10]).round(6).tolist(), [0.045, 0.045])
+        self.assertEqual(udf_engine.aalWeights([10, 100, 20]).round(6).tolist(), [0.025, 0.02, 0.045])
+        self.assertEqual(udf_engine.returnPeriodSuffix(100), 'rp100')
+        with self.assertRaises(ValueError):
+            udf_engine.aalWeights([100, 100])
+
+    def testScenarioHeights(self):
+        ffh = np.array([1.0, np.nan])
+        self.assertEqual(udf_sweep.scenarioHeights(ffh, 0, np.array([0.0, 2.0]))[0].tolist(), [1.0, 3.0])
+        heights = np.array([[1.0, 2.0], [3.0, 4.0], [5.0, 6.0]])
+        self.assertEqual(udf_sweep.scenarioHeights(ffh, 1, firstFloorHeights=heights).tolist(), [[3.0, 4.0], [5.0, 6.0]])
+        with self.assertRaises(ValueError):
+            udf_sweep.scenarioHeights(ffh, 2, heights)
+
+    def testEnsemblePerturbations(self):
+        raw = np.array([2.0, 0.0, 3.0, 1.0])
+        ffh = np.ones(4)
+        whole = udf_ensemble.Perturbations(seed=3).draw(raw, ffh)
+        chunks = udf_ensemble.Perturbations(seed=3)
+        parts = [chunks.draw(raw[:1], ffh[:1]), chunks.draw(raw[1:], ffh[1:])]
+        for i in range(3):
+            self.assertEqual(whole[i].tolist(), np.concatenate([part[i] for part in parts]).tolist())
+        self.assertEqual(whole[0][1], 0.0)
+        self.assertEqual(udf_ensemble.statisticNames([5, 97.5]), ['mean', 'p5', 'p97.5'])
+
+    def testCheckpointResume(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'results.csv')
+            checkpointDir = os.path.join(folder, 'checkpoint')
+            checkpoint = udf_checkpoint.Checkpoint(checkpointDir, {'grids': ['a.tif']})
+            f = checkpoint.open(path)
+            f.write('header\nrow1\n')
+            checkpoint.commit(1, 1, {path: f}, {'records': 1}, [('a.tif', 1)])
+            f.write('row2\n')
+            f.close()
+
+            checkpoint = udf_checkpoint.Checkpoint(checkpointDir, {'grids': ['a.tif']}, resume=True)
+            self.assertTrue(checkpoint.resumed)
+            self.assertEqual((checkpoint.chunks, checkpoint.records, checkpoint.state()), (1, 1, {'records': 1}))
+            with checkpoint.open(path) as f:
+                f.write('row3\n')
+            with open(path) as f:
+                self.assertEqual(f.read(), 'header\nrow1\nrow3\n')
+            checkpoint = udf_checkpoint.Checkpoint(checkpointDir, {'grids': ['b.tif']}, resume=True)
+            self.assertFalse(checkpoint.resumed)
+            self.assertIsNone(checkpoint.state())
+            with self.assertRaises(ValueError):
+                udf_checkpoint.Checkpoint(folder, {})
+
+    def testResultStore(self):
+        cells = np.array([['a', '1'], ['b', None], ['a', '1']], dtype=object)
+        hashes = udf_incremental.rowHashes(cells)
+        self.assertEqual(hashes[0], hashes[2])
+        self.assertNotEqual(hashes[0], hashes[1])
+        with tempfile.TemporaryDirectory() as folder:
+            storeDir = os.path.join(folder, 'store')
+            store = udf_incremental.ResultStore(storeDir, {'library': 'v1'}, [['a.tif', 'k1']])
+            self.assertFalse(store.reusable(0))
+            store.write(0, {'row': np.array(['a,1', 'b,'], dtype=object), 'key': np.array([1.5, -99999.0])})
+            store.append(hashes[:2])
+            store.close()
+            self.assertEqual(sorted(os.listdir(folder)), ['store'])
+
+            store = udf_incremental.ResultStore(storeDir, {'library': 'v1'}, [['b.tif', 'k2'], ['a.tif', 'k1']])
+            self.assertEqual([store.reusable(0), store.reusable(1)], [False, True])
+            positions = store.lookup(udf_incremental.rowHashes(np.array([['b', None], ['c', '2']], dtype=object)))
+            self.assertEqual(positions.tolist(), [1, -1])
+            self.assertEqual(store.stored(1, positions[:1])['row'].tolist(), ['b,'])
+            store.discard()
+            store = udf_incremental.ResultStore(storeDir, {'library': 'v2'}, [['a.tif', 'k1']])
+            self.assertFalse(store.reusable(0))
+            self.assertEqual(store.lookup(hashes).tolist(), [-1, -1, -1])
+            store.discard()
+
+    def testSortedResultsRuns(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'results_sorted.csv')
+            sortedResults = SortedResults(path, ['ID', 'Depth_in_Struc'], runRecords=2)
+            sortedResults.append(['a,1', 'b,-99999', 'c,3.5'], [1, -99999, 3.5])
+            sortedResults.append(['d,1', 'e,3.5'], [1, 3.5])
+            sortedResults.close()
+            with open(path, newline='') as f:
+                self.assertEqual(f.read(), 'ID,Depth_in_Struc\r\nc,3.5\r\ne,3.5\r\na,1\r\nd,1\r\nb,-99999\r\n')
+            self.assertEqual(os.listdir(folder), ['results_sorted.csv'])
+
+    def testArrowResultsRowGroups(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'results.parquet')
+            arrowResults = ArrowResults(path, 'parquet', ['ID', 'Depth_in_Struc'])
+            for ids, depths in [(['a', 'b'], [1.5, None]), (['c'], [-99999.0])]:
+                arrowResults.write(recordBatch({'ID': pa.array(ids), 'Depth_in_Struc': pa.array(depths, type=pa.float64())}))
+            arrowResults.close()
+            self.assertEqual(pq.ParquetFile(path).num_row_groups, 2)
+            self.assertEqual(pq.read_table(path).column('Depth_in_Struc').to_pylist(), [1.5, None, -99999.0])
+
+    def testArrayDepthGrid(self):
+        depths = np.array([[1.5, -9999], [0.0, 3.0]], dtype=np.float32)
+        grid = ArrayDepthGrid(depths, (-90.0, 0.5, 0, 30.0, 0, -0.5), noData=-9999)
+        raw, sampled = grid.sample(np.array([29.9, 29.9, 29.1, 28.0]), np.array([-89.9, -89.4, -89.4, -89.9]))
+        self.assertEqual(raw.tolist(), [1.5, 0.0, 3.0, 0.0])
+        self.assertEqual(list(sampled), [True, False, True, False])
+
+    def testDepthGridStatePlaneFeet(self):
+        # NAD83 / Louisiana South (ftUS): a projected grid in US survey feet, not metres
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(3452)
+        lat, lon = np.array([29.95, 29.95, 31.0]), np.array([-90.07, -90.069, -90.07])
+        points = np.array(DepthGrid.coordinateTransformation(srs).TransformPoints([[lon[0], lat[0]], [lon[1], lat[1]]]))
+        # 0.001 degree of longitude is about 96.5 m here, or 317 feet
+        self.assertAlmostEqual(points[1, 0] - points[0, 0], 317, delta=3)
+        depths = np.arange(100, dtype=np.float32).reshape(10, 10)
+        grid = ArrayDepthGrid(depths, (points[0, 0] - 250, 100, 0, points[0, 1] + 250, 0, -100), srs.ExportToWkt(), noData=-9999)
+        self.assertFalse(grid.isUTM)
+        raw, sampled = grid.sample(lat, lon)
+        self.assertEqual(list(sampled), [True, True, False])
+        self.assertEqual(raw.tolist(), [22.0, 25.0, 0.0])
+
+    def testSamplingPlan(self):
+        geoTransform = (-90.0, 0.5, 0, 30.0, 0, -0.5)
+        grids = [ArrayDepthGrid(np.array([[1.5, 2.0], [0.0, 3.0]]) * scale, geoTransform) for scale in [1, 2]]
+        lat, lon = np.array([29.9, 29.1, 28.0, np.nan]), np.array([-89.4, -89.4, -89.9, -89.9])
+        with tempfile.TemporaryDirectory() as folder:
+            plan = SamplingPlan(folder)
+            for grid, expected in zip(grids, [[2.0, 3.0, 0.0, 0.0], [4.0, 6.0, 0.0, 0.0]]):
+                raw, sampled = grid.sample(lat, lon, PointCache(plan), 0)
+                self.assertEqual(raw.tolist(), expected)
+                self.assertEqual(list(sampled), [True, True, False, False])
+            self.assertEqual((plan.saves, len(os.listdir(folder))), (1, 1))
+            plan = SamplingPlan(folder)
+            row, col, inside = grids[0].indices(lat, lon, PointCache(plan))
+            self.assertEqual((row.tolist(), col.tolist(), list(inside)), ([0, 1, 0, 0], [1, 1, 0, 0], [True, True, False, False]))
+            self.assertEqual(plan.loads, 1)
+            grids[0].sample(lat[:2], lon[:2], PointCache(plan))
+            self.assertEqual(plan.saves, 1)
+
+    def testSamplingPlanPrune(self):
+        with tempfile.TemporaryDirectory() as folder:
+            now = time.time()
+            for name, used in [('old.npz', now - 3 * 86400), ('a.npz', now - 20), ('b.npz', now - 10), ('old.npz.1.partial', now - 3 * 86400)]:
+                path = os.path.join(folder, name)
+                with open(path, 'wb') as f:
+                    f.write(b'\0' * 100)
+                os.utime(path, (used, used))
+            SamplingPlan(folder, maxAge=86400, maxBytes=1000)
+            self.assertEqual(sorted(os.listdir(folder)), ['a.npz', 'b.npz'])
+            SamplingPlan(folder, maxAge=86400, maxBytes=150)
+            self.assertEqual(os.listdir(folder), ['b.npz'])
+
+    def testSpatialChunks(self):
+        self.assertEqual(mortonKeys(np.array([0, 0, 1, 1, 2]), np.array([0, 1, 0, 1, 0])).tolist(), [0, 1, 2, 3, 8])
+        chunks = [np.array([['a', '3'], ['b', '1']], dtype=object), np.array([['c', '2']], dtype=object)]
+        spatial = list(udf_engine.spatialChunks(iter(chunks), lambda cells: cells[:, 1].astype(int), 2))
+        self.assertEqual([cells[:, 0].tolist() for cells, window in spatial], [['b', 'c'], ['a']])
+        window = spatial[0][1]
+        self.assertEqual(window.restore([['b', 'c'], ['a']]), [['a', 'b'], ['c']])
+        restored = window.restore([({'key': np.array([1, 2])}, None), ({'key': np.array([3])}, None)])
+        self.assertEqual([(chunk['key'].tolist(), other) for chunk, other in restored], [([3, 1], None), ([2], None)])
+
+    def testReadGeoParquet(self):
+        import json
+        import struct
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        points = [struct.pack('<BIdd', 1, 1, -89.5, 29.75), None, struct.pack('<BIdd', 1, 1, -90.0, 30.0)]
+        table = pa.table({'ID': ['a', 'b', 'c'], 'Notes': ['x', 'y', 'z'], 'Cost': [1500.0, None, 2.5],
+                          'CensusTract': ['22071', '22071', '22051'], 'geometry': pa.array(points, pa.binary())})
+        geo = {'version': '1.0.0', 'primary_column': 'geometry', 'columns': {'geometry': {'encoding': 'WKB'}}}
+        fields = udf_engine.UDFFields(FieldMap(UserDefinedFltyId='ID', Cost='Cost', latitude='Lat', longitude='Lon'))
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'inventory.parquet')
+            pq.write_table(table.replace_schema_metadata({b'geo': json.dumps(geo).encode()}), path, row_group_size=2)
+            self.assertTrue(udf_vector.isVector(path))
+            fieldnames, chunks = udf_engine.readInventory(path, 2, fields)
+            chunks = [cells.tolist() for cells in chunks]
+        self.assertEqual(fieldnames, ['ID', 'Cost', 'CensusTract', 'Lat', 'Lon'])
+        self.assertEqual(chunks, [[['a', '1500', '22071', '29.75', '-89.5'], ['b', '', '22071', '', '']],
+                                  [['c', '2.5', '22051', '30.0', '-90.0']]])
+
+    def testFootprintZonalDepths(self):
+        depths = np.arange(36, dtype=np.float32).reshape(6, 6)
+        depths[0, 0] = -9999
+        grid = ArrayDepthGrid(depths, (0.0, 1.0, 0, 6.0, 0, -1.0), noData=-9999)
+        # A 4 x 4 pixel square with a 2 x 2 pixel hole, and a square within a single pixel
+        x = [0.0, 4.0, 4.0, 0.0, 1.0, 3.0, 3.0, 1.0, 5.2, 5.8, 5.8, 5.2]
+        y = [6.0, 6.0, 2.0, 2.0, 5.0, 5.0, 3.0, 3.0, 0.8, 0.8, 0.2, 0.2]
+        footprints = Footprints(['a', 'b', 'c'], x, y, [0, 4, 8, 12], [0, 2, 3, 3])
+        positions = footprints.lookup([' a', 'b', 'none'])
+        self.assertEqual(positions.tolist(), [0, 1, -1])
+        lat, lon = np.array([5.5, 0.5, 0.5]), np.array([0.5, 5.5, 0.5])
+        raw, sampled = zonalDepths(grid, footprints, positions, lat, lon, 'max')
+        self.assertEqual(raw.tolist(), [21.0, 35.0, 30.0])
+        self.assertEqual(list(sampled), [True, True, True])
+        ring = [0, 1, 2, 3, 6, 9, 12, 15, 18, 19, 20, 21]
+        raw, sampled = zonalDepths(grid, footprints, positions, lat, lon, 'mean')
+        self.assertAlmostEqual(raw[0], sum(ring) / 12)
+        raw, sampled = zonalDepths(grid, footprints, positions, lat, lon, 'p50')
+        self.assertEqual(raw[0], np.percentile([0] + ring[1:], 50))
+
+    def testGridCache(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'depth.tif')
+            raster = gdal.GetDriverByName('GTiff').Create(path, 600, 600, 1, gdal.GDT_Float32)
+            raster.SetGeoTransform((-90.0, 0.01, 0, 30.0, 0, -0.01))
+            band = raster.GetRasterBand(1)
+            band.SetNoDataValue(-9999)
+            band.WriteArray(np.arange(600 * 600, dtype=np.float32).reshape(600, 600))
+            raster = None
+
+            cacheDir = os.path.join(folder, 'cache')
+            prepared = grid_cache.prepareGrid(path, cacheDir)
+            self.assertEqual(os.path.dirname(prepared), cacheDir)
+            self.assertEqual(grid_cache.prepareGrid(path, cacheDir), prepared)
+            self.assertEqual(grid_cache.gridPath(path, cacheDir), prepared)
+            self.assertEqual(grid_cache.gridPath(path, False), path)
+            self.assertEqual(grid_cache.prepareGrid(prepared, cacheDir), prepared)
+            copy = gdal.Open(prepared)
+            self.assertTrue(grid_cache.isPrepared(copy))
+            self.assertEqual(copy.GetRasterBand(1).GetNoDataValue(), -9999)
+            self.assertEqual(copy.GetGeoTransform(), (-90.0, 0.01, 0, 30.0, 0, -0.01))
+            self.assertTrue((copy.GetRasterBand(1).ReadAsArray() == gdal.Open(path).ReadAsArray()).all())
+            copy = None
+            os.utime(path, ns=(0, 0))
+            self.assertNotEqual(grid_cache.prepareGrid(path, cacheDir), prepared)
+            self.assertEqual(len(os.listdir(cacheDir)), 1)
+
+    def testFieldMap(self):
+        fmap = FieldMap(UserDefinedFltyId='ID', OccupancyClass='Occ', latitude='Lat', longitude='Lon')
+        self.assertEqual(udf_engine.fieldMap(list(fmap)), fmap)
+        self.assertEqual(udf_engine.UDFFields(fmap._asdict()).latitude, 'Lat')
+
+    def _udfFixture(self, folder, records=300):
+        """Writes lookup tables, a depth grid and an inventory of records buildings to folder
+
+        Returns:
+            inventory: str -- the inventory csv
+            lutDir: str -- the lookup tables folder
+            grid: str -- the depth grid
+        """
+        rng = np.random.default_rng(0)
+        curve = lambda: [str(value) for value in np.sort(np.round(rng.uniform(0, 100, len(DEPTH_COLUMNS)), 1))]
+        occupancies = ['RES1', 'RES3A', 'COM1', 'IND1']
+        lutDir = os.path.join(folder, 'lut')
+        os.mkdir(lutDir)
+
+        def write(name, header, rows):
+            with open(os.path.join(lutDir, LUT_FILES[name]), 'w', newline='') as f:
+                csv.writer(f).writerows([header] + rows)
+        soids = sorted(set(udf_engine._specificOccupancyId(oc, ft, ns) for oc in occupancies for ft in [4.0, 7.0] for ns in [1.0, 2.0, 5.0]))
+        for name in ['bddf_riverine', 'bddf_coastalA', 'bddf_coastalV', 'cddf_riverine', 'cddf_coastalA', 'cddf_coastalV', 'iddf_riverine']:
+            write(name, ['SpecificOccupId', 'DDF_ID', 'Occupancy'] + DEPTH_COLUMNS, [[soid, str(100 + i), 'X'] + curve() for i, soid in enumerate(soids)])
+        for name in ['bddf_full', 'cddf_full', 'iddf_full']:
+            write(name, [LUT_KEYS[name], 'Occupancy'] + DEPTH_COLUMNS, [[str(i), occupancies[i % 4]] + curve() for i in range(1, 9)])
+        write('iecon', ['Occupancy', 'AnnualSalesPerSqFt', 'BusinessInvPctofSales'], [[oc, '55.5', '10'] for oc in occupancies])
+        write('debris', ['DebrisID', 'Finishes', 'Structure', 'Foundation'],
+              [[oc + basement + footing + depth, '1.5', '2.25', '0.5'] for oc in occupancies for basement in ['B', 'NB']
+               for footing in ['SG', 'FT'] for depth in ['-8', '-4', '0', '1', '4', '6', '8', '12', '']])
+        write('rest', ['RestFnID', 'Min_Restor_Days', 'Max_Restor_Days'],
+              [[oc + depth, '30', '120'] for oc in occupancies for depth in ['0', '1', '4', '8', '12', '24']])
+
+        grid = os.path.join(folder, 'depth.tif')
+        raster = gdal.GetDriverByName('GTiff').Create(grid, 40, 40, 1, gdal.GDT_Float32)
+        raster.SetGeoTransform((-90.0, 0.01, 0, 30.0, 0, -0.01))
+        spatialReference = osr.SpatialReference()
+        spatialReference.ImportFromEPSG(4326)
+        raster.SetProjection(spatialReference.ExportToWkt())
+        band = raster.GetRasterBand(1)
+        band.SetNoDataValue(-9999)
+        band.WriteArray(rng.choice([-9999.0, 0.0, 0.5, 1.25, 3.0, 7.5, 12.0, 30.0], (40, 40)).astype(np.float32))
+        raster = None
+
+        inventory = os.path.join(folder, 'inventory.csv')
+        with open(inventory, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['ID', 'Occ', 'Cost', 'Area', 'NumStories', 'FoundationType', 'FFH', 'BDDF', 'Lat', 'Lon', 'Note'])
+            for i in range(records):
+                writer.writerow([str(i), occupancies[i % 4], str(rng.integers(1000, 900000)), str(round(rng.uniform(100, 9000), 1)),
+                                 str(rng.choice([1, 2, 5])), str(rng.choice([4, 7])), str(rng.choice([0, 1, 2.5])),
+                                 rng.choice(['', '', '3', '999']), str(round(rng.uniform(29.605, 29.995), 5)),
+                                 str(round(rng.uniform(-89.995, -89.605), 5)), rng.choice(['plain', 'has,comma', 'has "quote"', ''])])
+        return inventory, lutDir, grid
+
+    def _udfRun(self, records=300):
+        """Writes the _udfFixture to a temporary folder, the working folder until the test ends as the log is written to Log\\app.log in it
+
+        Returns:
+            folder: str -- the temporary folder
+            inventory: str -- the inventory csv
+            lutDir: str -- the lookup tables folder
+            grid: str -- the depth grid
+        """
+        temporary = tempfile.TemporaryDirectory()
+        self.addCleanup(temporary.cleanup)
+        folder = temporary.name
+        inventory, lutDir, grid = self._udfFixture(folder, records)
+        os.mkdir(os.path.join(folder, 'Log'))
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(folder)
+        self.addCleanup(self._closeLog)
+        return folder, inventory, lutDir, grid
+
+    @staticmethod
+    def _closeLog():
+        logger = logging.getLogger('FAST')
+        for handler in logger.handlers[:]:
+            handler.close()
+            logger.removeHandler(handler)
+
+    def _floodDamage(self, folder, run, inventory, lutDir, grids, **kwargs):
+        """Runs flood_damage with the columnar engine on the _udfFixture, writing to the folder run
+
+        Returns:
+            results: str -- the results folder
+        """
+        results = os.path.join(folder, run)
+        os.mkdir(results)
+        result = UDF.flood_damage(inventory, lutDir, results, grids, 'False', UDF_FMAP, engine='columnar', chunkSize=64, **kwargs)
+        self.assertTrue(result[0], result[1])
+        return results
+
+    def _readResults(self, path):
+        """Reads a results csv
+
+        Returns:
+            header: list<str> -- the field names
+            rows: list<list<str>> -- the records
+        """
+        with open(path, newline='') as f:
+            rows = list(csv.reader(f))
+        return rows[0], rows[1:]
+
+    def _copyGrid(self, grid, path, change):
+        """Writes the _udfFixture grid to path with its depths changed by the function change
+
+        Returns:
+            path: str -- the new grid
+        """
+        source = gdal.Open(grid)
+        depths = source.GetRasterBand(1).ReadAsArray(0, 0, 40, 40)
+        raster = gdal.GetDriverByName('GTiff').Create(path, 40, 40, 1, gdal.GDT_Float32)
+        raster.SetGeoTransform(source.GetGeoTransform())
+        raster.SetProjection(source.GetProjection())
+        band = raster.GetRasterBand(1)
+        band.SetNoDataValue(-9999)
+        band.WriteArray(change(depths).astype(np.float32))
+        source = raster = None
+        return path
+
+    def _assertSameTable(self, path, table):
+        """Asserts a pyarrow table holds the values of the results csv path, blank numbers as nulls"""
+        header, rows = self._readResults(path)
+        # A field repeated in the csv header is one column of the table, as in a DataFrame
+        column = dict((name, i) for i, name in enumerate(header))
+        self.assertEqual(table.column_names, list(column))
+        self.assertEqual(table.num_rows, len(rows))
+        for name in table.column_names:
+            values = table.column(name).to_pylist()
+            cells = [row[column[name]] for row in rows]
+            for value, cell in zip(values, cells):
+                if value is None:
+                    self.assertEqual(cell, '', name)
+                else:
+                    self.assertEqual(value, cell if isinstance(value, str) else float(cell), name)
+
+    def testFloodDamageEngines(self):
+        same = lambda a, b: [filecmp.cmp(os.path.join(a, name), os.path.join(b, name), shallow=False) for name in UDF_RESULTS]
+        folder, inventory, lutDir, grid = self._udfRun()
+        runs = {'rows': os.path.join(folder, 'rows')}
+        os.mkdir(runs['rows'])
+        self.assertTrue(UDF.flood_damage_rows(inventory, lutDir, runs['rows'], [grid], 'False', UDF_FMAP)[0])
+        for run, kwargs in [('columnar', {}), ('workers', {'workers': 2}), ('incremental', {'incremental': True})]:
+            runs[run] = self._floodDamage(folder, run, inventory, lutDir, [grid], **kwargs)
+        with open(os.path.join(runs['rows'], UDF_RESULTS[0])) as f:
+            self.assertEqual(len(f.readlines()), 301)
+        for run in ['columnar', 'workers', 'incremental']:
+            self.assertEqual(same(runs['rows'], runs[run]), [True, True])
+
+        # NaN pixels are noData to the columnar engine; the row engine stops at them
+        os.mkdir(os.path.join(folder, 'nan'))
+        nanGrid = self._copyGrid(grid, os.path.join(folder, 'nan', 'depth.tif'), lambda depths: np.where(depths == -9999, np.nan, depths))
+        runs['nanRows'] = os.path.join(folder, 'nanRows')
+        os.mkdir(runs['nanRows'])
+        self.assertFalse(UDF.flood_damage_rows(inventory, lutDir, runs['nanRows'], [nanGrid], 'False', UDF_FMAP)[0])
+        runs['nanColumnar'] = self._floodDamage(folder, 'nanColumnar', inventory, lutDir, [nanGrid])
+        self.assertEqual(same(runs['rows'], runs['nanColumnar']), [True, True])
+
+        # Edit a record, drop one and add one: the incremental rerun writes the files of a full run
+        with open(inventory, newline='') as f:
+            rows = list(csv.reader(f))
+        rows[5][2] = '123456'
+        del rows[40]
+        rows.append(['300', 'COM1', '50000', '2500.0', '2', '7', '1', '', '29.95', '-89.95', 'new'])
+        with open(inventory, 'w', newline='') as f:
+            csv.writer(f).writerows(rows)
+        result = UDF.flood_damage(inventory, lutDir, runs['incremental'], [grid], 'False', UDF_FMAP, engine='columnar', chunkSize=64,
+                                  incremental=True)
+        self.assertTrue(result[0], result[1])
+        full = self._floodDamage(folder, 'full', inventory, lutDir, [grid])
+        # Options of the columnar engine are not ignored by the row engine, the default
+        with self.assertRaises(ValueError):
+            UDF.flood_damage(inventory, lutDir, full, [grid], 'False', UDF_FMAP, workers=2)
+        self.assertEqual(same(full, runs['incremental']), [True, True])
+        self.assertEqual(same(runs['rows'], runs['incremental']), [False, False])
+
+    def testFloodDamageFormats(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        folder, inventory, lutDir, grid = self._udfRun()
+        csvRun = self._floodDamage(folder, 'csv', inventory, lutDir, [grid])
+        parquetRun = self._floodDamage(folder, 'parquet', inventory, lutDir, [grid], format='parquet')
+        arrowRun = self._floodDamage(folder, 'arrow', inventory, lutDir, [grid], format='arrow')
+        # Typed results have no sorted copy
+        self.assertEqual(os.listdir(parquetRun), ['inventory_depth.parquet'])
+        self.assertEqual(os.listdir(arrowRun), ['inventory_depth.arrow'])
+        path = os.path.join(csvRun, UDF_RESULTS[0])
+        self._assertSameTable(path, pq.read_table(os.path.join(parquetRun, 'inventory_depth.parquet')))
+        with pa.memory_map(os.path.join(arrowRun, 'inventory_depth.arrow')) as source:
+            self._assertSameTable(path, pa.ipc.open_file(source).read_all())
+
+    def testFloodDamageWide(self):
+        folder, inventory, lutDir, grid = self._udfRun()
+        grids = [grid, self._copyGrid(grid, os.path.join(folder, 'depth500.tif'), lambda depths: np.where(depths > 0, depths * 1.5, depths))]
+        csvRun = self._floodDamage(folder, 'csv', inventory, lutDir, grids)
+        wideRun = self._floodDamage(folder, 'wide', inventory, lutDir, grids, wide=True)
+        self.assertEqual(os.listdir(wideRun), ['inventory_wide.csv'])
+        header, rows = self._readResults(os.path.join(wideRun, 'inventory_wide.csv'))
+        inventoryHeader, inventoryRows = self._readResults(inventory)
+        self.assertEqual(header, udf_engine.UDFFields(UDF_FMAP).wideHeader(inventoryHeader, ['depth', 'depth500']))
+        # The inventory fields are not overwritten: the DDF used is the BDDF_ID of every grid
+        self.assertEqual([row[:len(inventoryHeader)] for row in rows], inventoryRows)
+        for suffix in ['depth', 'depth500']:
+            gridHeader, gridRows = self._readResults(os.path.join(csvRun, 'inventory_' + suffix + '.csv'))
+            self.assertEqual(len(rows), len(gridRows))
+            # The shared fields once, the others with the grid name as suffix
+            column = lambda name: len(inventoryHeader) + udf_engine.NEW_FIELDS.index(name)
+            columns = [(header.index(name), column(name)) for name in udf_engine.SHARED_FIELDS]
+            columns += [(header.index(name + '_' + suffix), column(name)) for name in udf_engine.GRID_FIELDS]
+            for row, gridRow in zip(rows, gridRows):
+                self.assertEqual([row[i] for i, j in columns], [gridRow[j] for i, j in columns])
+
+    def testFloodDamageFrame(self):
+        import pandas as pd
+        import pyarrow as pa
+        folder, inventory, lutDir, grid = self._udfRun()
+        csvRun = self._floodDamage(folder, 'csv', inventory, lutDir, [grid])
+        frame = pd.read_csv(inventory, dtype=str, keep_default_na=False)
+        results = UDF.flood_damage_frame(frame, lutDir, [grid], UDF_FMAP, chunkSize=64)
+        self.assertEqual(list(results), ['depth.tif'])
+        self.assertTrue(results['depth.tif'].index.equals(frame.index))
+        # NaN and <NA> are the empty cells of the csv
+        self._assertSameTable(os.path.join(csvRun, UDF_RESULTS[0]), pa.Table.from_pandas(results['depth.tif'], preserve_index=False))
+
+    def testFloodDamageSummary(self):
+        folder, inventory, lutDir, grid = self._udfRun()
+        # Census fields, with blocks numbered in their tract, by GEOID or missing
+        header, rows = self._readResults(inventory)
+        tracts = ['22071000100', '22071000200', '22071000300']
+        blocks = lambda i: [str(1000 + i % 2), tracts[i % 3] + str(1000 + i % 2), ''][i % 5 % 3]
+        with open(inventory, 'w', newline='') as f:
+            csv.writer(f).writerows([header + udf_summary.CENSUS_FIELDS] + [row + [tracts[i % 3], blocks(i)] for i, row in enumerate(rows)])
+        grids = [grid, self._copyGrid(grid, os.path.join(folder, 'depth500.tif'), lambda depths: np.where(depths > 0, depths * 1.5, depths))]
+        csvRun = self._floodDamage(folder, 'csv', inventory, lutDir, grids)
+        summaryRun = self._floodDamage(folder, 'summary', inventory, lutDir, grids, summary=True)
+        # The results are those of a run without summary
+        names = ['inventory_' + suffix + ending for suffix in ['depth', 'depth500'] for ending in ['.csv', '_sorted.csv']]
+        self.assertEqual(sorted(os.listdir(summaryRun)), sorted(names + ['inventory_summary.csv']))
+        self.assertEqual(filecmp.cmpfiles(csvRun, summaryRun, names, shallow=False)[0], names)
+
+        summaryHeader, summaryRows = self._readResults(os.path.join(summaryRun, 'inventory_summary.csv'))
+        self.assertEqual(summaryHeader, ['GridName', 'Level', 'Group'] + udf_summary.SUMMARY_FIELDS)
+        for gridName, suffix in [('depth.tif', 'depth'), ('depth500.tif', 'depth500')]:
+            results = self._readResults(os.path.join(csvRun, 'inventory_' + suffix + '.csv'))[1]
+            column = lambda name: len(header) + 2 + udf_engine.NEW_FIELDS.index(name)
+            expected = {}
+            for i, row in enumerate(results):
+                # Totals of the records sampled on the grid, blank losses counting as none
+                if row[column('Depth_Grid')] == '':
+                    continue
+                exposed = row[column('flExp')] == '1' and row[column('BDDF_ID')] != 'Unmatched'
+                values = np.array([1, int(exposed)] + [float(row[column(name)] or 0) for name in udf_summary.SUMMARY_FIELDS[2:]])
+                block = blocks(i) if len(blocks(i)) in [0, 15] else tracts[i % 3] + '/' + blocks(i)
+                for key in [('Grid', ''), ('OccupancyClass', row[1]), ('CensusTract', tracts[i % 3]), ('CensusBlock', block)]:
+                    expected[key] = expected.get(key, 0) + values
+            totals = dict(((level, group), np.array(values, dtype=float)) for name, level, group, *values in summaryRows if name == gridName)
+            self.assertEqual(sorted(totals), sorted(expected))
+            for key in expected:
+                np.testing.assert_allclose(totals[key], expected[key], rtol=1e-12, err_msg=str(key))
+
+    def testFloodDamageAAL(self):
+        folder, inventory, lutDir, grid = self._udfRun()
+        # A record without its cost is skipped, so it has no AAL
+        header, rows = self._readResults(inventory)
+        rows[3][header.index('Cost')] = ''
+        with open(inventory, 'w', newline='') as f:
+            csv.writer(f).writerows([header] + rows)
+        grids = [grid, self._copyGrid(grid, os.path.join(folder, 'depth500.tif'), lambda depths: np.where(depths > 0, depths * 1.5, depths))]
+        csvRun = self._floodDamage(folder, 'csv', inventory, lutDir, grids)
+        aalRun = self._floodDamage(folder, 'aal', inventory, lutDir, grids, returnPeriods=[100, 500], aalDetail=True)
+        self.assertEqual(os.listdir(aalRun), ['inventory_aal.csv'])
+        header, rows = self._readResults(os.path.join(aalRun, 'inventory_aal.csv'))
+        inventoryHeader, inventoryRows = self._readResults(inventory)
+        self.assertEqual(header, udf_engine.UDFFields(UDF_FMAP).aalHeader(inventoryHeader, ['rp100', 'rp500'], True))
+        self.assertEqual([row[:len(inventoryHeader)] for row in rows], inventoryRows)
+        column = lambda name: len(inventoryHeader) + udf_engine.NEW_FIELDS.index(name)
+        losses = []
+        for suffix, returnPeriod in [('depth', 'rp100'), ('depth500', 'rp500')]:
+            gridRows = self._readResults(os.path.join(csvRun, 'inventory_' + suffix + '.csv'))[1]
+            columns = [(header.index(name), column(name)) for name in udf_engine.SHARED_FIELDS]
+            columns += [(header.index(name + '_' + returnPeriod), column(name)) for name in udf_engine.RETURN_PERIOD_FIELDS]
+            for row, gridRow in zip(rows, gridRows):
+                self.assertEqual([row[i] for i, j in columns], [gridRow[j] for i, j in columns])
+            losses.append([[gridRow[column(name)] for name in udf_engine.RETURN_PERIOD_FIELDS] for gridRow in gridRows])
+
+        # The AAL integrates the losses over the exceedance probabilities 1/100 and 1/500: both weigh 0.004.
+        # Records without losses at a return period (not processed) have none.
+        aal = np.array([[float(row[header.index(name)] or 'nan') for name in udf_engine.AAL_FIELDS] for row in rows])
+        cells = np.array(losses)
+        complete = (cells != '').all(axis=(0, 2))
+        self.assertEqual(list(np.flatnonzero(~complete)), [3])
+        expected = np.where(complete[:, None], 0.004 * np.where(cells == '', '0', cells).astype(float).sum(axis=0), np.nan)
+        np.testing.assert_allclose(aal[:, :3], expected, rtol=1e-12)
+        np.testing.assert_allclose(aal[:, 3], expected.sum(axis=1), rtol=1e-12)
+
+    def testFloodDamageResume(self):
+        folder, inventory, lutDir, grid = self._udfRun()
+        grids = [grid, self._copyGrid(grid, os.path.join(folder, 'depth500.tif'), lambda depths: np.where(depths > 0, depths * 1.5, depths))]
+        csvRun = self._floodDamage(folder, 'csv', inventory, lutDir, grids)
+        # Commit every chunk, and fail on the fourth chunk of the second grid as a lost network share would
+        runGrids, computeDamage = udf_engine.runGrids, udf_engine.computeDamage
+        self.addCleanup(setattr, udf_engine, 'runGrids', runGrids)
+        self.addCleanup(setattr, udf_engine, 'computeDamage', computeDamage)
+        udf_engine.runGrids = lambda *args, **kwargs: runGrids(*args, checkpointRecords=64, **kwargs)
+        calls = []
+
+        def failing(*args, **kwargs):
+            calls.append(args[3])
+            if len(calls) == 8:
+                raise IOError('The network path was not found')
+            return computeDamage(*args, **kwargs)
+        udf_engine.computeDamage = failing
+        resumed = os.path.join(folder, 'resumed')
+        os.mkdir(resumed)
+        self.assertFalse(UDF.flood_damage(inventory, lutDir, resumed, grids, 'False', UDF_FMAP, engine='columnar', chunkSize=64, checkpoint=True)[0])
+        self.assertEqual(calls[-1], 'depth500.tif')
+        self.assertTrue(os.path.isdir(os.path.join(resumed, 'inventory_checkpoint')))
+
+        udf_engine.computeDamage = computeDamage
+        with self.assertLogs('FAST', 'INFO') as logs:
+            result = UDF.flood_damage(inventory, lutDir, resumed, grids, 'False', UDF_FMAP, engine='columnar', chunkSize=64, resume=True)
+        self.assertTrue(result[0], result[1])
+        # The three chunks before the failure were committed
+        self.assertIn('INFO:FAST:resuming after record 192', logs.output)
+        # The outputs of an uninterrupted run, and no checkpoint
+        self.assertEqual(sorted(os.listdir(resumed)), sorted(os.listdir(csvRun)))
+        names = os.listdir(csvRun)
+        self.assertEqual(filecmp.cmpfiles(csvRun, resumed, names, shallow=False)[0], names)
+
+    def testFloodDamageFootprints(self):
+        folder, inventory, lutDir, grid = self._udfRun()
+        csvRun = self._floodDamage(folder, 'csv', inventory, lutDir, [grid])
+        # The grid moved a pixel west: its pixels hold the depths of the pixels east of them
+        os.mkdir(os.path.join(folder, 'west'))
+        west = self._copyGrid(grid, os.path.join(folder, 'west', 'depth.tif'),
+                              lambda depths: np.column_stack([depths[:, 1:], np.full(40, -9999, dtype=depths.dtype)]))
+        westRun = self._floodDamage(folder, 'westCsv', inventory, lutDir, [west])
+
+        # Squares within a pixel: buildings with an even ID in their own pixel, the others in the pixel east of them.
+        # Buildings near a pixel edge have none, as buildings on the east edge of the grid.
+        header, rows = self._readResults(inventory)
+        ids, x, y, expected = [], [], [], []
+        for row in rows:
+            column, line = (float(row[header.index('Lon')]) + 90) / 0.01, (30 - float(row[header.index('Lat')])) / 0.01
+            east = int(row[0]) % 2
+            if min(abs(column - round(column)), abs(line - round(line))) < 1e-6 or int(column) + east > 39:
+                expected.append(csvRun)
+                continue
+            ids.append(row[0])
+            centerX, centerY = -90 + (int(column) + east + 0.5) * 0.01, 30 - (int(line) + 0.5) * 0.01
+            x += [centerX - 0.002, centerX + 0.002, centerX + 0.002, centerX - 0.002]
+            y += [centerY + 0.002, centerY + 0.002, centerY - 0.002, centerY - 0.002]
+            expected.append(westRun if east else csvRun)
+        footprints = Footprints(ids, x, y, np.arange(0, len(x) + 1, 4), np.arange(len(ids) + 1))
+        self.assertGreater(len(footprints), 250)
+        footprintRun = self._floodDamage(folder, 'footprints', inventory, lutDir, [grid], footprints=footprints)
+        results = self._readResults(os.path.join(footprintRun, UDF_RESULTS[0]))
+        self.assertEqual(results[0], self._readResults(os.path.join(csvRun, UDF_RESULTS[0]))[0])
+        runs = dict((run, self._readResults(os.path.join(run, UDF_RESULTS[0]))[1]) for run in [csvRun, westRun])
+        self.assertEqual(results[1], [runs[run][i] for i, run in enumerate(expected)])
+        self.assertNotEqual(results[1], runs[csvRun])
+
+    def testFloodDamageSpatialOrder(self):
+        folder, inventory, lutDir, grid = self._udfRun()
+        csvRun = self._floodDamage(folder, 'csv', inventory, lutDir, [grid])
+        computeDamage = udf_engine.computeDamage
+        self.addCleanup(setattr, udf_engine, 'computeDamage', computeDamage)
+        uids = []
+
+        def recording(attributes, *args, **kwargs):
+            uids.extend(attributes['uid'])
+            return computeDamage(attributes, *args, **kwargs)
+        udf_engine.computeDamage = recording
+        for spatialOrder in [True, 2]:
+            del uids[:]
+            spatialRun = self._floodDamage(folder, 'spatial' + str(spatialOrder), inventory, lutDir, [grid], spatialOrder=spatialOrder)
+            # The buildings are computed in the order of their pixels, and written in inventory order
+            self.assertNotEqual(uids, sorted(uids, key=float))
+            self.assertEqual(sorted(uids, key=float), [str(i) for i in range(300)])
+            self.assertEqual(sorted(os.listdir(spatialRun)), sorted(UDF_RESULTS))
+            self.assertEqual(filecmp.cmpfiles(csvRun, spatialRun, UDF_RESULTS, shallow=False)[0], UDF_RESULTS)
+
+    def testEnsembleChunkSize(self):
+        fmap = ['ID', 'Occ', 'Cost', 'Area', 'NumStories', 'FoundationType', 'FFH', '', 'BDDF', '', '', '', '', 'Lat', 'Lon', '']
+        with tempfile.TemporaryDirectory() as folder:
+            inventory, lutDir, grid = self._udfFixture(folder, 60)
+            # 7 buildings a chunk, then the whole inventory in one
+            runs = [udf_ensemble.ensembleLosses(inventory, grid, fmap, lutDir, realizations=8, seed=5, chunkSize=chunkSize)
+                    for chunkSize in [56, 8 * 60]]
+        buildings, aggregate = runs[0]
+        self.assertEqual(len(buildings), 60)
+        self.assertTrue((buildings['TotalLossUSD_mean'] > 0).any())
+        self.assertTrue(buildings.equals(runs[1][0]))
+        self.assertEqual(aggregate[['Level', 'Group']].values.tolist(), runs[1][1][['Level', 'Group']].values.tolist())
+        columns = [name for name in aggregate.columns if name not in ['Level', 'Group']]
+        np.testing.assert_allclose(aggregate[columns].to_numpy(dtype=float), runs[1][1][columns].to_numpy(dtype=float), rtol=1e-12)
 
+    def testDamageFunctionLibraryCache(self):
+        with tempfile.TemporaryDirectory() as folder:
+            for name, fileName in LUT_FILES.items():
+                with open(os.path.join(folder, fileName), 'w') as f:
+                    f.write(','.join([LUT_KEYS.get(name, 'SpecificOccupId')] + DEPTH_COLUMNS) + '\n')
+                    f.write(','.join(['R12N'] + ['1'] * len(DEPTH_COLUMNS)) + '\n')
+            with open(os.path.join(folder, LUT_FILES['rest']), 'a') as f:
+                f.write('RES1\n')
+            DamageFunctionLibrary(folder)
+            with np.load(os.path.join(folder, CACHE_FILE), allow_pickle=False) as cached:
+                self.assertIn('meta', cached.files)
+            library = DamageFunctionLibrary(folder)
+            self.assertEqual(library['bddf_riverine'].depths[0, 0], 1.0)
+            self.assertEqual(library['rest'].get('RES1'), DamageFunctionTable(os.path.join(folder, LUT_FILES['rest']), 'RestFnID').get('RES1'))
+            self.assertIsNone(library['rest'].get('RES1')['p0'])
+            with open(os.path.join(folder, LUT_FILES['bddf_riverine']), 'a') as f:
+                f.write(','.join(['C1LN'] + ['2'] * len(DEPTH_COLUMNS)) + '\n')
+            self.assertEqual(list(DamageFunctionLibrary(folder)['bddf_riverine'].lookup(['C1LN'])), [1])